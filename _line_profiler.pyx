@@ -1,4 +1,23 @@
 from python25 cimport PyFrameObject, PyObject, PyStringObject
+from libc.string cimport memset, memcpy
+
+import difflib
+import dis
+import linecache
+import sys
+import threading
+import time
+import weakref
+from types import CodeType, MethodType
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+try:
+    from thread import get_ident
+except ImportError:
+    from threading import get_ident
 
 
 cdef extern from "frameobject.h":
@@ -7,9 +26,14 @@ cdef extern from "frameobject.h":
 cdef extern from "Python.h":
     ctypedef long long PY_LONG_LONG
     cdef bint PyCFunction_Check(object obj)
+    cdef PyObject *PyDict_GetItem(object d, object key)
+    cdef void *PyMem_Malloc(size_t n)
+    cdef void PyMem_Free(void *p)
 
     cdef void PyEval_SetProfile(Py_tracefunc func, object arg)
     cdef void PyEval_SetTrace(Py_tracefunc func, object arg)
+    cdef PyFrameObject *PyEval_GetFrame()
+    cdef PyObject *PyWeakref_GetObject(object ref)
 
     ctypedef object (*PyCFunction)(object self, object args)
 
@@ -34,12 +58,40 @@ cdef extern from "Python.h":
     cdef int PyTrace_C_RETURN
 
 cdef extern from "timers.h":
+    ctypedef PY_LONG_LONG (*hpTimerFunc)()
     PY_LONG_LONG hpTimer()
     double hpTimerUnit()
+    const char *hpTimerDefaultName()
+    hpTimerFunc hpTimerLookup(const char *name, double *unit)
 
 cdef extern from "unset_trace.h":
     void unset_trace()
 
+cdef extern from "frame_compat.h":
+    PyObject *frame_code(PyFrameObject *frame)
+    int frame_lineno(PyFrameObject *frame)
+    int frame_lasti(PyFrameObject *frame)
+    cdef int PyTrace_OPCODE
+
+cdef extern from "histogram.h":
+    int HIST_NBUCKETS
+    int log2_bucket(PY_LONG_LONG t)
+
+cdef extern from "tracer_filter.h":
+    int tag_code(object code) except -1
+    int code_is_tagged(PyObject *code)
+    int set_code_entry(object code, object entry) except -1
+    PyObject *get_code_entry(object code)
+    int disable_line_events(PyFrameObject *frame, PyObject *code)
+    void restore_line_events(PyFrameObject *frame)
+
+cdef extern from "thread_trace.h":
+    int set_thread_trace(unsigned long thread_id, Py_tracefunc func, object arg)
+    int unset_thread_trace(unsigned long thread_id)
+    int set_trace_all_threads(Py_tracefunc func, object arg)
+    int unset_trace_all_threads()
+    unsigned long long current_thread_state_id()
+
 
 def label(code):
     """ Return a (filename, first_lineno, func_name) tuple for a given code
@@ -53,33 +105,402 @@ def label(code):
         return (code.co_filename, code.co_firstlineno, code.co_name)
 
 
-cdef class LineTiming:
-    """ The timing for a single line.
+def function_source(code):
+    """ Return the source lines of a code object, starting at its first line,
+    or None if the source is not available.
+    """
+    first_lineno, nlines = code_line_span(code)
+    lines = linecache.getlines(code.co_filename)
+    start = code.co_firstlineno - 1
+    lines = lines[start:first_lineno - 1 + nlines]
+    if not lines:
+        return None
+    return [line.rstrip('\r\n') for line in lines]
+
+
+TIMERS = ('gettimeofday', 'monotonic', 'monotonic_raw', 'qpc', 'tsc')
+
+
+def available_timers():
+    """ Return the names of the timer backends that can be used on this
+    platform, with the default one first.
+    """
+    cdef double unit
+    default = hpTimerDefaultName().decode('ascii')
+    names = [default]
+    for name in TIMERS:
+        if name != default and hpTimerLookup(name.encode('ascii'), &unit) != NULL:
+            names.append(name)
+    return names
+
+
+def code_line_span(code):
+    """ Return the (first_lineno, nlines) span of source lines that can produce
+    line events for the given code object.
+
+    The span is computed from the line number table (`co_lnotab` or
+    `co_lines()`, depending on the Python version) so that the per-line arrays
+    can be allocated once, up front.
+    """
+    first_lineno = code.co_firstlineno
+    last_lineno = first_lineno
+    for offset, lineno in dis.findlinestarts(code):
+        if lineno is not None:
+            first_lineno = min(first_lineno, lineno)
+            last_lineno = max(last_lineno, lineno)
+    return first_lineno, last_lineno - first_lineno + 1
+
+
+cdef class CodeTimings:
+    """ The line timings for a single code object.
+
+    Hit counts, total times and self times are kept in contiguous arrays of
+    64-bit integers indexed by `lineno - first_lineno`, so recording a hit is
+    a bounds check and three additions. The self time of a line leaves out the
+    time spent in other profiled functions that it called.
+
+    With `histogram`, each line also keeps the minimum and maximum time of
+    a hit and a histogram of hit times in HIST_NBUCKETS log2 buckets. With
+    `memory`, each line also keeps the bytes it allocated and the bytes it
+    left allocated. All of the arrays live in one allocation.
     """
     cdef public object code
-    cdef public int lineno
-    cdef public PY_LONG_LONG total_time
-    cdef public long nhits
+    cdef readonly int first_lineno
+    cdef readonly Py_ssize_t nlines
+    cdef readonly bint histogram
+    cdef readonly bint memory
+    cdef PY_LONG_LONG *data
+    cdef PY_LONG_LONG *nhits
+    cdef PY_LONG_LONG *total_time
+    cdef PY_LONG_LONG *self_time
+    cdef PY_LONG_LONG *min_time
+    cdef PY_LONG_LONG *max_time
+    cdef PY_LONG_LONG *buckets
+    cdef PY_LONG_LONG *allocated
+    cdef PY_LONG_LONG *retained
 
-    def __init__(self, object code, int lineno):
+    def __cinit__(self, object code, bint histogram=False, bint memory=False):
         self.code = code
-        self.lineno = lineno
-        self.total_time = 0
-        self.nhits = 0
+        self.histogram = histogram
+        self.memory = memory
+        self.first_lineno, self.nlines = code_line_span(code)
+        self.data = NULL
+        self._allocate(self.nlines)
+
+    def __dealloc__(self):
+        PyMem_Free(self.data)
+
+    cdef Py_ssize_t _row_size(self):
+        """ The number of 64-bit values kept for each line.
+        """
+        cdef Py_ssize_t size = 3
+        if self.histogram:
+            size += 2 + HIST_NBUCKETS
+        if self.memory:
+            size += 2
+        return size
+
+    cdef int _allocate(self, Py_ssize_t nlines) except -1:
+        """ Allocate zeroed arrays for `nlines` lines, keeping nothing.
+        """
+        cdef size_t nbytes = nlines * self._row_size() * sizeof(PY_LONG_LONG)
+        cdef PY_LONG_LONG *data = <PY_LONG_LONG *>PyMem_Malloc(nbytes)
+        if data == NULL:
+            raise MemoryError()
+        memset(data, 0, nbytes)
+        PyMem_Free(self.data)
+        self.data = data
+        self._set_views(nlines)
+        return 0
+
+    cdef void _set_views(self, Py_ssize_t nlines):
+        """ Point the per-line arrays into `data`, which holds `nlines` lines.
+        """
+        self.nlines = nlines
+        self.nhits = self.data
+        self.total_time = self.data + nlines
+        self.self_time = self.data + 2 * nlines
+        cdef PY_LONG_LONG *end = self.data + 3 * nlines
+        if self.histogram:
+            self.min_time = end
+            self.max_time = end + nlines
+            self.buckets = end + 2 * nlines
+            end += (2 + HIST_NBUCKETS) * nlines
+        if self.memory:
+            self.allocated = end
+            self.retained = end + nlines
+
+    cdef int _extend(self, int lineno) except -1:
+        """ Grow the arrays so that they cover `lineno`, keeping the current
+        counts.
+
+        This should not happen with the spans computed from the line number
+        table, but code objects can be built by hand.
+        """
+        cdef PY_LONG_LONG *old_data = self.data
+        cdef int first_lineno = min(self.first_lineno, lineno)
+        cdef int last_lineno = max(self.first_lineno + self.nlines - 1, lineno)
+        cdef Py_ssize_t shift = self.first_lineno - first_lineno
+        cdef Py_ssize_t old_nlines = self.nlines
+        cdef Py_ssize_t nlines = last_lineno - first_lineno + 1
+        cdef Py_ssize_t i
+        self.data = NULL
+        try:
+            self._allocate(nlines)
+        except MemoryError:
+            self.data = old_data
+            self._set_views(old_nlines)
+            raise
+        # Each per-line array, and each bucket of the histograms, is copied
+        # to its new, longer place.
+        for i in range(self._row_size()):
+            memcpy(self.data + i * nlines + shift, old_data + i * old_nlines,
+                old_nlines * sizeof(PY_LONG_LONG))
+        PyMem_Free(old_data)
+        self.first_lineno = first_lineno
+        return 0
+
+    cdef int hit(self, int lineno, PY_LONG_LONG dt, PY_LONG_LONG self_dt,
+        bint count=True) except -1:
+        """ Record a line timing, of which `self_dt` was spent outside of other
+        profiled functions. Without `count`, the time is added to the last hit
+        instead, as for the rest of a line after a generator resumes.
+        """
+        cdef Py_ssize_t i = lineno - self.first_lineno
+        if i < 0 or i >= self.nlines:
+            self._extend(lineno)
+            i = lineno - self.first_lineno
+        self.total_time[i] += dt
+        self.self_time[i] += self_dt
+        if not count:
+            return 0
+        self.nhits[i] += 1
+        if self.buckets != NULL:
+            if self.nhits[i] == 1 or dt < self.min_time[i]:
+                self.min_time[i] = dt
+            if dt > self.max_time[i]:
+                self.max_time[i] = dt
+            # Bucket b of line i, laid out bucket by bucket.
+            self.buckets[log2_bucket(dt) * self.nlines + i] += 1
+        return 0
+
+    cdef int add_memory(self, int lineno, PY_LONG_LONG allocated,
+        PY_LONG_LONG retained) except -1:
+        """ Record the bytes that a hit of a line allocated and the bytes that
+        it left allocated, which may be negative. Called after `hit()`.
+        """
+        cdef Py_ssize_t i = lineno - self.first_lineno
+        if self.allocated != NULL and 0 <= i < self.nlines:
+            self.allocated[i] += allocated
+            self.retained[i] += retained
+        return 0
+
+    cdef int add(self, CodeTimings other) except -1:
+        """ Add the counts of another CodeTimings for the same code object.
+        """
+        cdef Py_ssize_t i, j, b
+        if other.nlines == 0:
+            return 0
+        if other.first_lineno < self.first_lineno:
+            self._extend(other.first_lineno)
+        if other.first_lineno + other.nlines > self.first_lineno + self.nlines:
+            self._extend(other.first_lineno + other.nlines - 1)
+        j = other.first_lineno - self.first_lineno
+        for i in range(other.nlines):
+            if self.buckets != NULL and other.buckets != NULL and (
+                    other.nhits[i] != 0):
+                if self.nhits[i + j] == 0 or (
+                        other.min_time[i] < self.min_time[i + j]):
+                    self.min_time[i + j] = other.min_time[i]
+                if other.max_time[i] > self.max_time[i + j]:
+                    self.max_time[i + j] = other.max_time[i]
+                for b in range(HIST_NBUCKETS):
+                    self.buckets[b * self.nlines + i + j] += (
+                        other.buckets[b * other.nlines + i])
+            if self.allocated != NULL and other.allocated != NULL:
+                self.allocated[i + j] += other.allocated[i]
+                self.retained[i + j] += other.retained[i]
+            self.nhits[i + j] += other.nhits[i]
+            self.total_time[i + j] += other.total_time[i]
+            self.self_time[i + j] += other.self_time[i]
+        return 0
+
+    def astuples(self):
+        """ Convert to a list of (lineno, nhits, total_time) tuples for each line
+        that has been hit, sorted by line number.
+        """
+        cdef Py_ssize_t i
+        result = []
+        for i in range(self.nlines):
+            if self.nhits[i] != 0:
+                result.append((self.first_lineno + i, self.nhits[i],
+                    self.total_time[i]))
+        return result
+
+    def self_astuples(self):
+        """ Like `astuples()`, but with the self time of each line instead of
+        its total time.
+        """
+        cdef Py_ssize_t i
+        result = []
+        for i in range(self.nlines):
+            if self.nhits[i] != 0:
+                result.append((self.first_lineno + i, self.nhits[i],
+                    self.self_time[i]))
+        return result
 
-    cdef hit(self, PY_LONG_LONG dt):
-        """ Record a line timing.
+    def memory_astuples(self):
+        """ Convert the memory counts to a list of (lineno, allocated,
+        retained) tuples for each line that has been hit, sorted by line
+        number. See `LineStats.memory`.
         """
-        self.nhits += 1
-        self.total_time += dt
+        cdef Py_ssize_t i
+        result = []
+        if self.allocated == NULL:
+            return result
+        for i in range(self.nlines):
+            if self.nhits[i] != 0:
+                result.append((self.first_lineno + i, self.allocated[i],
+                    self.retained[i]))
+        return result
 
-    def astuple(self):
-        """ Convert to a tuple of (lineno, nhits, total_time).
+    def histograms(self):
+        """ Convert the histograms to a list of (lineno, min_time, max_time,
+        counts) tuples for each line that has been hit, sorted by line number.
+
+        `counts` is a tuple of the number of hits in each log2 bucket, without
+        the empty buckets at the end. See `LineStats.histograms`.
+        """
+        cdef Py_ssize_t i, b, nbuckets
+        result = []
+        if self.buckets == NULL:
+            return result
+        for i in range(self.nlines):
+            if self.nhits[i] == 0:
+                continue
+            nbuckets = HIST_NBUCKETS
+            while nbuckets > 0 and self.buckets[
+                    (nbuckets - 1) * self.nlines + i] == 0:
+                nbuckets -= 1
+            result.append((self.first_lineno + i, self.min_time[i],
+                self.max_time[i], tuple([self.buckets[b * self.nlines + i]
+                for b in range(nbuckets)])))
+        return result
+
+    def clear(self):
+        """ Reset all of the counts to zero.
         """
-        return (self.lineno, self.nhits, self.total_time)
+        memset(self.data, 0,
+            self.nlines * self._row_size() * sizeof(PY_LONG_LONG))
 
     def __repr__(self):
-        return '<LineTiming for %r\n  lineno: %r\n  nhits: %r\n  total_time: %r>' % (self.code, self.lineno, self.nhits, <long>self.total_time)
+        return '<CodeTimings for %r\n  lines: %r-%r>' % (self.code,
+            self.first_lineno, self.first_lineno + self.nlines - 1)
+
+
+cdef class InstructionTimings:
+    """ The timings of the bytecode instructions on selected lines of a single
+    code object.
+
+    Hit counts and total times are kept in arrays indexed by the offset of the
+    instruction in code units, like in CodeTimings. Only the instructions at
+    the offsets passed to `select()` are timed.
+    """
+    cdef public object code
+    cdef readonly Py_ssize_t ncodeunits
+    cdef PY_LONG_LONG *data
+    cdef PY_LONG_LONG *nhits
+    cdef PY_LONG_LONG *total_time
+    cdef unsigned char *selected
+
+    def __cinit__(self, object code):
+        cdef Py_ssize_t n = max(1, len(code.co_code) // 2)
+        cdef size_t nbytes = n * (2 * sizeof(PY_LONG_LONG) + 1)
+        self.code = code
+        self.ncodeunits = n
+        self.data = <PY_LONG_LONG *>PyMem_Malloc(nbytes)
+        if self.data == NULL:
+            raise MemoryError()
+        memset(self.data, 0, nbytes)
+        self.nhits = self.data
+        self.total_time = self.data + n
+        self.selected = <unsigned char *>(self.data + 2 * n)
+
+    def __dealloc__(self):
+        PyMem_Free(self.data)
+
+    def select(self, offsets):
+        """ Time the instructions at these byte offsets too.
+        """
+        cdef Py_ssize_t i
+        for offset in offsets:
+            i = offset // 2
+            if 0 <= i < self.ncodeunits:
+                self.selected[i] = 1
+
+    cdef copy_selection(self, InstructionTimings other):
+        memcpy(self.selected, other.selected, self.ncodeunits)
+
+    cdef inline bint is_selected(self, int offset):
+        cdef Py_ssize_t i = offset >> 1
+        return 0 <= i < self.ncodeunits and self.selected[i]
+
+    cdef inline void hit(self, int offset, PY_LONG_LONG dt):
+        cdef Py_ssize_t i = offset >> 1
+        if 0 <= i < self.ncodeunits:
+            self.nhits[i] += 1
+            self.total_time[i] += dt
+
+    cdef add(self, InstructionTimings other):
+        """ Add the counts of another InstructionTimings for the same code.
+        """
+        cdef Py_ssize_t i
+        for i in range(min(self.ncodeunits, other.ncodeunits)):
+            self.nhits[i] += other.nhits[i]
+            self.total_time[i] += other.total_time[i]
+
+    def astuples(self):
+        """ Convert to a list of (offset, nhits, total_time) tuples for each
+        instruction that has been hit, sorted by offset.
+        """
+        cdef Py_ssize_t i
+        result = []
+        for i in range(self.ncodeunits):
+            if self.nhits[i] != 0:
+                result.append((2 * i, self.nhits[i], self.total_time[i]))
+        return result
+
+    def clear(self):
+        """ Reset all of the counts to zero, keeping the selection.
+        """
+        memset(self.data, 0, 2 * self.ncodeunits * sizeof(PY_LONG_LONG))
+
+
+def line_offsets(code, lineno):
+    """ Return the byte offsets of the instructions of `code` on line `lineno`.
+    """
+    return sorted(offset for offset, offset_lineno in _line_table(code).items()
+        if offset_lineno == lineno)
+
+
+def instruction_info(code):
+    """ Return a dictionary from the byte offset of each instruction of `code`
+    to its (lineno, opname, col_offset, end_col_offset). The columns are
+    0-based, and None before Python 3.11 or if the instruction spans several
+    lines.
+    """
+    linenos = _line_table(code)
+    info = {}
+    for instruction in dis.get_instructions(code):
+        col_offset = end_col_offset = None
+        positions = getattr(instruction, 'positions', None)
+        if positions is not None and positions.lineno is not None and (
+                positions.lineno == positions.end_lineno):
+            col_offset = positions.col_offset
+            end_col_offset = positions.end_col_offset
+        info[instruction.offset] = (linenos.get(instruction.offset),
+            instruction.opname, col_offset, end_col_offset)
+    return info
 
 
 # Note: this is a regular Python class to allow easy pickling.
@@ -95,58 +516,678 @@ class LineStats(object):
         timer.
     unit : float
         The number of seconds per timer unit.
+    overhead : float
+        The calibrated cost of the trace callback per recorded hit, in timer
+        units, or 0 if the profiler was not calibrated.
+    threads : dict or None
+        For profilers tracing all threads, a mapping from (thread_id,
+        thread_name) to timings in the same format as `timings`, covering only
+        that thread. `timings` is the sum over all threads.
+    processes : dict or None
+        For statistics merged from several processes, a mapping from process
+        id to the timings of that process. `timings` is the sum over all
+        processes.
+    sample_interval : float or None
+        For statistics from the 'sample' mode, the requested sampling interval
+        in seconds. nhits is then a count of samples, and total_time is the
+        estimated time.
+    sources : dict or None
+        Mapping from the keys of `timings` to the source lines of each function
+        when it was profiled, starting at its first line, where available.
+    self_timings : dict or None
+        For profilers recording exclusive times, the same as `timings` but
+        with the self time of each line, which leaves out the time spent in
+        other profiled functions.
+    histograms : dict or None
+        For profilers recording histograms, a mapping from the keys of
+        `timings` to a list of (lineno, min_time, max_time, counts) tuples for
+        each line. counts[i] is the number of hits that took at least 2**i and
+        less than 2**(i + 1) timer units; counts[0] also counts hits that took
+        0 units. `histogram_percentile()` estimates percentiles from them.
+    tasks : dict or None
+        For profilers splitting the timings by asyncio task, a mapping from
+        task name to timings in the same format as `timings`, covering only
+        the lines run by tasks of that name.
+    instructions : dict or None
+        For profilers timing the instructions of selected lines, a mapping from
+        the keys of `timings` to a list of (lineno, offset, opname, col_offset,
+        end_col_offset, nhits, total_time) tuples for each instruction that was
+        hit, sorted by offset. The columns locate the instruction in its line
+        of source, as in `instruction_info()`.
+    memory : dict or None
+        For profilers tracking memory, a mapping from the keys of `timings` to
+        a list of (lineno, allocated, retained) tuples for each line, in
+        bytes. allocated is the sum over the hits of the line of the highest
+        traced memory during the hit less the memory at its start, which
+        includes temporaries that were freed again. retained is the change of
+        the traced memory over all of the hits, and may be negative.
     """
-    def __init__(self, timings, unit):
+    # Older pickles do not have these attributes.
+    overhead = 0.0
+    threads = None
+    processes = None
+    sample_interval = None
+    sources = None
+    self_timings = None
+    histograms = None
+    tasks = None
+    instructions = None
+    memory = None
+
+    def __init__(self, timings, unit, overhead=0.0, threads=None,
+        processes=None, sample_interval=None, sources=None, self_timings=None,
+        histograms=None, tasks=None, memory=None, instructions=None):
         self.timings = timings
         self.unit = unit
+        self.overhead = overhead
+        self.threads = threads
+        self.processes = processes
+        self.sample_interval = sample_interval
+        self.sources = sources
+        self.self_timings = self_timings
+        self.histograms = histograms
+        self.tasks = tasks
+        self.memory = memory
+        self.instructions = instructions
+
+    def corrected_timings(self):
+        """ Return the timings with the tracer overhead subtracted from each
+        hit, in the same format as `timings`.
+
+        Times are clamped at 0 since the overhead is only an estimate.
+        """
+        overhead = self.overhead
+        corrected = {}
+        for key, timings in self.timings.items():
+            corrected[key] = [
+                (lineno, nhits, max(0, int(round(time - nhits * overhead))))
+                for lineno, nhits, time in timings]
+        return corrected
+
+    def diff(self, other):
+        """ Compare these statistics, as the baseline, with `other`, and return
+        a LineStatsDiff.
+
+        Functions are matched by their (filename, first_lineno, name) key, or
+        by filename and name alone if a function has moved. When the sources
+        of a matched function were recorded in both, its lines are matched by
+        diffing the sources, so that lines that moved or were edited are still
+        compared with their old selves. Otherwise, lines are matched by their
+        offset from the first line of the function.
+        """
+        return LineStatsDiff(self, other)
+
+
+class LineStatsDiff(object):
+    """ The differences between two sets of line-profile statistics.
+
+    Attributes
+    ----------
+    unit : float
+        The number of seconds per timer unit, the finer of the two.
+    functions : list
+        One (base_key, new_key, base_hits, new_hits, base_time, new_time)
+        tuple for each function, with the total hits and time of its lines.
+        One of the keys is None for a function that is only in one of the
+        statistics. Sorted by the change in time, largest increase first.
+    lines : list
+        One (base_key, new_key, base_lineno, new_lineno, base_hits, new_hits,
+        base_time, new_time) tuple for each profiled line, with the keys of
+        its function. One of the line numbers is None for a line that was
+        added or removed, whose hits and time are 0 on that side. Sorted by
+        the change in time, largest increase first.
+    sources : dict
+        The recorded source lines of the functions in either statistics, as in
+        `LineStats.sources`.
+    """
+
+    def __init__(self, base, new):
+        self.unit = min(base.unit, new.unit)
+        base_scale = base.unit / self.unit
+        new_scale = new.unit / self.unit
+        self.functions = []
+        self.lines = []
+        self.sources = dict(base.sources or {})
+        self.sources.update(new.sources or {})
+        for base_key, new_key in _match_functions(base.timings, new.timings):
+            base_lines = dict((lineno, (nhits, int(round(time * base_scale))))
+                for lineno, nhits, time in base.timings.get(base_key, ()))
+            new_lines = dict((lineno, (nhits, int(round(time * new_scale))))
+                for lineno, nhits, time in new.timings.get(new_key, ()))
+            line_map = {}
+            if base_key is not None and new_key is not None:
+                line_map = _match_lines(base_key, new_key,
+                    (base.sources or {}).get(base_key),
+                    (new.sources or {}).get(new_key))
+            lines = []
+            for base_lineno, (base_hits, base_time) in base_lines.items():
+                new_lineno = line_map.get(base_lineno)
+                new_hits, new_time = new_lines.pop(new_lineno, (0, 0))
+                lines.append((base_key, new_key, base_lineno, new_lineno,
+                    base_hits, new_hits, base_time, new_time))
+            for new_lineno, (new_hits, new_time) in new_lines.items():
+                lines.append((base_key, new_key, None, new_lineno, 0, new_hits,
+                    0, new_time))
+            self.lines.extend(lines)
+            self.functions.append((base_key, new_key,
+                sum([line[4] for line in lines]),
+                sum([line[5] for line in lines]),
+                sum([line[6] for line in lines]),
+                sum([line[7] for line in lines])))
+        self.functions.sort(key=lambda entry: entry[4] - entry[5])
+        self.lines.sort(key=lambda entry: entry[6] - entry[7])
+
+    def regressions(self, threshold=0.0, min_time=0.0, per_hit=False):
+        """ Return the entries of `lines` that got slower by more than the
+        fraction `threshold` of their baseline time and by more than
+        `min_time` seconds.
+
+        With `per_hit`, the time per hit is compared instead of the total time,
+        which is better when the two runs did different amounts of work.
+        """
+        regressions = []
+        for entry in self.lines:
+            base_hits, new_hits, base_time, new_time = entry[4:]
+            if per_hit:
+                base_time = float(base_time) / base_hits if base_hits else 0.0
+                new_time = float(new_time) / new_hits if new_hits else 0.0
+            delta = new_time - base_time
+            if (delta > threshold * base_time and
+                    delta * self.unit > min_time):
+                regressions.append(entry)
+        return regressions
+
+
+def _match_functions(base_timings, new_timings):
+    """ Pair up the keys of two `LineStats.timings` mappings.
+
+    Keys that are not in both are paired by filename and function name, if
+    that is unambiguous. The others are paired with None.
+    """
+    pairs = []
+    unmatched_base = {}
+    unmatched_new = {}
+    for key in base_timings:
+        if key in new_timings:
+            pairs.append((key, key))
+        else:
+            unmatched_base.setdefault((key[0], key[2]), []).append(key)
+    for key in new_timings:
+        if key not in base_timings:
+            unmatched_new.setdefault((key[0], key[2]), []).append(key)
+    for name, base_keys in unmatched_base.items():
+        new_keys = unmatched_new.pop(name, [])
+        if len(base_keys) == 1 and len(new_keys) == 1:
+            pairs.append((base_keys[0], new_keys[0]))
+        else:
+            pairs.extend([(key, None) for key in base_keys])
+            pairs.extend([(None, key) for key in new_keys])
+    for new_keys in unmatched_new.values():
+        pairs.extend([(None, key) for key in new_keys])
+    return pairs
+
+
+def _match_lines(base_key, new_key, base_source, new_source):
+    """ Return a mapping from the line numbers of a function in the baseline
+    to its line numbers in the new statistics.
+    """
+    base_first = base_key[1]
+    new_first = new_key[1]
+    if base_source is None or new_source is None:
+        return _ShiftedLines(new_first - base_first)
+    line_map = {}
+    matcher = difflib.SequenceMatcher(None, base_source, new_source,
+        autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        # Edited lines are matched one for one if the number of lines did not
+        # change.
+        if tag == 'equal' or (tag == 'replace' and i2 - i1 == j2 - j1):
+            for i, j in zip(range(i1, i2), range(j1, j2)):
+                line_map[base_first + i] = new_first + j
+    return line_map
+
+
+class _ShiftedLines(object):
+    """ A line mapping that adds a constant offset.
+    """
+
+    def __init__(self, shift):
+        self.shift = shift
+
+    def get(self, lineno, default=None):
+        return lineno + self.shift
+
+
+def histogram_percentile(counts, fraction, min_time, max_time):
+    """ Estimate a percentile of the hit times of a line from its histogram,
+    as in `LineStats.histograms`.
+
+    `fraction` is the percentile as a fraction, e.g. 0.99 for p99. Within the
+    bucket that holds it, the times are taken to be evenly spread, and the
+    estimate is kept between `min_time` and `max_time`.
+    """
+    total = sum(counts)
+    if total == 0:
+        return 0.0
+    rank = fraction * total
+    seen = 0
+    for i, count in enumerate(counts):
+        if count and seen + count >= rank:
+            low = 2 ** i if i > 0 else 0
+            estimate = low + (2 ** (i + 1) - low) * (rank - seen) / count
+            return float(min(max(estimate, min_time), max_time))
+        seen += count
+    return float(max_time)
+
+
+def merge_timings(timings_list):
+    """ Sum several mappings in the format of `LineStats.timings`, line by line.
+    """
+    lines = {}
+    for timings in timings_list:
+        for key, entries in timings.items():
+            key_lines = lines.setdefault(key, {})
+            for lineno, nhits, time in entries:
+                if lineno in key_lines:
+                    old_nhits, old_time = key_lines[lineno]
+                    key_lines[lineno] = (old_nhits + nhits, old_time + time)
+                else:
+                    key_lines[lineno] = (nhits, time)
+    merged = {}
+    for key, key_lines in lines.items():
+        merged[key] = sorted((lineno, nhits, time)
+            for lineno, (nhits, time) in key_lines.items())
+    return merged
+
+
+_CALIBRATION_SOURCE = """
+def calibration_loop(n):
+    i = 0
+    while i < n:
+        i += 1
+"""
+
+
+def _calibration_function():
+    """ Return a fresh pure-Python function that runs a loop of trivial lines.
+    """
+    ns = {}
+    exec(compile(_CALIBRATION_SOURCE, '<line_profiler calibration>', 'exec'),
+        ns)
+    return ns['calibration_loop']
+
+
+cdef class _ThreadState:
+    """ The tracing state for the threads sharing one set of timing buffers.
+
+    Each traced thread passes its state object to the trace callback, so the
+    callback never has to look up the current thread. By default, all threads
+    share the profiler's own state. In `all_threads` mode, every thread gets
+    its own state keyed by thread id, and only that thread ever writes to it.
+    """
+    cdef LineProfiler profiler
+    cdef public object thread_id
+    cdef public object thread_name
+    # The id of the Python thread state, which tells a thread apart from an
+    # earlier one with the same thread id, or 0 if unknown.
+    cdef unsigned long long tstate_id
+    cdef public dict code_map
+    # The values of `code_map` in the order the code objects were added to the
+    # profiler, which the sys.monitoring callbacks index.
+    cdef list code_timings
+    cdef public dict last_time
+    cdef public dict task_code_maps
+    cdef public dict instruction_map
+    cdef list stack
+    # The timings of the call being captured by `LineProfiler.call_captured()`,
+    # or None.
+    cdef dict capture
+    # Whether the line events of some frame were switched off since the
+    # profiler was enabled.
+    cdef bint lines_disabled
+
+    def __cinit__(self, LineProfiler profiler, thread_id=None, thread_name=None,
+        dict code_map=None, dict last_time=None):
+        self.profiler = profiler
+        self.thread_id = thread_id
+        self.thread_name = thread_name
+        if code_map is None:
+            code_map = {}
+            for code in profiler.code_map:
+                code_map[code] = CodeTimings(code, profiler.histogram,
+                    profiler.memory)
+        self.code_map = code_map
+        self.code_timings = list(code_map.values())
+        if last_time is None:
+            last_time = {}
+        self.last_time = last_time
+        self.task_code_maps = {}
+        self.instruction_map = {}
+        if profiler.state is not None:
+            for code, other in profiler.state.instruction_map.items():
+                timings = InstructionTimings(code)
+                timings.copy_selection(other)
+                self.instruction_map[code] = timings
+        self.stack = []
+
+    cdef CodeTimings captured(self, object code):
+        """ Return the timings of `code` for the call being captured.
+        """
+        timings = self.capture.get(code)
+        if timings is None:
+            timings = self.capture[code] = CodeTimings(code,
+                self.profiler.histogram, self.profiler.memory)
+        return timings
+
+    cdef keep_capture(self, dict capture):
+        """ Add the timings of a captured call to those of the call that it is
+        nested in, or to the state's own timings.
+        """
+        for code, timings in capture.items():
+            if self.capture is not None:
+                self.captured(code).add(timings)
+            else:
+                (<CodeTimings>self.code_map[code]).add(timings)
+
+    cdef forget_frames(self):
+        """ Forget the running lines, when the profiler is disabled.
+        """
+        self.last_time.clear()
+        del self.stack[:]
+
+    cdef CodeTimings task_timings(self, object code):
+        """ Return the timings of `code` for the asyncio task running now, or
+        None outside of a task.
+        """
+        task = _current_task()
+        if task is None:
+            return None
+        try:
+            name = task.get_name()
+        except AttributeError:
+            name = 'Task at 0x%x' % id(task)
+        code_map = self.task_code_maps.get(name)
+        if code_map is None:
+            code_map = self.task_code_maps[name] = {}
+        timings = code_map.get(code)
+        if timings is None:
+            timings = code_map[code] = CodeTimings(code,
+                self.profiler.histogram)
+        return timings
+
+
+def _current_task():
+    """ Return the asyncio task running in this thread, or None.
+    """
+    asyncio = sys.modules.get('asyncio')
+    if asyncio is None:
+        return None
+    current_task = getattr(asyncio, 'current_task', None)
+    if current_task is None:
+        current_task = asyncio.Task.current_task
+    try:
+        return current_task()
+    except RuntimeError:
+        # No event loop is running.
+        return None
+
+
+# Generators, coroutines, iterable coroutines and async generators.
+cdef int _SUSPENDABLE_FLAGS = 0x0020 | 0x0080 | 0x0100 | 0x0200
+
+
+cdef bint _frame_is_resuming(object frame):
+    """ Return True if the call event of `frame` is a generator or coroutine
+    resuming after a yield or an await, rather than a new call.
+    """
+    code = frame.f_code
+    if not code.co_flags & _SUSPENDABLE_FLAGS:
+        return False
+    if sys.version_info < (3, 11):
+        return frame.f_lasti >= 0
+    # Every call starts at a RESUME instruction, but only the ones after
+    # a yield or an await have a nonzero kind in the low bits of their arg.
+    entry = _monitored_code(code)
+    if entry.resume_offsets is None:
+        entry.resume_offsets = frozenset(
+            instr.offset for instr in dis.get_instructions(code)
+            if instr.opname == 'RESUME' and instr.arg & 3)
+    return frame.f_lasti in entry.resume_offsets
 
 
 cdef class LineProfiler:
     """ Time the execution of lines of Python code.
+
+    Parameters
+    ----------
+    *functions
+        Functions to profile.
+    timer : str, optional
+        The name of the timer backend to use, one of `available_timers()`. By
+        default, the platform's monotonic nanosecond clock is used where
+        available.
+    all_threads : bool, optional
+        If True, `enable()` installs the tracer on every existing thread and on
+        threads started later, instead of only on the calling thread. Each
+        thread records into its own buffers, which `get_stats()` merges.
+    mode : {'trace', 'sample'}, optional
+        'trace', the default, records every line event. 'sample' instead
+        starts a background thread that wakes up every `interval` seconds and
+        looks at the current line of each registered function on the stack of
+        the profiled thread (or of every thread, with `all_threads`). Hit
+        counts are then sample counts and times are the elapsed time between
+        samples, which is far cheaper than tracing but only statistically
+        accurate.
+    interval : float, optional
+        The sampling interval in seconds for the 'sample' mode.
+    engine : {'monitoring', 'settrace'}, optional
+        How the 'trace' mode gets line events. 'monitoring' uses
+        `sys.monitoring` (Python 3.12+) and only turns on events for the
+        registered code objects, so other code runs at full speed.
+        'settrace' uses `PyEval_SetTrace()`. By default, 'monitoring' is used
+        where it is available.
+    exclusive : bool, optional
+        If True, also record the self time of each line, which leaves out the
+        time spent in other profiled functions that the line called. In the
+        'sample' mode, the self time is charged only to the innermost profiled
+        function on the stack.
+    histogram : bool, optional
+        If True, also record the minimum and maximum time of each line and
+        a histogram of its hit times, so that tail latencies can be reported.
+        Only available in the 'trace' mode.
+    asyncio : bool, optional
+        If True, keep track of the running line of each frame instead of each
+        code object, so that coroutines running the same code in concurrent
+        tasks, or recursive calls, do not get each other's time, and start
+        timing again as soon as a suspended coroutine resumes. Time spent
+        suspended at an `await` is never charged to a line. Only available in
+        the 'trace' mode.
+    per_task : bool, optional
+        If True, also split the timings by the name of the asyncio task that
+        ran them. Implies `asyncio`.
+    memory : bool, optional
+        If True, also record the bytes that each line allocates and the bytes
+        that it leaves allocated, as traced by `tracemalloc`, which is started
+        while the profiler is enabled if it is not tracing already. This
+        covers the allocations of Python objects and of extensions that report
+        to tracemalloc, like NumPy arrays. The counts are for the whole
+        process, so other threads running at the same time add to them. Only
+        available in the 'trace' mode on Python 3.9+.
     """
     cdef public list functions
     cdef public dict code_map
     cdef public dict last_time
+    cdef readonly bint all_threads
+    cdef public dict thread_states
+    cdef public list finished_thread_states
+    cdef public dict instruction_lines
+    cdef _ThreadState state
+    cdef readonly object timer
     cdef public double timer_unit
     cdef public long enable_count
+    cdef public double overhead
+    cdef readonly object mode
+    cdef public double interval
+    cdef object sampler
+    cdef object sampling
+    cdef object sampled_thread_id
+    cdef readonly object engine
+    cdef readonly bint exclusive
+    cdef readonly bint histogram
+    cdef readonly bint asyncio
+    cdef readonly bint per_task
+    cdef readonly bint memory
+    cdef bint started_tracemalloc
+    cdef bint monitoring
+    cdef object monitor_ref
+    cdef _MonitorRelease monitor_release
+    cdef unsigned long long cached_thread_id
+    cdef _ThreadState cached_state
+    cdef hpTimerFunc timer_func
+    cdef object __weakref__
 
-    def __init__(self, *functions):
+    def __init__(self, *functions, timer=None, all_threads=False, mode='trace',
+        interval=0.001, engine=None, exclusive=False, histogram=False,
+        asyncio=False, per_task=False, memory=False):
+        cdef double unit = 0.0
+        if mode not in ('trace', 'sample'):
+            raise ValueError("mode must be 'trace' or 'sample', not %r." % (
+                mode,))
+        if histogram and mode != 'trace':
+            raise ValueError('Histograms are only available in the trace mode.')
+        if (asyncio or per_task) and mode != 'trace':
+            raise ValueError('The asyncio mode is only available in the trace '
+                'mode.')
+        if memory and mode != 'trace':
+            raise ValueError('Memory tracking is only available in the trace '
+                'mode.')
+        if memory and not hasattr(tracemalloc, 'reset_peak'):
+            raise ValueError('Memory tracking requires Python 3.9 or later.')
+        if engine is None:
+            engine = 'monitoring' if monitoring_available() else 'settrace'
+        elif engine not in ('monitoring', 'settrace'):
+            raise ValueError("engine must be 'monitoring' or 'settrace', not "
+                "%r." % (engine,))
+        elif engine == 'monitoring' and not monitoring_available():
+            raise ValueError('sys.monitoring requires Python 3.12 or later.')
+        if timer is None:
+            timer = hpTimerDefaultName().decode('ascii')
+        self.timer_func = hpTimerLookup(timer.encode('ascii'), &unit)
+        if self.timer_func == NULL:
+            raise ValueError('Timer %r is not available; choose one of %s.' % (
+                timer, ', '.join(available_timers())))
+        self.timer = timer
+        self.timer_unit = unit
         self.functions = []
         self.code_map = {}
         self.last_time = {}
-        self.timer_unit = hpTimerUnit()
+        self.all_threads = all_threads
+        self.thread_states = {}
+        self.finished_thread_states = []
+        self.instruction_lines = {}
+        self.state = _ThreadState(self, code_map=self.code_map,
+            last_time=self.last_time)
         self.enable_count = 0
+        self.overhead = 0.0
+        self.mode = mode
+        self.interval = interval
+        self.sampler = None
+        self.sampling = threading.Event()
+        self.sampled_thread_id = None
+        self.engine = engine
+        self.exclusive = exclusive
+        self.histogram = histogram
+        self.asyncio = asyncio or per_task
+        self.per_task = per_task
+        self.memory = memory
+        self.started_tracemalloc = False
+        self.monitoring = False
+        self.monitor_ref = None
+        self.monitor_release = None
+        self.cached_thread_id = 0
+        self.cached_state = None
         for func in functions:
             self.add_function(func)
 
     def add_function(self, func):
-        """ Record line profiling information for the given Python function.
+        """ Record line profiling information for the given Python function,
+        or for a code object, like the code of a nested function.
         """
-        try:
-            code = func.__code__
-        except AttributeError:
-            import warnings
-            warnings.warn("Could not extract a code object for the object %r" % (func,))
-            return
+        if isinstance(func, CodeType):
+            code = func
+        else:
+            try:
+                code = func.__code__
+            except AttributeError:
+                import warnings
+                warnings.warn("Could not extract a code object for the object %r" % (func,))
+                return
         if code not in self.code_map:
-            self.code_map[code] = {}
+            tag_code(code)
+            self.code_map[code] = CodeTimings(code, self.histogram, self.memory)
+            self.state.code_timings.append(self.code_map[code])
+            for state in self.all_thread_states():
+                timings = CodeTimings(code, self.histogram, self.memory)
+                (<_ThreadState>state).code_map[code] = timings
+                (<_ThreadState>state).code_timings.append(timings)
             self.functions.append(func)
+            if self.engine == 'monitoring' and self.mode == 'trace':
+                _monitor_code(self, code, len(self.state.code_timings) - 1)
+
+    def add_line(self, func, int lineno):
+        """ Also time each bytecode instruction on line `lineno` of a Python
+        function, which is added with `add_function()` if needed.
+
+        Only frames that start after this call time their instructions with
+        the 'settrace' engine. The times include the tracer's overhead, which
+        is large next to most instructions, so they are best compared with
+        each other. Only available in the 'trace' mode on Python 3.7+.
+        """
+        cdef _ThreadState state
+        if self.mode != 'trace':
+            raise ValueError('Instructions can only be timed in the trace '
+                'mode.')
+        if sys.version_info < (3, 7):
+            raise ValueError('Timing instructions requires Python 3.7 or '
+                'later.')
+        code = func.__code__
+        offsets = line_offsets(code, lineno)
+        if not offsets:
+            raise ValueError('Line %d of %s has no instructions.' % (lineno,
+                code.co_name))
+        self.add_function(func)
+        for state in [self.state] + self.all_thread_states():
+            timings = state.instruction_map.get(code)
+            if timings is None:
+                timings = state.instruction_map[code] = InstructionTimings(code)
+            timings.select(offsets)
+        self.instruction_lines.setdefault(code, set()).add(lineno)
+        if self.engine == 'monitoring':
+            _monitor_instructions(code)
 
     def enable_by_count(self):
         """ Enable the profiler if it hasn't been enabled before.
         """
-        if self.enable_count == 0:
-            self.enable()
-        self.enable_count += 1
+        self._enable_by_count()
 
     def disable_by_count(self):
         """ Disable the profiler if the number of disable requests matches the
         number of enable requests.
         """
+        self._disable_by_count()
+
+    cdef int _enable_by_count(self) except -1:
+        if self.enable_count == 0:
+            self.enable()
+        self.enable_count += 1
+        return 0
+
+    cdef int _disable_by_count(self) except -1:
         if self.enable_count > 0:
             self.enable_count -= 1
             if self.enable_count == 0:
                 self.disable()
+        return 0
 
     def __enter__(self):
         self.enable_by_count()
@@ -154,75 +1195,1117 @@ cdef class LineProfiler:
     def __exit__(self, exc_type, exc_val, exc_tb):
         self.disable_by_count()
 
+    cdef _ThreadState _current_state(self):
+        """ Return the state that the current thread records into.
+        """
+        if self.all_threads:
+            return self._thread_state(get_ident())
+        return self.state
+
+    cdef object _call_captured(self, func, tuple args, dict kwds,
+        PY_LONG_LONG threshold):
+        """ Profile a call of `func`, but only keep its timings if it takes at
+        least `threshold` timer units.
+
+        The timings of the call are recorded apart, so the timings of other
+        calls are not held up, and a captured call nested in another one adds
+        its timings to those of the outer call.
+        """
+        cdef _ThreadState state
+        cdef dict outer, capture
+        cdef PY_LONG_LONG start
+        self._enable_by_count()
+        state = self._current_state()
+        outer = state.capture
+        state.capture = {}
+        start = self.timer_func()
+        try:
+            return func(*args, **kwds)
+        finally:
+            capture = state.capture
+            state.capture = outer
+            try:
+                if self.timer_func() - start >= threshold:
+                    state.keep_capture(capture)
+            finally:
+                self._disable_by_count()
+
     def enable(self):
-        PyEval_SetTrace(python_trace_callback, self)
+        if self.memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.started_tracemalloc = True
+        if self.mode == 'sample':
+            self.sampled_thread_id = get_ident()
+            self.sampling.set()
+            if self.sampler is None or not self.sampler.is_alive():
+                self.sampler = threading.Thread(target=self._sample_loop,
+                    name='line_profiler sampler')
+                self.sampler.daemon = True
+                self.sampler.start()
+        elif self.engine == 'monitoring':
+            if self.all_threads:
+                self.cached_thread_id = 0
+                self.cached_state = None
+            else:
+                self.cached_thread_id = current_thread_state_id()
+                self.cached_state = self.state
+            self.monitoring = True
+        elif self.all_threads:
+            self._request_opcode_events()
+            threading.settrace(self._trace_new_thread)
+            if sys.version_info >= (3, 12):
+                set_trace_all_threads(trace_first_event, self)
+            else:
+                for thread_id in sys._current_frames():
+                    set_thread_trace(thread_id, python_trace_callback,
+                        self._thread_state(thread_id))
+        else:
+            self._request_opcode_events()
+            PyEval_SetTrace(python_trace_callback, self.state)
+
+    def _request_opcode_events(self):
+        """ Since Python 3.12, a tracer only gets opcode events if a frame has
+        asked for them before the tracer is installed.
+        """
+        if self.instruction_lines and sys.version_info >= (3, 12):
+            frame = sys._getframe()
+            frame.f_trace_opcodes = True
+            frame.f_trace_opcodes = False
 
     def disable(self):
-        self.last_time = {}
-        unset_trace()
+        self.state.forget_frames()
+        if self.mode == 'sample':
+            self.sampling.clear()
+        elif self.monitoring:
+            self.monitoring = False
+            for state in self.all_thread_states():
+                (<_ThreadState>state).forget_frames()
+        elif self.all_threads:
+            threading.settrace(None)
+            if sys.version_info >= (3, 12):
+                unset_trace_all_threads()
+            else:
+                for thread_id in sys._current_frames():
+                    unset_thread_trace(thread_id)
+            lines_disabled = False
+            for state in self.all_thread_states():
+                (<_ThreadState>state).forget_frames()
+                lines_disabled |= (<_ThreadState>state).lines_disabled
+                (<_ThreadState>state).lines_disabled = False
+            if lines_disabled:
+                for frame in sys._current_frames().values():
+                    restore_line_events(<PyFrameObject *>frame)
+        else:
+            unset_trace()
+            if self.state.lines_disabled:
+                self.state.lines_disabled = False
+                restore_line_events(PyEval_GetFrame())
+        if self.started_tracemalloc:
+            tracemalloc.stop()
+            self.started_tracemalloc = False
+
+    def _sample_loop(self):
+        """ The body of the sampler thread.
+
+        The thread stays around once started and just waits while the profiler
+        is disabled, so that enabling and disabling around every call of
+        a decorated function stays cheap.
+        """
+        cdef PY_LONG_LONG last, now
+        while True:
+            self.sampling.wait()
+            last = self.timer_func()
+            while True:
+                time.sleep(self.interval)
+                if not self.sampling.is_set():
+                    break
+                now = self.timer_func()
+                self._take_sample(now - last)
+                last = now
+
+    cdef _take_sample(self, PY_LONG_LONG elapsed):
+        """ Charge `elapsed` timer units to the current line of each registered
+        function on the stacks of the sampled threads.
+        """
+        cdef _ThreadState state
+        cdef PyObject *timings
+        cdef set seen
+        sampler_id = get_ident()
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == sampler_id:
+                continue
+            if self.all_threads:
+                state = self._thread_state(thread_id)
+            elif thread_id == self.sampled_thread_id:
+                state = self.state
+            else:
+                continue
+            # Recursive calls only count once per sample, and only the innermost
+            # profiled function gets the self time.
+            seen = set()
+            self_elapsed = elapsed
+            while frame is not None:
+                code = frame.f_code
+                if not code_is_tagged(<PyObject *>code):
+                    frame = frame.f_back
+                    continue
+                timings = PyDict_GetItem(state.code_map, code)
+                if timings != NULL:
+                    key = (code, frame.f_lineno)
+                    if key not in seen:
+                        seen.add(key)
+                        (<CodeTimings>timings).hit(frame.f_lineno, elapsed,
+                            self_elapsed)
+                        self_elapsed = 0
+                frame = frame.f_back
+
+    def reset_stats(self):
+        """ Clear the timings recorded so far, keeping the registered functions.
+        """
+        cdef _ThreadState state
+        for state in [self.state] + self.all_thread_states():
+            for timings in state.code_map.values():
+                (<CodeTimings>timings).clear()
+            for code_map in state.task_code_maps.values():
+                for timings in code_map.values():
+                    (<CodeTimings>timings).clear()
+            for timings in state.instruction_map.values():
+                (<InstructionTimings>timings).clear()
 
-    def get_stats(self):
+    def all_thread_states(self):
+        """ Return the states of all threads traced in `all_threads` mode,
+        including threads that have finished.
+        """
+        return list(self.thread_states.values()) + self.finished_thread_states
+
+    def _thread_state(self, thread_id, new_thread=False):
+        """ Get or create the state for the thread with the given id.
+
+        Thread ids can be reused once a thread has finished, so the state left
+        behind by an earlier thread is retired when a new thread starts, or
+        when a thread asking for its own state turns out not to be the thread
+        that created it.
+        """
+        cdef _ThreadState state = self.thread_states.get(thread_id)
+        cdef unsigned long long tstate_id = 0
+        if thread_id == get_ident():
+            tstate_id = current_thread_state_id()
+        if state is not None and (new_thread or tstate_id != 0 and
+                state.tstate_id != 0 and state.tstate_id != tstate_id):
+            self.finished_thread_states.append(state)
+            state = None
+        if state is None:
+            thread = threading._active.get(thread_id)
+            state = _ThreadState(self, thread_id,
+                thread.name if thread is not None else None)
+            self.thread_states[thread_id] = state
+        if tstate_id != 0:
+            state.tstate_id = tstate_id
+        return state
+
+    def _trace_new_thread(self, frame, event, arg):
+        """ Install the C tracer from a thread started while profiling.
+
+        This is installed with `threading.settrace()`, so it is called once in
+        each new thread before its target runs.
+        """
+        PyEval_SetTrace(python_trace_callback,
+            self._thread_state(get_ident(), new_thread=True))
+        return None
+
+    def get_stats(self, reset=False):
         """ Return a LineStats object containing the timings.
+
+        With `reset`, the counters are also cleared. The tracer keeps running,
+        and no line event can be recorded between taking the timings and
+        clearing them, so consecutive snapshots do not overlap or lose hits.
         """
+        cdef CodeTimings total
+        cdef InstructionTimings instruction_total
+        cdef _ThreadState state
         stats = {}
+        threads = None
+        # Read the sources first: reading files may release the GIL, which
+        # must not happen between taking and resetting the timings.
+        sources = {}
         for code in self.code_map:
-            entries = self.code_map[code].values()
-            key = label(code)
-            stats[key] = [e.astuple() for e in entries]
-            stats[key].sort()
-        return LineStats(stats, self.timer_unit)
+            source = function_source(code)
+            if source is not None:
+                sources[label(code)] = source
+        infos = dict((code, instruction_info(code))
+            for code in self.instruction_lines)
+        self_timings = {} if self.exclusive else None
+        histograms = {} if self.histogram else None
+        memory = {} if self.memory else None
+        for code, timings in self.code_map.items():
+            total = CodeTimings(code, self.histogram, self.memory)
+            total.add(timings)
+            for state in self.all_thread_states():
+                total.add(state.code_map[code])
+            stats[label(code)] = total.astuples()
+            if self.exclusive:
+                self_timings[label(code)] = total.self_astuples()
+            if self.histogram:
+                histograms[label(code)] = total.histograms()
+            if self.memory:
+                memory[label(code)] = total.memory_astuples()
+        if self.all_threads:
+            threads = {}
+            for state in self.all_thread_states():
+                key = (state.thread_id, state.thread_name)
+                if key in threads:
+                    # Merge a reused thread id running under the same name.
+                    threads[key] = merge_timings([threads[key], dict(
+                        (label(code), timings.astuples())
+                        for code, timings in state.code_map.items())])
+                else:
+                    threads[key] = dict(
+                        (label(code), timings.astuples())
+                        for code, timings in state.code_map.items())
+        tasks = None
+        if self.per_task:
+            tasks = {}
+            for state in [self.state] + self.all_thread_states():
+                for name, code_map in state.task_code_maps.items():
+                    task_stats = dict((label(code), timings.astuples())
+                        for code, timings in code_map.items())
+                    if name in tasks:
+                        task_stats = merge_timings([tasks[name], task_stats])
+                    tasks[name] = task_stats
+        instructions = None
+        if self.instruction_lines:
+            instructions = {}
+            for code, info in infos.items():
+                instruction_total = InstructionTimings(code)
+                for state in [self.state] + self.all_thread_states():
+                    instruction_total.add(state.instruction_map[code])
+                instructions[label(code)] = [info[offset][:1] + (offset,) +
+                    info[offset][1:] + (nhits, time) for offset, nhits, time
+                    in instruction_total.astuples() if offset in info]
+        if reset:
+            self.reset_stats()
+        return LineStats(stats, self.timer_unit, self.overhead, threads,
+            sample_interval=self.interval if self.mode == 'sample' else None,
+            sources=sources, self_timings=self_timings, histograms=histograms,
+            tasks=tasks, memory=memory, instructions=instructions)
+
+    def calibrate(self, long number=100000, int repeat=5):
+        """ Measure the cost that the trace callback adds to each recorded hit
+        on this machine, store it in `overhead` and return it.
+
+        A loop of trivial lines is run `repeat` times both with and without
+        tracing. The difference between the best recorded line time and the
+        best untraced time, divided by the number of hits, is the part of each
+        measured interval that is spent in the tracer rather than in the line
+        itself. The loop is traced by a profiler with the same options as this
+        one, since exclusive times, histograms, memory tracking and the asyncio
+        mode all add to the cost. The profiler must not be enabled while
+        calibrating.
+        """
+        cdef PY_LONG_LONG start, best_untraced = -1, best_traced = -1
+        cdef long nhits = 0
+        if self.enable_count > 0:
+            raise RuntimeError('Cannot calibrate an enabled profiler.')
+        if self.mode != 'trace':
+            raise RuntimeError('Only tracing profilers can be calibrated.')
+        if number < 1 or repeat < 1:
+            raise ValueError('number and repeat must be at least 1.')
+        loop = _calibration_function()
+        for i in range(repeat):
+            start = self.timer_func()
+            loop(number)
+            start = self.timer_func() - start
+            if best_untraced < 0 or start < best_untraced:
+                best_untraced = start
+
+            prof = LineProfiler(loop, timer=self.timer,
+                all_threads=self.all_threads, engine=self.engine,
+                exclusive=self.exclusive, histogram=self.histogram,
+                asyncio=self.asyncio, per_task=self.per_task,
+                memory=self.memory)
+            prof.enable_by_count()
+            try:
+                loop(number)
+            finally:
+                prof.disable_by_count()
+            timings = prof.code_map[loop.__code__].astuples()
+            nhits = sum([t[1] for t in timings])
+            start = sum([t[2] for t in timings])
+            if best_traced < 0 or start < best_traced:
+                best_traced = start
+        if nhits == 0:
+            raise RuntimeError('No lines were recorded while calibrating. '
+                'Another tool may have replaced the tracer.')
+        self.overhead = max(0.0, float(best_traced - best_untraced) / nhits)
+        return self.overhead
+
+
+if sys.version_info[0] >= 3:
+    def _bind(func, instance, owner):
+        return MethodType(func, instance)
+else:
+    _bind = MethodType
+
+
+cdef class FunctionWrapper:
+    """ A callable that enables a LineProfiler around each call of `func`.
+
+    The enable count is kept in C, so a decorated function only costs one
+    extra call. Like a function, it binds as a method when it is a class
+    attribute, and it has a `__dict__` for `functools.update_wrapper()`.
+    """
+    cdef LineProfiler profiler
+    cdef readonly object func
+    cdef dict __dict__
+
+    def __cinit__(self, LineProfiler profiler, func):
+        self.profiler = profiler
+        self.func = func
+
+    def __call__(self, *args, **kwds):
+        self.profiler._enable_by_count()
+        try:
+            return self.func(*args, **kwds)
+        finally:
+            self.profiler._disable_by_count()
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        return _bind(self, instance, owner)
+
+    def __reduce__(self):
+        # Pickle by reference, the way the wrapped function would be.
+        return getattr(self, '__qualname__', getattr(self, '__name__', None))
+
+    def __repr__(self):
+        return '<profiled %r>' % (self.func,)
+
+
+cdef class GeneratorWrapper(FunctionWrapper):
+    """ A FunctionWrapper for generator functions. Calling it returns
+    a ProfiledGenerator.
+    """
+
+    def __call__(self, *args, **kwds):
+        return ProfiledGenerator(self.profiler, self.func(*args, **kwds))
+
+
+cdef class ProfiledGenerator:
+    """ A generator that enables a LineProfiler whenever it runs.
+
+    `send()`, `throw()` and `close()` are forwarded to the wrapped generator,
+    and other attributes, like `gi_frame`, are looked up on it.
+    """
+    cdef LineProfiler profiler
+    cdef readonly object generator
+
+    def __cinit__(self, LineProfiler profiler, generator):
+        self.profiler = profiler
+        self.generator = generator
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        self.profiler._enable_by_count()
+        try:
+            return next(self.generator)
+        finally:
+            self.profiler._disable_by_count()
+
+    def send(self, value):
+        self.profiler._enable_by_count()
+        try:
+            return self.generator.send(value)
+        finally:
+            self.profiler._disable_by_count()
+
+    def throw(self, *args):
+        self.profiler._enable_by_count()
+        try:
+            return self.generator.throw(*args)
+        finally:
+            self.profiler._disable_by_count()
+
+    def close(self):
+        self.profiler._enable_by_count()
+        try:
+            return self.generator.close()
+        finally:
+            self.profiler._disable_by_count()
+
+    def __getattr__(self, name):
+        return getattr(self.generator, name)
+
+
+cdef class CallSampler:
+    """ Choose the calls of a function to profile, for functions that are
+    called too often to profile every call.
+
+    One call in `every` is profiled and, if `rate` is given, at most `rate`
+    calls per second. With a `threshold` in seconds, the timings of a call are
+    only kept if the call takes at least that long. These are counted in the
+    timer units of `profiler`.
+    """
+    cdef LineProfiler profiler
+    cdef readonly long every
+    cdef readonly object rate
+    cdef readonly object threshold
+    cdef long countdown
+    cdef PY_LONG_LONG interval
+    cdef PY_LONG_LONG next_time
+    cdef PY_LONG_LONG threshold_units
+
+    def __cinit__(self, LineProfiler profiler, every=1, rate=None,
+        threshold=None):
+        if every < 1:
+            raise ValueError('every must be at least 1.')
+        if rate is not None and rate <= 0:
+            raise ValueError('rate must be positive.')
+        if threshold is not None:
+            if threshold < 0:
+                raise ValueError('threshold cannot be negative.')
+            if profiler.mode != 'trace':
+                raise ValueError('A threshold needs the trace mode.')
+        self.profiler = profiler
+        self.every = every
+        self.rate = rate
+        self.threshold = threshold
+        self.countdown = 0
+        self.interval = 0
+        if rate is not None:
+            self.interval = <PY_LONG_LONG>(1.0 / (rate * profiler.timer_unit))
+        self.next_time = 0
+        self.threshold_units = 0
+        if threshold is not None:
+            self.threshold_units = <PY_LONG_LONG>(threshold /
+                profiler.timer_unit)
+
+    cpdef bint sample(self):
+        """ Return whether to profile the call that is starting now.
+        """
+        cdef PY_LONG_LONG now
+        if self.countdown > 0:
+            self.countdown -= 1
+            return False
+        if self.interval:
+            now = self.profiler.timer_func()
+            if now < self.next_time:
+                return False
+            self.next_time = now + self.interval
+        self.countdown = self.every - 1
+        return True
+
+    def __repr__(self):
+        return '<CallSampler every=%d rate=%r threshold=%r>' % (self.every,
+            self.rate, self.threshold)
+
+
+cdef class SampledFunctionWrapper(FunctionWrapper):
+    """ A FunctionWrapper that only profiles the calls chosen by its
+    `sampler`, a CallSampler. The other calls go straight to `func`.
+    """
+    cdef public CallSampler sampler
+
+    def __call__(self, *args, **kwds):
+        if not self.sampler.sample():
+            return self.func(*args, **kwds)
+        if self.sampler.threshold is not None:
+            return self.profiler._call_captured(self.func, args, kwds,
+                self.sampler.threshold_units)
+        self.profiler._enable_by_count()
+        try:
+            return self.func(*args, **kwds)
+        finally:
+            self.profiler._disable_by_count()
+
+
+cdef class SampledGeneratorWrapper(FunctionWrapper):
+    """ A GeneratorWrapper that only profiles the generators chosen by its
+    `sampler`, a CallSampler.
+    """
+    cdef public CallSampler sampler
+
+    def __call__(self, *args, **kwds):
+        generator = self.func(*args, **kwds)
+        if not self.sampler.sample():
+            return generator
+        return ProfiledGenerator(self.profiler, generator)
+
+
+try:
+    from collections.abc import Generator
+except ImportError:
+    pass
+else:
+    Generator.register(ProfiledGenerator)
 
 
 cdef class LastTime:
     """ Record the last callback call for a given line.
+
+    For exclusive timing, `start` is the time of the first line event of the
+    function call, and `child_time` is the time spent in other profiled
+    functions since the last line event. When the timings are split by
+    asyncio task, `task_timings` also receives the hits. `resumed` is set
+    while the line is the one that a generator resumed in, which was already
+    counted as a hit before it was suspended.
+
+    For memory tracking, `memory` is the traced memory when the line started,
+    `peak` the highest traced memory seen during the line so far, and
+    `frame_peak` the highest seen during the whole call. When instructions are
+    timed, `instr_offset` is the offset of the running instruction, or -1, and
+    `instr_time` the time it started.
     """
     cdef int f_lineno
     cdef PY_LONG_LONG time
+    cdef PY_LONG_LONG start
+    cdef PY_LONG_LONG child_time
+    cdef CodeTimings task_timings
+    cdef bint resumed
+    cdef PY_LONG_LONG memory
+    cdef PY_LONG_LONG peak
+    cdef PY_LONG_LONG frame_peak
+    cdef int instr_offset
+    cdef PY_LONG_LONG instr_time
 
     def __cinit__(self, int f_lineno, PY_LONG_LONG time):
         self.f_lineno = f_lineno
         self.time = time
+        self.start = time
+        self.child_time = 0
+        self.instr_offset = -1
+
+
+cdef int record_event(_ThreadState state, CodeTimings timings, object key,
+    int lineno, bint resumed=False) except -1:
+    """ Charge the time since the last event to the line that was running in
+    `key`, then note that line `lineno` starts now. A negative `lineno` means
+    that the function is returning or being suspended instead. `resumed` means
+    that a generator is resuming in the middle of line `lineno`.
+
+    `key` is the code object, or the frame in the asyncio mode.
+
+    For memory tracking, the peak of the traced memory is reset at each line
+    event, so the peak seen since then is also passed on to the records of
+    the callers through `stack`, as they return.
+    """
+    cdef LineProfiler self = state.profiler
+    cdef dict last_time = state.last_time
+    cdef list stack = state.stack
+    cdef bint keep_stack = self.exclusive or self.memory
+    cdef LastTime old = None
+    cdef CodeTimings task_timings = None
+    cdef PY_LONG_LONG time = self.timer_func()
+    cdef PY_LONG_LONG dt, self_dt
+    cdef PY_LONG_LONG memory = 0, peak = 0
+    if state.capture is not None:
+        timings = state.captured(timings.code)
+    if self.memory:
+        memory, peak = tracemalloc.get_traced_memory()
+    if key in last_time:
+        old = last_time[key]
+        dt = time - old.time
+        self_dt = max(0, dt - old.child_time)
+        timings.hit(old.f_lineno, dt, self_dt, not old.resumed)
+        if old.task_timings is not None:
+            old.task_timings.hit(old.f_lineno, dt, self_dt, not old.resumed)
+        if old.instr_offset >= 0:
+            (<InstructionTimings>state.instruction_map[timings.code]).hit(
+                old.instr_offset, time - old.instr_time)
+            old.instr_offset = -1
+        if self.memory:
+            peak = max(peak, old.peak)
+            timings.add_memory(old.f_lineno, max(0, peak - old.memory),
+                memory - old.memory)
+            old.frame_peak = max(old.frame_peak, peak)
+    elif self.memory and lineno >= 0 and stack:
+        # The peak so far belongs to the line of the caller.
+        (<LastTime>stack[-1]).peak = max((<LastTime>stack[-1]).peak, peak)
+    if lineno >= 0:
+        if self.memory:
+            tracemalloc.reset_peak()
+        # Get the time again. This way, we don't record much time wasted in
+        # this function.
+        if old is None:
+            # A task switch always suspends the frame first, so the task
+            # stays the same for the life of the record.
+            if self.per_task:
+                task_timings = state.task_timings(timings.code)
+            old = LastTime(lineno, 0)
+            old.task_timings = task_timings
+            old.resumed = resumed
+            old.memory = old.peak = old.frame_peak = memory
+            last_time[key] = old
+            if keep_stack:
+                stack.append(old)
+            old.time = old.start = self.timer_func()
+        else:
+            old.f_lineno = lineno
+            old.child_time = 0
+            old.resumed = resumed
+            old.memory = old.peak = memory
+            old.time = self.timer_func()
+    elif old is not None:
+        # We are returning from a function, not executing a line. Delete the
+        # last_time record. It may have already been deleted if we are
+        # profiling a generator that is being pumped past its end.
+        del last_time[key]
+        if keep_stack:
+            if stack and stack[-1] is old:
+                stack.pop()
+            elif old in stack:
+                stack.remove(old)
+            if stack:
+                # Charge the whole call to the line of the innermost profiled
+                # function that is still running.
+                (<LastTime>stack[-1]).child_time += time - old.start
+                (<LastTime>stack[-1]).peak = max((<LastTime>stack[-1]).peak,
+                    old.frame_peak)
+    return 0
+
+
+cdef int record_instruction(_ThreadState state, object code, object key,
+    int offset) except -1:
+    """ Charge the time since the last instruction event to the instruction
+    that was running in `key`, if it is timed, then note that the instruction
+    at `offset` starts now. Return whether that instruction is timed.
+    """
+    cdef PY_LONG_LONG time = state.profiler.timer_func()
+    cdef PyObject *entry = PyDict_GetItem(state.instruction_map, code)
+    cdef PyObject *record
+    cdef InstructionTimings timings
+    cdef LastTime old
+    if entry == NULL:
+        return False
+    timings = <InstructionTimings>entry
+    record = PyDict_GetItem(state.last_time, key)
+    if record == NULL:
+        return timings.is_selected(offset)
+    old = <LastTime>record
+    if old.instr_offset >= 0:
+        timings.hit(old.instr_offset, time - old.instr_time)
+    if timings.is_selected(offset):
+        old.instr_offset = offset
+        old.instr_time = state.profiler.timer_func()
+        return True
+    old.instr_offset = -1
+    return False
+
+
+cdef int trace_first_event(object self_, PyFrameObject *py_frame, int what,
+                           PyObject *arg):
+    """ The trace function installed on every thread by `all_threads` profilers
+    on Python 3.12+, where all threads have to share one trace argument.
+
+    The first event of each thread swaps in python_trace_callback with the
+    state of that thread, so later events go straight to it.
+    """
+    cdef LineProfiler profiler = <LineProfiler>self_
+    state = profiler._thread_state(get_ident())
+    PyEval_SetTrace(python_trace_callback, state)
+    return python_trace_callback(state, py_frame, what, arg)
 
 
 cdef int python_trace_callback(object self_, PyFrameObject *py_frame, int what,
     PyObject *arg):
     """ The PyEval_SetTrace() callback.
+
+    `self_` is the _ThreadState of the traced thread.
     """
-    cdef LineProfiler self
-    cdef object code, key
-    cdef dict line_entries, last_time
-    cdef LineTiming entry
-    cdef LastTime old
-    cdef PY_LONG_LONG time
+    cdef _ThreadState state
+    cdef PyObject *code = frame_code(py_frame)
+    cdef PyObject *timings
+
+    if what == PyTrace_CALL:
+        # Frames of code that no profiler has registered do not need any line
+        # events, so switch them off. disable() switches them on again for the
+        # frames that are still running, for debuggers attached later on.
+        if not code_is_tagged(code):
+            if disable_line_events(py_frame, code):
+                (<_ThreadState>self_).lines_disabled = True
+            return 0
+        state = <_ThreadState>self_
+        # Opcode events are only turned on for the frames of code with timed
+        # instructions.
+        if state.instruction_map and PyDict_GetItem(state.instruction_map,
+                <object>code) != NULL:
+            (<object>py_frame).f_trace_opcodes = True
+        # A coroutine resuming in the middle of a line after an await gets no
+        # line event, so start timing that line here.
+        if state.profiler.asyncio:
+            timings = PyDict_GetItem(state.code_map, <object>code)
+            if timings != NULL and _frame_is_resuming(<object>py_frame):
+                record_event(state, <CodeTimings>timings, <object>py_frame,
+                    frame_lineno(py_frame), True)
+        return 0
 
-    self = <LineProfiler>self_
-    last_time = self.last_time
+    if what == PyTrace_OPCODE:
+        state = <_ThreadState>self_
+        record_instruction(state, <object>code,
+            <object>py_frame if state.profiler.asyncio else <object>code,
+            frame_lasti(py_frame))
+        return 0
 
     if what == PyTrace_LINE or what == PyTrace_RETURN:
-        code = <object>py_frame.f_code
-        if code in self.code_map:
-            time = hpTimer()
-            if code in last_time:
-                old = last_time[code]
-                line_entries = self.code_map[code]
-                key = old.f_lineno
-                if key not in line_entries:
-                    entry = LineTiming(code, old.f_lineno)
-                    line_entries[key] = entry
-                else:
-                    entry = line_entries[key]
-                entry.hit(time - old.time)
-            if what == PyTrace_LINE:
-                # Get the time again. This way, we don't record much time wasted
-                # in this function.
-                last_time[code] = LastTime(py_frame.f_lineno, hpTimer())
-            else:
-                # We are returning from a function, not executing a line. Delete
-                # the last_time record. It may have already been deleted if we
-                # are profiling a generator that is being pumped past its end.
-                if code in last_time:
-                    del last_time[code]
+        if not code_is_tagged(code):
+            return 0
+        state = <_ThreadState>self_
+        timings = PyDict_GetItem(state.code_map, <object>code)
+        if timings != NULL:
+            record_event(state, <CodeTimings>timings,
+                <object>py_frame if state.profiler.asyncio else <object>code,
+                frame_lineno(py_frame) if what == PyTrace_LINE else -1)
 
     return 0
 
 
+# The sys.monitoring (PEP 669) engine.
+#
+# All LineProfilers share one tool id. A code object gets LINE, PY_RETURN,
+# PY_YIELD and PY_RESUME events switched on locally when it is added to
+# a profiler, so no other code is slowed down. The events stay on while the
+# profiler lives, and enabling or disabling it only flips its `monitoring`
+# flag, which the callbacks check. Code with timed instructions also gets
+# INSTRUCTION events, which are disabled at each instruction that is not timed
+# the first time it runs. PY_UNWIND cannot be enabled per code object, so it is
+# enabled globally while the tool id is held; it only fires when an exception
+# leaves a frame.
+#
+# The tool id is one of those that Python does not reserve for debuggers,
+# coverage, profilers such as cProfile or the optimizer, and it is given back
+# once no code object is monitored any more.
+#
+# The callbacks find the profilers of a code object through the _MonitoredCode
+# in one of its extra slots, and the timings of each profiler by position in
+# the `code_timings` of its thread state, so no event hashes the code object.
+
+# The tool ids that sys.monitoring leaves free for other tools.
+_MONITORING_TOOL_IDS = (3, 4)
+
+cdef object _monitoring_tool_id = None
+cdef object _DISABLE = None
+# The number of code objects that some profiler monitors.
+cdef Py_ssize_t _monitored_count = 0
+
+
+def monitoring_available():
+    """ Return True if the sys.monitoring engine can be used.
+    """
+    return getattr(sys, 'monitoring', None) is not None
+
+
+cdef object _monitoring_tool():
+    """ Claim a sys.monitoring tool id and register the callbacks, unless that
+    is done already.
+    """
+    global _monitoring_tool_id, _DISABLE
+    if _monitoring_tool_id is not None:
+        return _monitoring_tool_id
+    monitoring = sys.monitoring
+    events = monitoring.events
+    for tool_id in _MONITORING_TOOL_IDS:
+        if monitoring.get_tool(tool_id) is None:
+            break
+    else:
+        raise RuntimeError('The sys.monitoring tool ids %s are in use by %s. '
+            "Use engine='settrace' instead." % (
+            ' and '.join(str(tool_id) for tool_id in _MONITORING_TOOL_IDS),
+            ' and '.join(repr(monitoring.get_tool(tool_id))
+                for tool_id in _MONITORING_TOOL_IDS)))
+    monitoring.use_tool_id(tool_id, 'line_profiler')
+    monitoring.register_callback(tool_id, events.LINE, _monitor_line)
+    monitoring.register_callback(tool_id, events.PY_RETURN, _monitor_return)
+    monitoring.register_callback(tool_id, events.PY_YIELD, _monitor_return)
+    monitoring.register_callback(tool_id, events.PY_UNWIND, _monitor_return)
+    monitoring.register_callback(tool_id, events.PY_RESUME, _monitor_resume)
+    monitoring.register_callback(tool_id, events.INSTRUCTION,
+        _monitor_instruction)
+    monitoring.set_events(tool_id, events.PY_UNWIND)
+    _DISABLE = monitoring.DISABLE
+    _monitoring_tool_id = tool_id
+    return tool_id
+
+
+cdef _release_monitoring_tool():
+    """ Give the sys.monitoring tool id back.
+    """
+    global _monitoring_tool_id
+    tool_id = _monitoring_tool_id
+    if tool_id is None:
+        return
+    monitoring = sys.monitoring
+    events = monitoring.events
+    monitoring.set_events(tool_id, 0)
+    for event in (events.LINE, events.PY_RETURN, events.PY_YIELD,
+            events.PY_UNWIND, events.PY_RESUME, events.INSTRUCTION):
+        monitoring.register_callback(tool_id, event, None)
+    monitoring.free_tool_id(tool_id)
+    _monitoring_tool_id = None
+
+
+cdef class _MonitorTarget:
+    """ A profiler monitoring a code object.
+
+    The profiler is held through a weak reference, so that monitoring does not
+    keep it alive. `index` is the position of the code object's timings in the
+    `code_timings` of the profiler's thread states.
+    """
+    cdef object ref
+    cdef Py_ssize_t index
+
+
+cdef class _MonitoredCode:
+    """ The profilers monitoring one code object, kept in its extra slot, which
+    also caches the tables derived from its bytecode for both engines. They go
+    away with the code object.
+    """
+    # Replaced rather than changed in place, so a callback can keep iterating
+    # over the list it started with.
+    cdef list targets
+    cdef bint instructions
+    cdef dict linenos
+    cdef frozenset resume_offsets
+
+    def __cinit__(self):
+        self.targets = []
+        self.instructions = False
+        self.linenos = None
+        self.resume_offsets = None
+
+
+cdef class _MonitorRelease:
+    """ The callback of the weak reference to a monitoring profiler, which stops
+    monitoring its code objects once it is gone.
+    """
+    cdef list codes
+
+    def __cinit__(self):
+        self.codes = []
+
+    def __call__(self, ref):
+        global _monitored_count
+        tool_id = _monitoring_tool_id
+        if tool_id is None:
+            return
+        for code in self.codes:
+            monitored = _monitored_code(code)
+            if not monitored.targets:
+                continue
+            monitored.targets = [target for target in monitored.targets
+                if (<_MonitorTarget>target).ref is not ref]
+            if not monitored.targets:
+                monitored.instructions = False
+                sys.monitoring.set_local_events(tool_id, code, 0)
+                _monitored_count -= 1
+        if _monitored_count == 0:
+            _release_monitoring_tool()
+
+
+cdef _MonitoredCode _monitored_code(object code):
+    """ Return the _MonitoredCode of `code`, adding one if needed.
+    """
+    cdef PyObject *entry = get_code_entry(code)
+    if entry != NULL:
+        return <_MonitoredCode>entry
+    monitored = _MonitoredCode()
+    set_code_entry(code, monitored)
+    return monitored
+
+
+cdef _set_code_events(object code, _MonitoredCode monitored):
+    """ Switch on the events that the profilers of `code` need.
+    """
+    events = sys.monitoring.events
+    code_events = (events.LINE | events.PY_RETURN | events.PY_YIELD |
+        events.PY_RESUME)
+    if monitored.instructions:
+        code_events |= events.INSTRUCTION
+    sys.monitoring.set_local_events(_monitoring_tool(), code, code_events)
+
+
+cdef _monitor_code(LineProfiler profiler, object code, Py_ssize_t index):
+    """ Deliver the events of `code` to `profiler` from now on. `index` is the
+    position of its timings in the profiler's `code_timings`.
+    """
+    global _monitored_count
+    cdef _MonitorTarget target
+    # Fail before changing anything if there is no tool id to be had.
+    _monitoring_tool()
+    monitored = _monitored_code(code)
+    if profiler.monitor_ref is None:
+        profiler.monitor_release = _MonitorRelease()
+        profiler.monitor_ref = weakref.ref(profiler, profiler.monitor_release)
+    target = _MonitorTarget()
+    target.ref = profiler.monitor_ref
+    target.index = index
+    if not monitored.targets:
+        _monitored_count += 1
+    monitored.targets = monitored.targets + [target]
+    profiler.monitor_release.codes.append(code)
+    _set_code_events(code, monitored)
+
+
+cdef _monitor_instructions(object code):
+    """ Also deliver the INSTRUCTION events of `code`, including those of the
+    instructions that were disabled because they were not timed before.
+    """
+    monitored = _monitored_code(code)
+    if monitored.instructions:
+        # Switching the events off and on again re-arms them for this tool and
+        # code object only, unlike sys.monitoring.restart_events().
+        monitored.instructions = False
+        _set_code_events(code, monitored)
+    monitored.instructions = True
+    _set_code_events(code, monitored)
+
+
+cdef inline _ThreadState _monitoring_state(LineProfiler profiler,
+    unsigned long long thread_id):
+    """ Return the state of the current thread for a monitoring profiler, or
+    None if the thread is not being profiled.
+
+    sys.monitoring events are process-wide, so unless the profiler is in
+    `all_threads` mode, only the thread that enabled it is profiled, just as
+    with the trace function. Threads are told apart by their thread state,
+    since a thread id can be reused by a later thread.
+    """
+    if thread_id != profiler.cached_thread_id:
+        if not profiler.all_threads:
+            return None
+        profiler.cached_state = profiler._thread_state(get_ident())
+        profiler.cached_thread_id = thread_id
+    return profiler.cached_state
+
+
+cdef inline _ThreadState _target_state(_MonitorTarget target,
+    unsigned long long thread_id):
+    """ Return the state that the profiler of `target` records into on the
+    current thread, or None if it is gone, disabled or not profiling this
+    thread.
+    """
+    cdef PyObject *profiler = PyWeakref_GetObject(target.ref)
+    if profiler == <PyObject *>None or not (<LineProfiler>profiler).monitoring:
+        return None
+    return _monitoring_state(<LineProfiler>profiler, thread_id)
+
+
+cdef inline object _monitoring_key(_ThreadState state, object code):
+    """ Return the key of the running frame of `code` in `last_time`.
+    """
+    if state.profiler.asyncio:
+        # The callbacks do not push a frame of their own.
+        return <object>PyEval_GetFrame()
+    return code
+
+
+def _monitor_line(code, int line_number):
+    """ The sys.monitoring LINE callback.
+    """
+    cdef PyObject *monitored = get_code_entry(code)
+    cdef _MonitorTarget target
+    cdef _ThreadState state
+    cdef unsigned long long thread_id
+    if monitored == NULL:
+        return
+    thread_id = current_thread_state_id()
+    for target in (<_MonitoredCode>monitored).targets:
+        state = _target_state(target, thread_id)
+        if state is not None:
+            record_event(state, <CodeTimings>state.code_timings[target.index],
+                _monitoring_key(state, code), line_number)
+
+
+def _monitor_return(code, int instruction_offset, arg):
+    """ The sys.monitoring PY_RETURN, PY_YIELD and PY_UNWIND callback.
+    """
+    cdef PyObject *monitored = get_code_entry(code)
+    cdef _MonitorTarget target
+    cdef _ThreadState state
+    cdef unsigned long long thread_id
+    if monitored == NULL:
+        return
+    thread_id = current_thread_state_id()
+    for target in (<_MonitoredCode>monitored).targets:
+        state = _target_state(target, thread_id)
+        if state is not None:
+            record_event(state, <CodeTimings>state.code_timings[target.index],
+                _monitoring_key(state, code), -1)
+
+
+def _monitor_resume(code, int instruction_offset):
+    """ The sys.monitoring PY_RESUME callback.
+
+    No line event is reported when a generator resumes in the middle of
+    a line, so start timing the rest of that line here, without counting
+    another hit.
+    """
+    cdef PyObject *monitored = get_code_entry(code)
+    cdef _MonitorTarget target
+    cdef _ThreadState state
+    cdef unsigned long long thread_id
+    if monitored == NULL:
+        return
+    linenos = (<_MonitoredCode>monitored).linenos
+    if linenos is None:
+        linenos = _line_table(code)
+    lineno = linenos.get(instruction_offset)
+    if lineno is None:
+        return
+    thread_id = current_thread_state_id()
+    for target in (<_MonitoredCode>monitored).targets:
+        state = _target_state(target, thread_id)
+        if state is not None:
+            record_event(state, <CodeTimings>state.code_timings[target.index],
+                _monitoring_key(state, code), lineno, True)
+
+
+def _monitor_instruction(code, int instruction_offset):
+    """ The sys.monitoring INSTRUCTION callback.
+    """
+    cdef PyObject *monitored = get_code_entry(code)
+    cdef _MonitorTarget target
+    cdef _ThreadState state
+    cdef unsigned long long thread_id
+    cdef bint timed = False
+    if monitored == NULL:
+        return
+    thread_id = current_thread_state_id()
+    for target in (<_MonitoredCode>monitored).targets:
+        state = _target_state(target, thread_id)
+        if state is None:
+            # The instruction may be timed later, or on another thread.
+            timed = True
+        elif record_instruction(state, code, _monitoring_key(state, code),
+                instruction_offset):
+            timed = True
+    if not timed:
+        return _DISABLE
+
+
+cdef dict _line_table(object code):
+    """ Return a dictionary from the byte offset of each instruction of `code`
+    to its line number.
+    """
+    cdef _MonitoredCode entry = None
+    linenos = None
+    if sys.version_info >= (3, 6):
+        # Cached in the code object's extra slot.
+        entry = _monitored_code(code)
+        linenos = entry.linenos
+    if linenos is None:
+        linenos = {}
+        if hasattr(code, 'co_lines'):
+            for start, end, lineno in code.co_lines():
+                for i in range(start, end, 2):
+                    linenos[i] = lineno
+        else:
+            starts = list(dis.findlinestarts(code))
+            ends = [start for start, lineno in starts[1:]] + [len(code.co_code)]
+            for (start, lineno), end in zip(starts, ends):
+                for i in range(start, end, 2):
+                    linenos[i] = lineno
+        if entry is not None:
+            entry.linenos = linenos
+    return linenos
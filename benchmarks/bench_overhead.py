@@ -0,0 +1,420 @@
+#!/usr/bin/env python
+""" Measure how much line_profiler slows down typical workloads.
+
+Each benchmark is timed without the profiler and with it, and the ratio of the
+two is the overhead. Benchmarks that only make sense with the profiler, like
+`get_stats()` and `show_text()`, are timed on their own. Build the extension in
+place first, then run from the repository root::
+
+    python setup.py build_ext --inplace
+    python benchmarks/bench_overhead.py -o baseline.json
+    ... change something and rebuild ...
+    python benchmarks/bench_overhead.py --compare baseline.json
+
+The results file holds the environment and, for each benchmark, the best
+baseline and profiled times in seconds and their ratio. `--compare` shows the
+change of each ratio against an earlier results file, and exits with status 1
+if any ratio got worse by more than `--threshold` percent. The ratios depend on
+the machine, so no results file is kept in the repository; record the baseline
+on the same machine from the unchanged tree, for example with `git stash`.
+"""
+
+from __future__ import print_function
+
+import gc
+import json
+import optparse
+import os
+import platform
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from line_profiler import LineProfiler, LineStats, show_text
+
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+RESULTS_VERSION = 1
+
+
+# ---- Workloads --------------------------------------------------------------
+
+def arithmetic(n):
+    total = 0
+    for i in range(n):
+        total += i * i % 7
+    return total
+
+
+def recurse(depth):
+    if depth == 0:
+        return 0
+    return recurse(depth - 1) + 1
+
+
+def countdown(n):
+    while n > 0:
+        yield n
+        n -= 1
+
+
+def consume_generator(n):
+    total = 0
+    for value in countdown(n):
+        total += value
+    return total
+
+
+def unregistered_helper(n):
+    total = 0
+    for i in range(n):
+        total += i
+    return total
+
+
+def call_unregistered(n, calls):
+    total = 0
+    for i in range(calls):
+        total += unregistered_helper(n)
+    return total
+
+
+def tiny(x):
+    return x + 1
+
+
+def make_functions(count):
+    """ Make `count` distinct functions with their own code objects.
+    """
+    functions = []
+    for i in range(count):
+        ns = {}
+        exec('def func_%d(x):\n    y = x + %d\n    return y\n' % (i, i), ns)
+        functions.append(ns['func_%d' % i])
+    return functions
+
+
+COROUTINE_SOURCE = """
+async def leaf(n):
+    return n + 1
+
+async def chain(n):
+    total = 0
+    for i in range(n):
+        total += await leaf(i)
+    return total
+"""
+
+
+def drive(coroutine):
+    """ Run a coroutine that never suspends, without an event loop.
+    """
+    try:
+        coroutine.send(None)
+    except StopIteration as e:
+        return e.value
+    raise RuntimeError('The coroutine suspended.')
+
+
+# ---- Benchmarks --------------------------------------------------------------
+#
+# Each benchmark registers its functions with the profiler it is given and
+# returns the callable to time. The profiler is enabled around it, unless the
+# benchmark also returns a second callable that does its own profiling.
+
+def bench_loop(profiler):
+    profiler.add_function(arithmetic)
+    return lambda: arithmetic(200000)
+
+
+def bench_recursion(profiler):
+    profiler.add_function(recurse)
+    depth = min(800, sys.getrecursionlimit() - 100)
+    return lambda: [recurse(depth) for i in range(50)]
+
+
+def bench_generator(profiler):
+    profiler.add_function(countdown)
+    profiler.add_function(consume_generator)
+    return lambda: consume_generator(100000)
+
+
+def bench_coroutine(profiler):
+    if sys.version_info < (3, 5):
+        return None
+    ns = {}
+    exec(COROUTINE_SOURCE, ns)
+    chain = ns['chain']
+    profiler.add_function(ns['leaf'])
+    profiler.add_function(chain)
+    return lambda: drive(chain(50000))
+
+
+def bench_many_functions(profiler):
+    functions = make_functions(500)
+    for func in functions:
+        profiler.add_function(func)
+
+    def run():
+        for i in range(100):
+            for func in functions:
+                func(i)
+    return run
+
+
+def bench_unregistered_frames(profiler):
+    profiler.add_function(call_unregistered)
+    return lambda: call_unregistered(100, 2000)
+
+
+def bench_threads(profiler):
+    profiler.add_function(arithmetic)
+
+    def run():
+        threads = [threading.Thread(target=arithmetic, args=(50000,))
+            for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    return run
+
+
+def bench_decorator(profiler):
+    wrapped = profiler(tiny)
+    calls = range(200000)
+
+    def run():
+        for i in calls:
+            tiny(i)
+
+    def profiled():
+        for i in calls:
+            wrapped(i)
+    return run, profiled
+
+
+# (name, benchmark, extra LineProfiler arguments)
+BENCHMARKS = [
+    ('loop', bench_loop, {}),
+    ('recursion', bench_recursion, {}),
+    ('generator', bench_generator, {}),
+    ('coroutine', bench_coroutine, {}),
+    ('many_functions', bench_many_functions, {}),
+    ('unregistered_frames', bench_unregistered_frames, {}),
+    ('threads', bench_threads, {'all_threads': True}),
+    ('decorator', bench_decorator, {}),
+]
+
+
+# ---- Runner ------------------------------------------------------------------
+
+clock = getattr(time, 'perf_counter', time.time)
+
+
+def best_time(func, repeat):
+    best = None
+    for i in range(repeat):
+        start = clock()
+        func()
+        elapsed = clock() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def run_benchmark(make, options, repeat):
+    """ Time one benchmark with and without a profiler made with `options`.
+    Return its result dictionary, or None if it does not apply to this Python.
+    """
+    # The sys.monitoring engine switches on the events of a function as soon as
+    # it is added, until the profiler is collected, so the baseline runs
+    # functions that only a 'settrace' profiler has seen.
+    gc.collect()
+    run = make(LineProfiler(engine='settrace'))
+    if run is None:
+        return None
+    if isinstance(run, tuple):
+        run = run[0]
+    baseline = best_time(run, repeat)
+    profiler = LineProfiler(**options)
+    run = make(profiler)
+    if isinstance(run, tuple):
+        run, profiled = run
+    else:
+        def profiled():
+            with profiler:
+                run()
+    profiled_time = best_time(profiled, repeat)
+    return {
+        'baseline': baseline,
+        'profiled': profiled_time,
+        'ratio': profiled_time / baseline,
+    }
+
+
+def run_get_stats(options, repeat):
+    functions = make_functions(2000)
+    profiler = LineProfiler(*functions, **options)
+    with profiler:
+        for func in functions:
+            func(1)
+    return {'profiled': best_time(profiler.get_stats, repeat)}
+
+
+def run_show_text(repeat):
+    timings = {}
+    for i in range(500):
+        timings[('bench_%d.py' % i, 1, 'func_%d' % i)] = [
+            (lineno, lineno, lineno * 1000) for lineno in range(2, 52)]
+    lstats = LineStats(timings, 1e-9)
+
+    def render():
+        show_text(lstats.timings, lstats.unit, stream=StringIO())
+    return {'profiled': best_time(render, repeat)}
+
+
+def environment(options):
+    import _line_profiler
+    profiler = LineProfiler(**options)
+    return {
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+        'machine': platform.machine(),
+        'engine': profiler.engine,
+        'mode': profiler.mode,
+        'timer': profiler.timer,
+        'extension': os.path.basename(_line_profiler.__file__),
+    }
+
+
+def compare(results, baseline, threshold, stream=sys.stdout):
+    """ Show the change of each overhead ratio against `baseline` and return
+    the names of the benchmarks whose ratio grew by more than `threshold`
+    percent.
+    """
+    regressions = []
+    stream.write('%-22s %10s %10s %9s\n' % ('Benchmark', 'Base', 'New',
+        'Change'))
+    for name, result in sorted(results['benchmarks'].items()):
+        base = baseline['benchmarks'].get(name)
+        if base is None:
+            continue
+        key = 'ratio' if 'ratio' in result and 'ratio' in base else 'profiled'
+        change = 100.0 * (result[key] - base[key]) / base[key]
+        flag = ''
+        if change > threshold:
+            flag = '  <-- regression'
+            regressions.append(name)
+        stream.write('%-22s %10.3g %10.3g %+8.1f%%%s\n' % (name, base[key],
+            result[key], change, flag))
+    for key in ['python', 'implementation', 'machine', 'engine', 'mode',
+            'timer']:
+        base = baseline.get('environment', {}).get(key)
+        new = results['environment'][key]
+        if base != new:
+            stream.write('Note: the baseline has %s %s, not %s.\n' % (key,
+                base, new))
+    return regressions
+
+
+def load_results(filename):
+    """ Load a results file written with `-o`.
+    """
+    with open(filename) as f:
+        results = json.load(f)
+    if results.get('version') != RESULTS_VERSION:
+        raise ValueError('Unsupported results version %r.' % (
+            results.get('version'),))
+    return results
+
+
+def main(args=None):
+    usage = "usage: %prog [options] [benchmark ...]"
+    parser = optparse.OptionParser(usage=usage)
+    parser.add_option('-r', '--repeat', type='int', default=5,
+        help="Time each benchmark this many times and keep the best. "
+            "[default: %default]")
+    parser.add_option('-o', '--output', default=None,
+        help="Write the results to this JSON file.")
+    parser.add_option('--compare', default=None, metavar='RESULTS',
+        help="Compare the results with an earlier JSON results file.")
+    parser.add_option('--threshold', type='float', default=10.0,
+        help="With --compare, the growth of an overhead ratio, in percent, "
+            "that counts as a regression. [default: %default]")
+    parser.add_option('--engine', default=None,
+        choices=['monitoring', 'settrace'],
+        help="The LineProfiler engine to benchmark.")
+    parser.add_option('--sample', type='float', default=None,
+        metavar='INTERVAL',
+        help="Benchmark the sampling mode with this interval instead.")
+    parser.add_option('-l', '--list', action='store_true',
+        help="List the benchmarks and exit.")
+    options, names = parser.parse_args(args)
+
+    all_names = [entry[0] for entry in BENCHMARKS] + ['get_stats',
+        'show_text']
+    if options.list:
+        print('\n'.join(all_names))
+        return 0
+    for name in names:
+        if name not in all_names:
+            parser.error('Unknown benchmark %r.' % (name,))
+    names = names or all_names
+    baseline = None
+    if options.compare is not None:
+        # Fail before spending minutes on the benchmarks.
+        try:
+            baseline = load_results(options.compare)
+        except (IOError, ValueError) as e:
+            parser.error('Cannot read %s: %s' % (options.compare, e))
+
+    profiler_options = {}
+    if options.sample is not None:
+        profiler_options.update(mode='sample', interval=options.sample)
+    elif options.engine is not None:
+        profiler_options['engine'] = options.engine
+
+    results = {
+        'version': RESULTS_VERSION,
+        'environment': environment(profiler_options),
+        'benchmarks': {},
+    }
+    print('%-22s %12s %12s %8s' % ('Benchmark', 'Baseline (s)', 'Profiled (s)',
+        'Ratio'))
+    for name, make, extra_options in BENCHMARKS:
+        if name not in names:
+            continue
+        bench_options = dict(profiler_options)
+        bench_options.update(extra_options)
+        result = run_benchmark(make, bench_options, options.repeat)
+        if result is None:
+            continue
+        results['benchmarks'][name] = result
+        print('%-22s %12.4f %12.4f %7.2fx' % (name, result['baseline'],
+            result['profiled'], result['ratio']))
+    for name, run in [('get_stats',
+            lambda: run_get_stats(profiler_options, options.repeat)),
+            ('show_text', lambda: run_show_text(options.repeat))]:
+        if name in names:
+            result = results['benchmarks'][name] = run()
+            print('%-22s %12s %12.4f %8s' % (name, '', result['profiled'], ''))
+
+    if options.output is not None:
+        with open(options.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if baseline is not None:
+        print()
+        if compare(results, baseline, options.threshold):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
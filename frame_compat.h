@@ -0,0 +1,58 @@
+/* Access to frame fields that became private in Python 3.11. */
+
+#ifndef LINE_PROFILER_FRAME_COMPAT_H
+#define LINE_PROFILER_FRAME_COMPAT_H
+
+#include "Python.h"
+#include "frameobject.h"
+
+/* Return a borrowed reference to the frame's code object. */
+static PyObject *
+frame_code(PyFrameObject *frame)
+{
+#if PY_VERSION_HEX >= 0x030B0000
+    /* The frame holds its own reference. */
+    PyCodeObject *code = PyFrame_GetCode(frame);
+    Py_DECREF(code);
+    return (PyObject *)code;
+#else
+    return (PyObject *)frame->f_code;
+#endif
+}
+
+/* Return the current line number of the frame. The trace machinery keeps
+ * f_lineno up to date, which is cheaper than PyFrame_GetLineNumber() before
+ * Python 3.11.
+ */
+static int
+frame_lineno(PyFrameObject *frame)
+{
+#if PY_VERSION_HEX >= 0x030B0000
+    return PyFrame_GetLineNumber(frame);
+#else
+    return frame->f_lineno;
+#endif
+}
+
+/* Return the byte offset of the frame's current instruction. */
+static int
+frame_lasti(PyFrameObject *frame)
+{
+#if PY_VERSION_HEX >= 0x030B0000
+    return PyFrame_GetLasti(frame);
+#elif PY_VERSION_HEX >= 0x030A0000
+    /* Counted in code units of two bytes. */
+    return frame->f_lasti * 2;
+#else
+    return frame->f_lasti;
+#endif
+}
+
+/* Opcode events only exist since Python 3.7. They are never delivered before,
+ * since f_trace_opcodes cannot be set.
+ */
+#ifndef PyTrace_OPCODE
+#define PyTrace_OPCODE 7
+#endif
+
+#endif
@@ -0,0 +1,41 @@
+/* Log2 bucketing for the per-line latency histograms. */
+
+#ifndef LINE_PROFILER_HISTOGRAM_H
+#define LINE_PROFILER_HISTOGRAM_H
+
+#include "Python.h"
+
+#if defined(_MSC_VER)
+#include <intrin.h>
+#endif
+
+/* Bucket i counts times t with 2**i <= t < 2**(i+1) timer units. Bucket 0 also
+ * counts times of 0 (and, defensively, negative times).
+ */
+#define HIST_NBUCKETS 64
+
+static int
+log2_bucket(PY_LONG_LONG t)
+{
+    unsigned PY_LONG_LONG u;
+    int bucket = 0;
+
+    if (t <= 1)
+        return 0;
+    u = (unsigned PY_LONG_LONG)t;
+#if defined(__GNUC__) || defined(__clang__)
+    bucket = 63 - __builtin_clzll(u);
+#elif defined(_MSC_VER) && defined(_M_X64)
+    {
+        unsigned long index;
+        _BitScanReverse64(&index, u);
+        bucket = (int)index;
+    }
+#else
+    while (u >>= 1)
+        bucket++;
+#endif
+    return bucket;
+}
+
+#endif
@@ -3,10 +3,16 @@
 """ Script to conveniently run profilers on code in a variety of circumstances.
 """
 
+import atexit
 import functools
 import optparse
 import os
+import re
+import signal
+import socket
 import sys
+import threading
+import uuid
 
 PY3 = sys.version_info[0] == 3
 
@@ -94,6 +100,9 @@ class ContextualProfile(Profile):
             self.enable_by_count()
             try:
                 item = next(g)
+            except StopIteration:
+                # Since PEP 479, the StopIteration cannot just propagate.
+                return
             finally:
                 self.disable_by_count()
             input = (yield item)
@@ -102,6 +111,8 @@ class ContextualProfile(Profile):
                 self.enable_by_count()
                 try:
                     item = g.send(input)
+                except StopIteration:
+                    return
                 finally:
                     self.disable_by_count()
                 input = (yield item)
@@ -146,6 +157,186 @@ def find_script(script_name):
     raise SystemExit(1)
 
 
+def _exit_on_sigterm(signum, frame):
+    """ Turn SIGTERM into a normal exit so that exit handlers run, unless the
+    process is already running them.
+    """
+    mp_util = sys.modules.get('multiprocessing.util')
+    if mp_util is not None and mp_util.is_exiting():
+        return
+    sys.exit(128 + signum)
+
+
+def _profile_worker(mp_util, dump):
+    """ Arrange for a multiprocessing child to call `dump` when it exits.
+
+    multiprocessing children leave through os._exit(), which skips atexit
+    handlers, but they run multiprocessing's own finalizers first.
+    Pool.terminate() stops its workers with SIGTERM, which would skip those
+    too, so SIGTERM exits normally instead, unless the program handles it
+    itself. A worker may already be exiting, and writing its profile, when
+    the signal arrives.
+    """
+    mp_util.Finalize(None, dump, exitpriority=0)
+    try:
+        if signal.getsignal(signal.SIGTERM) == signal.SIG_DFL:
+            signal.signal(signal.SIGTERM, _exit_on_sigterm)
+    except (AttributeError, ValueError):
+        pass
+
+
+def profile_forked_child(prof, prefix, snapshots=None):
+    """ Arrange for a forked child process to write its own line profile to
+    `<prefix>.<pid>` when it exits.
+
+    This is called in the child right after `os.fork()`, including the forks
+    made by multiprocessing. The counts inherited from the parent are cleared
+    so that the child's file only covers the child's own work.
+    """
+    prof.reset_stats()
+    pid = os.getpid()
+    filename = '%s.%d' % (prefix, pid)
+    if snapshots is not None:
+        snapshots.after_fork(filename)
+    dumped = []
+
+    def dump(*args):
+        # The hooks below are inherited by grandchildren, which write their
+        # own files.
+        if not dumped and os.getpid() == pid:
+            dumped.append(True)
+            if snapshots is not None:
+                snapshots.stop()
+            prof.dump_stats(filename)
+
+    atexit.register(dump)
+    # The finalizers inherited through the fork are cleared before
+    # multiprocessing's after-fork hooks run, so register the finalizer from
+    # one of those, which also only run in multiprocessing children.
+    mp_util = sys.modules.get('multiprocessing.util')
+    if mp_util is not None:
+        mp_util.register_after_fork(prof,
+            lambda prof: _profile_worker(mp_util, dump))
+
+
+class SnapshotWriter(object):
+    """ Write snapshots of a running LineProfiler's results, periodically or
+    when a signal arrives, without disabling the profiler.
+
+    Without `reset`, each snapshot holds everything recorded so far and
+    replaces `outfile`. With `reset`, the counters are cleared after each
+    snapshot, which goes to its own numbered file, `<outfile>.snapshot-<n>`,
+    covering the time since the previous one. Forked children write their
+    snapshots under their own profile's name instead.
+    """
+
+    def __init__(self, prof, outfile, reset=False):
+        self.prof = prof
+        self.outfile = outfile
+        self.reset = reset
+        self.count = 0
+        self.interval = None
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+
+    def write(self):
+        """ Write one snapshot and return its filename, or None if another
+        snapshot was being written at the same time.
+        """
+        # Do not block: this also runs from a signal handler, which may have
+        # interrupted a snapshot in the same thread.
+        if not self.lock.acquire(False):
+            return None
+        try:
+            import line_profiler
+            lstats = self.prof.get_stats(reset=self.reset)
+            filename = self.outfile
+            if self.reset:
+                self.count += 1
+                filename = '%s.snapshot-%d' % (filename, self.count)
+            line_profiler.write_stats(lstats, filename)
+            return filename
+        finally:
+            self.lock.release()
+
+    def start(self, interval):
+        """ Write a snapshot every `interval` seconds from a daemon thread.
+        """
+        self.interval = interval
+        thread = threading.Thread(target=self._run,
+            name='kernprof snapshots')
+        thread.daemon = True
+        thread.start()
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            self.write()
+
+    def stop(self):
+        """ Stop the periodic snapshots and wait for one in progress.
+        """
+        self.stopped.set()
+        with self.lock:
+            pass
+
+    def handle_signal(self, signum, frame):
+        self.write()
+
+    def after_fork(self, outfile):
+        """ Continue in a forked child process, writing to `outfile`.
+        """
+        self.outfile = outfile
+        self.count = 0
+        # The lock may have been held by a thread that does not exist in the
+        # child.
+        self.lock = threading.Lock()
+        if self.interval is not None and not self.stopped.is_set():
+            self.start(self.interval)
+
+
+def child_stats_prefix(outfile):
+    """ Return the prefix of the names of the child process profiles of this
+    run, `<outfile>.<parent pid>-<random hex>`, so that they cannot be mixed
+    up with the files of another run.
+    """
+    return '%s.%d-%s' % (outfile, os.getpid(), uuid.uuid4().hex[:8])
+
+
+def child_stats_files(prefix):
+    """ Return the (pid, filename) pairs of the child process profiles written
+    to `<prefix>.<pid>`.
+    """
+    directory = os.path.dirname(prefix) or os.curdir
+    pattern = re.compile(re.escape(os.path.basename(prefix)) + r'\.(\d+)$')
+    files = []
+    for name in sorted(os.listdir(directory)):
+        match = pattern.match(name)
+        if match is not None:
+            files.append((int(match.group(1)), os.path.join(directory, name)))
+    return files
+
+
+def merge_child_stats(outfile, prefix):
+    """ Merge the line profiles that child processes wrote to `<prefix>.<pid>`
+    into `outfile`, which holds the parent's profile, and remove them.
+
+    Returns the merged LineStats, or None if no child wrote a profile.
+    """
+    import line_profiler
+
+    files = child_stats_files(prefix)
+    if not files:
+        return None
+    lstats = line_profiler.merge_stats(
+        [line_profiler.load_stats(outfile)] +
+        [line_profiler.load_stats(filename) for pid, filename in files],
+        [os.getpid()] + [pid for pid, filename in files])
+    line_profiler.write_stats(lstats, outfile)
+    for pid, filename in files:
+        os.remove(filename)
+    return lstats
+
+
 def main(args=None):
     if args is None:
         args = sys.argv
@@ -166,6 +357,70 @@ def main(args=None):
         help="Code to execute before the code to profile")
     parser.add_option('-v', '--view', action='store_true',
         help="View the results of the profile in addition to saving it.")
+    parser.add_option('-t', '--timer', default=None,
+        help="Timer backend for --line-by-line: one of gettimeofday, "
+            "monotonic, monotonic_raw, qpc or tsc, depending on the platform. "
+            "Defaults to the platform's monotonic clock.")
+    parser.add_option('-a', '--all-threads', action='store_true',
+        help="With --line-by-line, trace all threads instead of only the "
+            "thread that enables the profiler.")
+    parser.add_option('--sample', type='float', default=None,
+        metavar='INTERVAL',
+        help="With --line-by-line, sample the current line of the profiled "
+            "functions every INTERVAL seconds instead of tracing every line. "
+            "This has much lower overhead but only estimates the times.")
+    parser.add_option('--engine', default=None,
+        choices=['monitoring', 'settrace'],
+        help="How --line-by-line gets line events: monitoring (sys.monitoring, "
+            "Python 3.12+) or settrace. Defaults to monitoring where it is "
+            "available.")
+    parser.add_option('-x', '--exclusive', action='store_true',
+        help="With --line-by-line, also show the self time of each line, "
+            "leaving out the time spent in other profiled functions.")
+    parser.add_option('--histogram', action='store_true',
+        help="With --line-by-line, also record a histogram of the times of "
+            "each line and show their median, 99th percentile and maximum.")
+    parser.add_option('--memory', action='store_true',
+        help="With --line-by-line, also record the bytes that each line "
+            "allocates and the bytes that it leaves allocated, using "
+            "tracemalloc. Requires Python 3.9+.")
+    parser.add_option('--asyncio', action='store_true',
+        help="With --line-by-line, time each running frame separately so that "
+            "concurrent coroutines do not get each other's time, and restart "
+            "the clock when a coroutine resumes after an await.")
+    parser.add_option('--per-task', action='store_true',
+        help="Like --asyncio, and also record and show the timings of each "
+            "asyncio task by task name.")
+    parser.add_option('--snapshot-interval', type='float', default=None,
+        metavar='SECONDS',
+        help="With --line-by-line, also write the results collected so far "
+            "every SECONDS seconds while the script runs.")
+    parser.add_option('--snapshot-signal', action='store_true',
+        help="With --line-by-line, write the results collected so far when "
+            "the process receives SIGUSR1.")
+    parser.add_option('--snapshot-reset', action='store_true',
+        help="Clear the counts after each snapshot and write each one to its "
+            "own numbered file, <outfile>.snapshot-<n>.")
+    parser.add_option('--export', action='append', default=[],
+        choices=['callgrind', 'speedscope', 'json', 'ndjson'], metavar='FORMAT',
+        help="With --line-by-line, also export the results for other tools "
+            "in FORMAT, one of callgrind, speedscope, json or ndjson, to "
+            "<outfile> with the format's suffix. Can be given more than once.")
+    parser.add_option('--control', default=None, metavar='SOCKET',
+        help="With --line-by-line, accept commands from "
+            "'python -m line_profiler control SOCKET ...' on this Unix-domain "
+            "socket, to enable and disable the profiler, add functions, reset "
+            "the counts or get the results while the script runs. Implies "
+            "--all-threads.")
+    parser.add_option('-p', '--prof-mod', action='append', default=[],
+        metavar='MODULE',
+        help="With --line-by-line, profile every function of MODULE and its "
+            "submodules, without @profile decorators, as they are imported. "
+            "The whole script is then profiled. Can be given more than once, "
+            "or with a comma-separated list of modules.")
+    parser.add_option('-c', '--calibrate', action='store_true',
+        help="Measure the tracer overhead per line before running the script "
+            "so that --line-by-line results can be corrected for it.")
 
     if not sys.argv[1:]:
         parser.print_usage()
@@ -173,6 +428,21 @@ def main(args=None):
 
     options, args = parser.parse_args()
 
+    if options.export and not options.line_by_line:
+        parser.error('--export requires --line-by-line.')
+    if options.prof_mod and not options.line_by_line:
+        parser.error('--prof-mod requires --line-by-line.')
+    if options.calibrate and options.sample is not None:
+        # Samples are not corrected for the tracer overhead.
+        parser.error('--calibrate cannot be used with --sample.')
+    if options.control is not None:
+        if not options.line_by_line:
+            parser.error('--control requires --line-by-line.')
+        if not hasattr(socket, 'AF_UNIX'):
+            parser.error('--control requires Unix-domain sockets.')
+        # The commands run in the server's own thread.
+        options.all_threads = True
+
     if not options.outfile:
         if options.line_by_line:
             extension = 'lprof'
@@ -196,7 +466,23 @@ def main(args=None):
 
     if options.line_by_line:
         import line_profiler
-        prof = line_profiler.LineProfiler()
+        if options.sample is not None:
+            prof = line_profiler.LineProfiler(timer=options.timer,
+                all_threads=bool(options.all_threads), mode='sample',
+                interval=options.sample, exclusive=bool(options.exclusive))
+        else:
+            prof = line_profiler.LineProfiler(timer=options.timer,
+                all_threads=bool(options.all_threads), engine=options.engine,
+                exclusive=bool(options.exclusive),
+                histogram=bool(options.histogram),
+                asyncio=bool(options.asyncio), per_task=bool(options.per_task),
+                memory=bool(options.memory))
+        if options.calibrate:
+            prof.calibrate()
+        for names in options.prof_mod:
+            for name in names.split(','):
+                if name.strip():
+                    prof.add_package(name.strip())
         options.builtin = True
     else:
         prof = ContextualProfile()
@@ -214,21 +500,84 @@ def main(args=None):
     # kernprof.py's.
     sys.path.insert(0, os.path.dirname(script_file))
 
+    # Long-running scripts can write their results while they run.
+    snapshots = None
+    if options.line_by_line and (options.snapshot_interval or
+            options.snapshot_signal):
+        snapshots = SnapshotWriter(prof, options.outfile,
+            reset=bool(options.snapshot_reset))
+        if options.snapshot_signal:
+            if not hasattr(signal, 'SIGUSR1'):
+                parser.error('--snapshot-signal requires SIGUSR1.')
+            signal.signal(signal.SIGUSR1, snapshots.handle_signal)
+        if options.snapshot_interval:
+            snapshots.start(options.snapshot_interval)
+
+    control = None
+    if options.control is not None:
+        control = line_profiler.ControlServer(prof, options.control)
+        control.start()
+
+    # Forked children, including multiprocessing workers, each write their
+    # own profile, which is merged into the parent's at the end.
+    parent_pid = os.getpid()
+    child_prefix = child_stats_prefix(options.outfile)
+    if options.line_by_line and hasattr(os, 'register_at_fork'):
+        os.register_at_fork(after_in_child=functools.partial(
+            profile_forked_child, prof, child_prefix, snapshots))
+
     try:
         try:
             execfile_ = execfile
             ns = locals()
-            if options.builtin:
+            if control is not None:
+                # Names given to `add` can refer to the script's own functions.
+                control.namespace = ns
+            if options.builtin and not options.prof_mod:
                 execfile(script_file, ns, ns)
             else:
                 prof.runctx('execfile_(%r, globals())' % (script_file,), ns, ns)
         except (KeyboardInterrupt, SystemExit):
             pass
     finally:
+        if os.getpid() != parent_pid:
+            # A forked child that ran off the end of the script. It writes its
+            # own profile at exit.
+            return
+        if snapshots is not None:
+            snapshots.stop()
+        if control is not None:
+            control.stop()
         prof.dump_stats(options.outfile)
+        lstats = None
+        if options.line_by_line:
+            lstats = merge_child_stats(options.outfile, child_prefix)
+            if lstats is not None:
+                print('Merged the profiles of %d child processes' % (
+                    len(lstats.processes) - 1))
         print('Wrote profile results to %s' % options.outfile)
+        if options.export:
+            exported = lstats if lstats is not None else prof.get_stats()
+            for format in options.export:
+                filename = (options.outfile +
+                    line_profiler.EXPORT_SUFFIXES[format])
+                line_profiler.export_stats(exported, filename, format=format)
+                print('Exported profile results to %s' % filename)
         if options.view:
-            prof.print_stats()
+            if lstats is not None:
+                line_profiler.show_text(lstats.timings, lstats.unit,
+                    overhead=lstats.overhead,
+                    sample_interval=lstats.sample_interval,
+                    self_timings=lstats.self_timings,
+                    histograms=lstats.histograms, memory=lstats.memory,
+                    instructions=lstats.instructions)
+                line_profiler.show_process_text(lstats.processes, lstats.unit,
+                    overhead=lstats.overhead)
+            elif options.line_by_line:
+                prof.print_stats(per_thread=bool(options.all_threads),
+                    per_task=bool(options.per_task))
+            else:
+                prof.print_stats()
 
 if __name__ == '__main__':
     sys.exit(main(sys.argv))
@@ -10,19 +10,37 @@ try:
     from cStringIO import StringIO
 except ImportError:
     from io import StringIO
+from io import BytesIO
 import functools
+import importlib
 import inspect
+import json
 import linecache
+import math
+import mmap
 import optparse
 import os
+import socket
+import stat
+import struct
 import sys
+import tempfile
+import threading
+import tokenize
+try:
+    from thread import get_ident
+except ImportError:
+    from threading import get_ident
 
 from IPython.core.magic import (Magics, magics_class, line_magic)
-from IPython.core.page import page
+from IPython.core.page import page, page_file
 from IPython.utils.ipstruct import Struct
 from IPython.core.error import UsageError
 
 from _line_profiler import LineProfiler as CLineProfiler
+from _line_profiler import (CallSampler, FunctionWrapper, GeneratorWrapper,
+    LineStats, SampledFunctionWrapper, SampledGeneratorWrapper,
+    available_timers, histogram_percentile, merge_timings)
 
 # Python 2/3 compatibility utils
 # ===========================================================
@@ -69,72 +87,105 @@ class LineProfiler(CLineProfiler):
     """ A profiler that records the execution times of individual lines.
     """
 
-    def __call__(self, func):
+    def __call__(self, func=None, every=1, rate=None, threshold=None):
         """ Decorate a function to start the profiler on function entry and stop
         it on function exit.
+
+        For functions called too often to profile every call, `every` only
+        profiles one call in `every`, and `rate` at most `rate` calls per
+        second. With a `threshold` in seconds, the timings of a call are only
+        kept if it takes at least that long, so that the slowest calls can be
+        studied. The threshold does not apply to generators and coroutines,
+        which other code runs between. Called without `func`, return
+        a decorator with these options::
+
+            @profile(every=100, threshold=0.05)
+            def handle(request):
+                ...
         """
+        if func is None:
+            return functools.partial(self, every=every, rate=rate,
+                threshold=threshold)
+        sampler = None
+        if every != 1 or rate is not None or threshold is not None:
+            sampler = CallSampler(self, every=every, rate=rate,
+                threshold=threshold)
+            if threshold is not None and (is_coroutine(func) or
+                    is_generator(func)):
+                raise ValueError('A threshold can only be used with plain '
+                    'functions.')
         self.add_function(func)
         if is_coroutine(func):
-            wrapper = self.wrap_coroutine(func)
+            wrapper = self.wrap_coroutine(func, sampler)
         elif is_generator(func):
-            wrapper = self.wrap_generator(func)
+            wrapper = self.wrap_generator(func, sampler)
         else:
-            wrapper = self.wrap_function(func)
+            wrapper = self.wrap_function(func, sampler)
         return wrapper
 
-    def wrap_generator(self, func):
-        """ Wrap a generator to profile it.
+    def wrap_generator(self, func, sampler=None):
+        """ Wrap a generator to profile it, or only the generators chosen by
+        `sampler`, a CallSampler.
         """
-        @functools.wraps(func)
-        def wrapper(*args, **kwds):
-            g = func(*args, **kwds)
-            # The first iterate will not be a .send()
-            self.enable_by_count()
-            try:
-                item = next(g)
-            finally:
-                self.disable_by_count()
-            input = (yield item)
-            # But any following one might be.
-            while True:
-                self.enable_by_count()
-                try:
-                    item = g.send(input)
-                finally:
-                    self.disable_by_count()
-                input = (yield item)
-        return wrapper
+        if sampler is None:
+            wrapper = GeneratorWrapper(self, func)
+        else:
+            wrapper = SampledGeneratorWrapper(self, func)
+            wrapper.sampler = sampler
+        return functools.update_wrapper(wrapper, func)
 
-    def wrap_function(self, func):
-        """ Wrap a function to profile it.
+    def wrap_function(self, func, sampler=None):
+        """ Wrap a function to profile it, or only the calls chosen by
+        `sampler`, a CallSampler.
         """
-        @functools.wraps(func)
-        def wrapper(*args, **kwds):
-            self.enable_by_count()
-            try:
-                result = func(*args, **kwds)
-            finally:
-                self.disable_by_count()
-            return result
-        return wrapper
+        if sampler is None:
+            wrapper = FunctionWrapper(self, func)
+        else:
+            wrapper = SampledFunctionWrapper(self, func)
+            wrapper.sampler = sampler
+        return functools.update_wrapper(wrapper, func)
 
     if PY35:
         import line_profiler_py35
         wrap_coroutine = line_profiler_py35.wrap_coroutine
 
     def dump_stats(self, filename):
-        """ Dump a representation of the data to a file as a pickled LineStats
-        object from `get_stats()`.
+        """ Dump the LineStats object from `get_stats()` to a file in the
+        binary .lprof format.
         """
-        lstats = self.get_stats()
-        with open(filename, 'wb') as f:
-            pickle.dump(lstats, f, pickle.HIGHEST_PROTOCOL)
+        write_stats(self.get_stats(), filename)
 
-    def print_stats(self, stream=None, output_unit=None, stripzeros=False):
+    def export(self, filename, format=None):
+        """ Export the LineStats object from `get_stats()` to a file in one of
+        the `EXPORT_FORMATS`, told from the file name by default.
+        """
+        export_stats(self.get_stats(), filename, format=format)
+
+    def print_stats(self, stream=None, output_unit=None, stripzeros=False,
+        per_thread=False, per_task=False, top=None, sort='time',
+        cumulative=None):
         """ Show the gathered statistics.
+
+        With `per_thread`, the timings of each thread traced in `all_threads`
+        mode are shown after the combined timings. With `per_task`, the same
+        goes for the timings of each asyncio task in `per_task` mode. `top`,
+        `sort` and `cumulative` show the hottest lines instead, as in
+        `show_text()`.
         """
         lstats = self.get_stats()
-        show_text(lstats.timings, lstats.unit, output_unit=output_unit, stream=stream, stripzeros=stripzeros)
+        show_text(lstats.timings, lstats.unit, output_unit=output_unit,
+            stream=stream, stripzeros=stripzeros, overhead=lstats.overhead,
+            sample_interval=lstats.sample_interval,
+            self_timings=lstats.self_timings, histograms=lstats.histograms,
+            memory=lstats.memory, top=top, sort=sort, cumulative=cumulative,
+            instructions=lstats.instructions)
+        if per_thread and lstats.threads:
+            show_thread_text(lstats.threads, lstats.unit,
+                output_unit=output_unit, stream=stream, stripzeros=stripzeros,
+                overhead=lstats.overhead)
+        if per_task and lstats.tasks:
+            show_task_text(lstats.tasks, lstats.unit, output_unit=output_unit,
+                stream=stream, stripzeros=stripzeros, overhead=lstats.overhead)
 
     def run(self, cmd):
         """ Profile a single executable statment in the main namespace.
@@ -180,20 +231,317 @@ class LineProfiler(CLineProfiler):
 
         return nfuncsadded
 
+    # The PackageImportHook of `add_package()`, once it is installed.
+    import_hook = None
+
+    def add_package(self, name, recursive=True):
+        """ Add all the functions of the module `name` and, if `recursive`,
+        of its submodules.
+
+        Unlike `add_module()`, this also adds the nested functions, lambdas
+        and comprehensions of the module's functions and classes, the
+        functions behind properties, classmethods and staticmethods, and the
+        functions wrapped with `functools.wraps()`, but not the functions that
+        the module imports from other modules. Modules that are already
+        imported are added now, and the others by an import hook when they are
+        first imported, so nothing is imported here. Return the number of code
+        objects added now.
+        """
+        if self.import_hook is None:
+            self.import_hook = PackageImportHook(self)
+            sys.meta_path.insert(0, self.import_hook)
+        self.import_hook.packages[name] = (recursive or
+            self.import_hook.packages.get(name, False))
+        ncodes = len(self.code_map)
+        for module_name, mod in list(sys.modules.items()):
+            if mod is not None and (module_name == name or recursive and
+                    module_name.startswith(name + '.')):
+                self.add_module_code(mod)
+        return len(self.code_map) - ncodes
+
+    def add_module_code(self, mod):
+        """ Add all of the code defined in a module, as in `add_package()`.
+        """
+        for code in _module_code(mod):
+            self.add_function(code)
+
+
+def _module_code(mod):
+    """ Return the code objects of the functions defined in the module `mod`.
+
+    These are its functions, the methods, properties, classmethods and
+    staticmethods of its classes, the functions that they wrap with
+    `functools.wraps()`, and all of the code nested in them. Functions and
+    classes that the module imports from other modules are left out.
+    """
+    codes = []
+    seen = set()
+    items = list(mod.__dict__.values())
+    while items:
+        item = items.pop()
+        if id(item) in seen:
+            continue
+        seen.add(id(item))
+        if isinstance(item, (classmethod, staticmethod)):
+            items.append(item.__func__)
+        elif isinstance(item, property):
+            items.extend([item.fget, item.fset, item.fdel])
+        elif inspect.isclass(item):
+            if getattr(item, '__module__', None) == mod.__name__:
+                items.extend(item.__dict__.values())
+        elif inspect.isfunction(item):
+            wrapped = getattr(item, '__wrapped__', None)
+            if wrapped is not None:
+                items.append(wrapped)
+            if item.__globals__ is mod.__dict__:
+                codes.append(item.__code__)
+    # Nested functions, classes, lambdas and comprehensions only have code
+    # objects, in the constants of the code that defines them.
+    for code in codes:
+        for const in code.co_consts:
+            if isinstance(const, type(code)) and id(const) not in seen:
+                seen.add(id(const))
+                codes.append(const)
+    return codes
+
+
+class PackageImportHook(object):
+    """ A `sys.meta_path` finder that adds the code of modules to a profiler
+    when they are imported.
+
+    `packages` maps the name of each package to whether its submodules are
+    added too. The modules are found by the other finders, and their loader is
+    wrapped to add their code once they have run.
+    """
+
+    def __init__(self, profiler):
+        self.profiler = profiler
+        self.packages = {}
+        self.loading = set()
+
+    def matches(self, fullname):
+        for name, recursive in self.packages.items():
+            if fullname == name or recursive and fullname.startswith(
+                    name + '.'):
+                return True
+        return False
+
+    def find_spec(self, fullname, path=None, target=None):
+        if not self.matches(fullname):
+            return None
+        for finder in sys.meta_path:
+            find_spec = getattr(finder, 'find_spec', None)
+            if finder is self or find_spec is None:
+                continue
+            spec = find_spec(fullname, path, target)
+            if spec is not None:
+                if hasattr(spec.loader, 'exec_module'):
+                    spec.loader = _ProfilingLoader(spec.loader, self.profiler)
+                return spec
+        return None
+
+    # The import protocol of Python 2.
+
+    def find_module(self, fullname, path=None):
+        if fullname in self.loading or not self.matches(fullname):
+            return None
+        return self
+
+    def load_module(self, fullname):
+        self.loading.add(fullname)
+        try:
+            mod = importlib.import_module(fullname)
+        finally:
+            self.loading.discard(fullname)
+        self.profiler.add_module_code(mod)
+        return mod
+
+
+class _ProfilingLoader(object):
+    """ Wrap a loader to add the code of the module to a profiler once it has
+    run.
+    """
+
+    def __init__(self, loader, profiler):
+        self.loader = loader
+        self.profiler = profiler
+
+    def create_module(self, spec):
+        create_module = getattr(self.loader, 'create_module', None)
+        if create_module is None:
+            return None
+        return create_module(spec)
+
+    def exec_module(self, module):
+        # The module only sees its own loader.
+        module.__loader__ = self.loader
+        if getattr(module, '__spec__', None) is not None:
+            module.__spec__.loader = self.loader
+        self.loader.exec_module(module)
+        self.profiler.add_module_code(module)
+
+    def __getattr__(self, name):
+        return getattr(self.loader, name)
+
+
+class SourceCache(object):
+    """ The source lines of profiled files, for showing many functions.
+
+    Each file is read once and kept until its modification time or size
+    changes, and the extent of each function in it is only found once. Files
+    are checked for changes at most once between calls of `refresh()`, which
+    `show_text()` calls once per report.
+    """
+
+    def __init__(self):
+        # filename -> ((mtime, size), lines, {start_lineno: block})
+        self.files = {}
+        self.checked = set()
+
+    def refresh(self):
+        """ Check the files for changes again on their next use.
+        """
+        self.checked.clear()
+
+    def function_lines(self, filename, start_lineno):
+        """ Return the source lines of the function that starts at
+        `start_lineno` in `filename`, or None if the file cannot be found.
+        """
+        entry = self._entry(filename)
+        if entry is None:
+            return None
+        version, lines, blocks = entry
+        block = blocks.get(start_lineno)
+        if block is None:
+            block = blocks[start_lineno] = _getblock(lines, start_lineno)
+        return block
+
+    def line(self, filename, lineno):
+        """ Return line `lineno` of `filename` without its line ending, or an
+        empty string if it cannot be found.
+        """
+        entry = self._entry(filename)
+        if entry is None or not 0 < lineno <= len(entry[1]):
+            return ''
+        return entry[1][lineno - 1].rstrip('\n').rstrip('\r')
+
+    def _entry(self, filename):
+        entry = self.files.get(filename)
+        if filename not in self.checked:
+            self.checked.add(filename)
+            if filename.startswith('<ipython-input-'):
+                # IPython keeps the cells in linecache, and they never change.
+                if entry is None:
+                    entry = (None, linecache.getlines(filename), {})
+            else:
+                try:
+                    st = os.stat(filename)
+                except OSError:
+                    entry = None
+                else:
+                    version = (st.st_mtime, st.st_size)
+                    if entry is None or entry[0] != version:
+                        linecache.checkcache(filename)
+                        entry = (version, linecache.getlines(filename), {})
+            if entry is None:
+                self.files.pop(filename, None)
+            else:
+                self.files[filename] = entry
+        return entry
+
+
+def _getblock(lines, start_lineno):
+    """ Return the block of `lines` that starts at `start_lineno`, like
+    `inspect.getblock()`, but only tokenizing as far as the block goes.
+    """
+    start = start_lineno - 1
+    window = 256
+    while True:
+        chunk = lines[start:start + window]
+        last = start + window >= len(lines)
+        try:
+            block = inspect.getblock(chunk)
+        except tokenize.TokenError:
+            # The window ends inside a bracket or a string.
+            if last:
+                raise
+            block = chunk
+        # A block that fills the whole window may go on after it.
+        if last or len(block) < len(chunk):
+            return block
+        window *= 8
+
+
+# Shared by all reports, so showing a profile again only rereads the files
+# that changed.
+_source_cache = SourceCache()
+
+
+def _format_bytes(nbytes):
+    """ Format a number of bytes, which may be negative, with a binary prefix.
+    """
+    size = float(nbytes)
+    for prefix in ('B', 'KiB', 'MiB', 'GiB'):
+        if abs(size) < 1024 or prefix == 'GiB':
+            break
+        size /= 1024
+    if prefix == 'B':
+        return '%d B' % nbytes
+    return '%.1f %s' % (size, prefix)
+
 
 def show_func(filename, start_lineno, func_name, timings, unit,
-    output_unit=None, stream=None, stripzeros=False):
+    output_unit=None, stream=None, stripzeros=False, overhead=None,
+    self_timings=None, histograms=None, memory=None, instructions=None,
+    source_cache=None):
     """ Show results for a single function.
+
+    If `overhead` is given, it is the tracer overhead per hit in timer units.
+    The overhead-corrected time is shown next to the raw time, and the Per Hit
+    and % Time columns are computed from the corrected times. If `self_timings`
+    is given, it holds the self time of each line in the same format as
+    `timings`, which is shown in a Self column. If `histograms` is given, it
+    holds the histogram of each line as in `LineStats.histograms`, from which
+    the median, 99th percentile and maximum time of a hit are shown. If
+    `memory` is given, it holds the bytes allocated and retained by each line
+    as in `LineStats.memory`, which are shown in Alloc and Net columns. If
+    `instructions` is given, it holds the timings of the bytecode instructions
+    of some lines as in `LineStats.instructions`, which are shown in rows of
+    their own below their line.
+
+    The source is read through `source_cache`, a SourceCache, if it is given.
+    Otherwise, the file is checked for changes first.
     """
     if stream is None:
         stream = sys.stdout
-
-    template = '%6s %9s %12s %8s %8s  %-s'
+    if source_cache is None:
+        source_cache = _source_cache
+        source_cache.checked.discard(filename)
+
+    columns = [('Hits', 9), ('Time', 12)]
+    if overhead:
+        columns.append(('Corrected', 12))
+    if self_timings is not None:
+        columns.append(('Self', 12))
+        self_times = dict((lineno, time)
+            for lineno, nhits, time in self_timings)
+    columns.extend([('Per Hit', 8), ('% Time', 8)])
+    if histograms is not None:
+        columns.extend([('p50', 8), ('p99', 8), ('Max', 8)])
+        line_histograms = dict((entry[0], entry[1:]) for entry in histograms)
+    if memory is not None:
+        columns.extend([('Alloc', 10), ('Net', 10)])
+        line_memory = dict((entry[0], entry[1:]) for entry in memory)
+    template = '%6s ' + ' '.join(['%%%ds' % width
+        for name, width in columns]) + '  %-s'
     d = {}
     total_time = 0.0
+    corrected_total_time = 0.0
     linenos = []
     for lineno, nhits, time in timings:
         total_time += time
+        if overhead:
+            corrected_total_time += max(0.0, time - nhits * overhead)
         linenos.append(lineno)
 
     if stripzeros and total_time == 0:
@@ -203,60 +551,321 @@ def show_func(filename, start_lineno, func_name, timings, unit,
         output_unit = unit
     scalar = unit / output_unit
 
-    stream.write("Total time: %g s\n" % (total_time * unit))
-    if os.path.exists(filename) or filename.startswith("<ipython-input-"):
-        stream.write("File: %s\n" % filename)
-        stream.write("Function: %s at line %s\n" % (func_name, start_lineno))
-        if os.path.exists(filename):
-            # Clear the cache to ensure that we get up-to-date results.
-            linecache.clearcache()
-        all_lines = linecache.getlines(filename)
-        sublines = inspect.getblock(all_lines[start_lineno-1:])
+    out = []
+    if overhead:
+        out.append("Total time: %g s (%g s corrected)" % (
+            total_time * unit, corrected_total_time * unit))
+    else:
+        out.append("Total time: %g s" % (total_time * unit))
+    sublines = source_cache.function_lines(filename, start_lineno)
+    if sublines is not None:
+        out.append("File: %s" % filename)
+        out.append("Function: %s at line %s" % (func_name, start_lineno))
     else:
-        stream.write("\n")
-        stream.write("Could not find file %s\n" % filename)
-        stream.write("Are you sure you are running this program from the same directory\n")
-        stream.write("that you ran the profiler from?\n")
-        stream.write("Continuing without the function's contents.\n")
+        out.append("")
+        out.append("Could not find file %s" % filename)
+        out.append("Are you sure you are running this program from the same directory")
+        out.append("that you ran the profiler from?")
+        out.append("Continuing without the function's contents.")
         # Fake empty lines so we can see the timings, if not the code.
         nlines = max(linenos) - min(min(linenos), start_lineno) + 1
         sublines = [''] * nlines
     for lineno, nhits, time in timings:
-        d[lineno] = (nhits,
-            '%5.1f' % (time * scalar),
-            '%5.1f' % (float(time) * scalar / nhits),
-            '%5.1f' % (100 * time / total_time) )
+        row = [nhits, '%5.1f' % (time * scalar)]
+        if overhead:
+            corrected = max(0.0, time - nhits * overhead)
+            row.append('%5.1f' % (corrected * scalar))
+        if self_timings is not None:
+            row.append('%5.1f' % (self_times.get(lineno, 0) * scalar))
+        if overhead:
+            percent = (100 * corrected / corrected_total_time
+                if corrected_total_time else 0.0)
+            row.extend(['%5.1f' % (corrected * scalar / nhits),
+                '%5.1f' % percent])
+        else:
+            row.extend(['%5.1f' % (float(time) * scalar / nhits),
+                '%5.1f' % (100 * time / total_time)])
+        if histograms is not None:
+            if lineno in line_histograms:
+                min_time, max_time, counts = line_histograms[lineno]
+                row.extend(['%5.1f' % (histogram_percentile(counts, fraction,
+                    min_time, max_time) * scalar) for fraction in (0.5, 0.99)])
+                row.append('%5.1f' % (max_time * scalar))
+            else:
+                row.extend(['', '', ''])
+        if memory is not None:
+            allocated, retained = line_memory.get(lineno, (0, 0))
+            row.extend([_format_bytes(allocated), _format_bytes(retained)])
+        d[lineno] = tuple(row)
     linenos = range(start_lineno, start_lineno + len(sublines))
-    empty = ('', '', '', '')
-    header = template % ('Line #', 'Hits', 'Time', 'Per Hit', '% Time',
-        'Line Contents')
-    stream.write("\n")
-    stream.write(header)
-    stream.write("\n")
-    stream.write('=' * len(header))
-    stream.write("\n")
+    empty = ('',) * len(columns)
+    header = template % (('Line #',) + tuple([name for name, width in columns])
+        + ('Line Contents',))
+    out.append("")
+    out.append(header)
+    out.append('=' * len(header))
+    names = [name for name, width in columns]
+    line_instructions = {}
+    for entry in instructions or ():
+        line_instructions.setdefault(entry[0], []).append(entry[1:])
     for lineno, line in zip(linenos, sublines):
-        nhits, time, per_hit, percent = d.get(lineno, empty)
-        txt = template % (lineno, nhits, time, per_hit, percent,
-                          line.rstrip('\n').rstrip('\r'))
-        stream.write(txt)
-        stream.write("\n")
-    stream.write("\n")
-
-def show_text(stats, unit, output_unit=None, stream=None, stripzeros=False):
+        line = line.rstrip('\n').rstrip('\r')
+        out.append(template % ((lineno,) + d.get(lineno, empty) + (line,)))
+        for (offset, opname, col_offset, end_col_offset, nhits,
+                time) in line_instructions.get(lineno, ()):
+            # Only the Hits, Time, Per Hit and % Time columns apply.
+            row = ['', '%5.1f' % (time * scalar)] + [''] * (len(columns) - 2)
+            row[0] = nhits
+            row[names.index('Per Hit')] = '%5.1f' % (
+                float(time) * scalar / nhits)
+            row[names.index('% Time')] = '%5.1f' % (
+                100 * time / total_time if total_time else 0.0)
+            contents = '%s@%d %s' % (line[:len(line) - len(line.lstrip())],
+                offset, opname)
+            if col_offset is not None:
+                contents += '  %s' % line[col_offset:end_col_offset]
+            out.append(template % (('',) + tuple(row) + (contents,)))
+    out.append("\n")
+    # One write per function is much faster on unbuffered or line-buffered
+    # streams.
+    stream.write("\n".join(out))
+
+def show_text(stats, unit, output_unit=None, stream=None, stripzeros=False,
+    overhead=None, sample_interval=None, self_timings=None, histograms=None,
+    memory=None, top=None, sort='time', cumulative=None, instructions=None):
     """ Show text for the given timings.
+
+    If `sample_interval` is given, the timings come from the sampling mode and
+    a note saying so is added to the header. If `self_timings`, `histograms`
+    or `memory` are given, the self time, the latency percentiles or the
+    memory allocated by each line are shown as well. So are the timings of the
+    bytecode instructions in `instructions`.
+
+    If `top` or `cumulative` is given, a single table of the hottest lines of
+    all functions is shown instead, ranked by `sort`: 'time' for the total
+    time, 'self' for the self time from `self_timings`, or 'per_hit' for the
+    time per hit. It stops after `top` lines, or once the lines shown cover
+    `cumulative` percent of the total time (or self time, with 'self').
     """
     if stream is None:
         stream = sys.stdout
 
+    _show_header(unit, output_unit, stream, overhead, sample_interval)
+    _source_cache.refresh()
+    if top is not None or cumulative is not None:
+        _show_top(stats, unit, output_unit, stream, overhead, self_timings, top,
+            sort, cumulative, _source_cache)
+    else:
+        _show_funcs(sorted(stats), stats, unit, output_unit, stream,
+            stripzeros, overhead, self_timings, histograms, memory,
+            instructions, _source_cache)
+
+SORT_KEYS = ('time', 'self', 'per_hit')
+
+def _show_top(stats, unit, output_unit, stream, overhead, self_timings, top,
+    sort, cumulative, source_cache):
+    """ Show the hottest lines of all functions in one table.
+    """
+    if sort not in SORT_KEYS:
+        raise ValueError('sort must be one of %s, not %r.' % (
+            ', '.join(SORT_KEYS), sort))
+    if sort == 'self' and self_timings is None:
+        raise ValueError('Sorting by self time needs self timings.')
+    if output_unit is None:
+        output_unit = unit
+    scalar = unit / output_unit
+
+    # (key, lineno, nhits, time, self time)
+    rows = []
+    for key, timings in stats.items():
+        if self_timings is not None:
+            self_times = dict((lineno, time)
+                for lineno, nhits, time in self_timings.get(key, []))
+        for lineno, nhits, time in timings:
+            if overhead:
+                time = max(0.0, time - nhits * overhead)
+            rows.append((key, lineno, nhits, time,
+                self_times.get(lineno, 0) if self_timings is not None else 0))
+    # The percentages are of the self time when ranking by it, since the total
+    # times of nested profiled functions overlap.
+    measure = 4 if sort == 'self' else 3
+    total = float(sum(row[measure] for row in rows))
+    if sort == 'per_hit':
+        rows.sort(key=lambda row: (-float(row[3]) / max(row[2], 1), row[0],
+            row[1]))
+    else:
+        rows.sort(key=lambda row: (-row[measure], row[0], row[1]))
+
+    shown = []
+    cumulative_percent = 0.0
+    for row in rows:
+        if top is not None and len(shown) >= top:
+            break
+        if cumulative is not None and shown and \
+            cumulative_percent >= cumulative:
+            break
+        percent = 100 * row[measure] / total if total else 0.0
+        cumulative_percent += percent
+        shown.append((row, percent, cumulative_percent))
+
+    columns = [('Rank', 6), ('Hits', 9), ('Time', 12)]
+    if self_timings is not None:
+        columns.append(('Self', 12))
+    columns.extend([('Per Hit', 8), ('% Time', 8), ('Cum %', 8)])
+    locations = ['%s:%s (%s)' % (row[0][0], row[1], row[0][2])
+        for row, percent, cumulative_percent in shown]
+    width = max([len('Location')] + [len(location) for location in locations])
+    template = ' '.join(['%%%ds' % w for name, w in columns]) + \
+        '  %%-%ds  %%s' % width
+
+    out = []
+    out.append('Total time: %g s in %d lines of %d functions' % (
+        total * unit, len(rows), len(stats)))
+    title = 'Top %d lines by %s' % (len(shown), sort.replace('_', ' '))
+    if shown:
+        title += ', covering %.1f%% of the %s' % (shown[-1][2],
+            'self time' if sort == 'self' else 'time')
+    out.append(title)
+    out.append('')
+    header = template % (tuple([name for name, w in columns]) +
+        ('Location', 'Line Contents'))
+    out.append(header)
+    out.append('=' * len(header))
+    for rank, ((row, percent, cumulative_percent), location) in enumerate(
+            zip(shown, locations)):
+        key, lineno, nhits, time, self_time = row
+        values = [rank + 1, nhits, '%5.1f' % (time * scalar)]
+        if self_timings is not None:
+            values.append('%5.1f' % (self_time * scalar))
+        values.extend(['%5.1f' % (float(time) * scalar / max(nhits, 1)),
+            '%5.1f' % percent, '%5.1f' % cumulative_percent])
+        out.append(template % (tuple(values) + (location,
+            source_cache.line(key[0], lineno).strip())))
+    out.append('\n')
+    stream.write('\n'.join(out))
+
+def _show_header(unit, output_unit, stream, overhead, sample_interval):
     if output_unit is not None:
         stream.write('Timer unit: %g s\n\n' % output_unit)
     else:
         stream.write('Timer unit: %g s\n\n' % unit)
+    if overhead:
+        stream.write('Tracer overhead: %g s per hit\n\n' % (overhead * unit))
+    if sample_interval is not None:
+        stream.write('Sampled every %g s: Hits are sample counts and times are '
+            'estimates.\n\n' % sample_interval)
+
+def _show_funcs(keys, stats, unit, output_unit, stream, stripzeros, overhead,
+    self_timings, histograms, memory, instructions, source_cache):
+    for key in keys:
+        fn, lineno, name = key
+        show_func(fn, lineno, name, stats[key], unit,
+            output_unit=output_unit, stream=stream, stripzeros=stripzeros,
+            overhead=overhead, self_timings=None if self_timings is None else
+            self_timings.get(key, []),
+            histograms=None if histograms is None else
+            histograms.get(key, []), memory=None if memory is None else
+            memory.get(key, []), instructions=None if instructions is None
+            else instructions.get(key), source_cache=source_cache)
+
+def write_text(lstats, stream, output_unit=None, stripzeros=False, jobs=None,
+    chunk_size=64):
+    """ Write the text report of a LineStats object to `stream`, formatting
+    the functions in `jobs` worker processes (by default, one per CPU).
+
+    The functions are shown in the same order as by `show_text()`, split into
+    chunks of at most `chunk_size` functions. Neighbouring functions usually
+    come from the same file, so each worker reads few files. The chunks are
+    written as they are done, in order.
+    """
+    keys = sorted(lstats.timings)
+    if jobs is None:
+        import multiprocessing
+        jobs = multiprocessing.cpu_count()
+    _show_header(lstats.unit, output_unit, stream, lstats.overhead,
+        lstats.sample_interval)
+    chunks = [keys[i:i + chunk_size] for i in range(0, len(keys), chunk_size)]
+    if jobs == 1 or len(chunks) <= 1:
+        _source_cache.refresh()
+        _show_funcs(keys, lstats.timings, lstats.unit, output_unit, stream,
+            stripzeros, lstats.overhead, lstats.self_timings,
+            lstats.histograms, lstats.memory, lstats.instructions,
+            _source_cache)
+        return
+    tasks = []
+    for chunk in chunks:
+        tasks.append((chunk, dict((key, lstats.timings[key]) for key in chunk),
+            _subset(lstats.self_timings, chunk),
+            _subset(lstats.histograms, chunk), _subset(lstats.memory, chunk),
+            _subset(lstats.instructions, chunk), lstats.unit, output_unit, stripzeros, lstats.overhead))
+    import multiprocessing
+    pool = multiprocessing.Pool(min(jobs, len(chunks)))
+    try:
+        for text in pool.imap(_render_chunk, tasks):
+            stream.write(text)
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+def _subset(stats, keys):
+    if stats is None:
+        return None
+    return dict((key, stats[key]) for key in keys if key in stats)
+
+def _render_chunk(task):
+    """ Format one chunk of functions for `write_text()`.
+    """
+    (keys, stats, self_timings, histograms, memory, instructions, unit,
+        output_unit, stripzeros, overhead) = task
+    stream = StringIO()
+    _source_cache.refresh()
+    _show_funcs(keys, stats, unit, output_unit, stream, stripzeros, overhead,
+        self_timings, histograms, memory, instructions, _source_cache)
+    return stream.getvalue()
+
+def show_thread_text(threads, unit, output_unit=None, stream=None,
+    stripzeros=False, overhead=None):
+    """ Show text for the per-thread timings from `LineStats.threads`.
+    """
+    if stream is None:
+        stream = sys.stdout
+
+    for (thread_id, thread_name), stats in sorted(threads.items(),
+        key=lambda item: item[0][0]):
+        stream.write('Thread: %s (id %s)\n' % (thread_name, thread_id))
+        stream.write('=' * 79)
+        stream.write('\n')
+        show_text(stats, unit, output_unit=output_unit, stream=stream,
+            stripzeros=stripzeros, overhead=overhead)
+
+def show_task_text(tasks, unit, output_unit=None, stream=None,
+    stripzeros=False, overhead=None):
+    """ Show text for the per-task timings from `LineStats.tasks`.
+    """
+    if stream is None:
+        stream = sys.stdout
+
+    for name, stats in sorted(tasks.items()):
+        stream.write('Task: %s\n' % (name,))
+        stream.write('=' * 79)
+        stream.write('\n')
+        show_text(stats, unit, output_unit=output_unit, stream=stream,
+            stripzeros=stripzeros, overhead=overhead)
+
+def show_process_text(processes, unit, output_unit=None, stream=None,
+    stripzeros=False, overhead=None):
+    """ Show text for the per-process timings from `LineStats.processes`.
+    """
+    if stream is None:
+        stream = sys.stdout
 
-    for (fn, lineno, name), timings in sorted(stats.items()):
-        show_func(fn, lineno, name, stats[fn, lineno, name], unit,
-            output_unit=output_unit, stream=stream, stripzeros=stripzeros)
+    for pid, stats in sorted(processes.items()):
+        stream.write('Process: %s\n' % (pid,))
+        stream.write('=' * 79)
+        stream.write('\n')
+        show_text(stats, unit, output_unit=output_unit, stream=stream,
+            stripzeros=stripzeros, overhead=overhead)
 
 @magics_class
 class LineProfilerMagics(Magics):
@@ -286,7 +895,7 @@ class LineProfilerMagics(Magics):
 
         One or more -f or -m options are required to get any useful results.
 
-        -D <filename>: dump the raw statistics out to a pickle file on disk. The
+        -D <filename>: dump the raw statistics out to a binary file on disk. The
         usual extension for this is ".lprof". These statistics may be viewed later
         by running line_profiler.py as a script.
 
@@ -298,12 +907,22 @@ class LineProfilerMagics(Magics):
         -s: strip out all entries from the print-out that have zeros.
 
         -u: specify time unit for the print-out in seconds.
+
+        -t <N>: only show the N hottest lines of all functions, in one table.
+
+        -c <percent>: show the hottest lines of all functions until they cover
+        this percentage of the time.
+
+        -k <key>: rank the hottest lines by "time" (the default), "self" or
+        "per_hit".
         """
 
         # Escape quote markers.
-        opts_def = Struct(D=[''], T=[''], f=[], m=[], u=None)
+        opts_def = Struct(D=[''], T=[''], f=[], m=[], u=None, t=None, c=None,
+            k=['time'])
         parameter_s = parameter_s.replace('"', r'\"').replace("'", r"\'")
-        opts, arg_str = self.parse_options(parameter_s, 'rsf:m:D:T:u:', list_all=True)
+        opts, arg_str = self.parse_options(parameter_s, 'rsf:m:D:T:u:t:c:k:',
+            list_all=True)
         opts.merge(opts_def)
 
         global_ns = self.shell.user_global_ns
@@ -337,6 +956,16 @@ class LineProfilerMagics(Magics):
         else:
             output_unit = None
 
+        try:
+            top = int(opts.t[0]) if opts.t is not None else None
+            cumulative = float(opts.c[0]) if opts.c is not None else None
+        except ValueError:
+            raise UsageError("-t must be an integer and -c a number.")
+        sort = opts.k[0]
+        if sort not in SORT_KEYS:
+            raise UsageError("-k must be one of %s." % ', '.join(SORT_KEYS))
+        summary = dict(top=top, sort=sort, cumulative=cumulative)
+
         # Add the profiler to the builtins for @profile.
         if PY3:
             import builtins
@@ -364,26 +993,29 @@ class LineProfilerMagics(Magics):
             if had_profile:
                 builtins.__dict__['profile'] = old_profile
 
-        # Trap text output.
-        stdout_trap = StringIO()
-        profile.print_stats(stdout_trap, output_unit=output_unit, stripzeros='s' in opts)
-        output = stdout_trap.getvalue()
-        output = output.rstrip()
-
-        page(output)
+        text_file = opts.T[0]
+        if text_file:
+            # Stream the printout straight to the file instead of building it
+            # in memory, then page it from there.
+            with open(text_file, 'w') as pfile:
+                profile.print_stats(pfile, output_unit=output_unit,
+                    stripzeros='s' in opts, **summary)
+            page_file(text_file)
+        else:
+            # Trap text output.
+            stdout_trap = StringIO()
+            profile.print_stats(stdout_trap, output_unit=output_unit,
+                stripzeros='s' in opts, **summary)
+            page(stdout_trap.getvalue().rstrip())
         print(message, end="")
 
         dump_file = opts.D[0]
         if dump_file:
             profile.dump_stats(dump_file)
-            print('\n*** Profile stats pickled to file %r. %s' % (
+            print('\n*** Profile stats dumped to file %r. %s' % (
                 dump_file, message))
 
-        text_file = opts.T[0]
         if text_file:
-            pfile = open(text_file, 'w')
-            pfile.write(output)
-            pfile.close()
             print('\n*** Profile printout saved to text file %r. %s' % (
                 text_file, message))
 
@@ -400,23 +1032,1276 @@ def load_ipython_extension(ip):
     ip.register_magics(LineProfilerMagics)
 
 
+# The binary .lprof format
+# ===========================================================
+#
+# All integers are little-endian. A file consists of:
+#
+#   header     LPROF_HEADER: the magic bytes, the format version, a reserved
+#              field, the timer unit and the tracer overhead as doubles, then
+#              the number of functions, the offset of the function table, the
+#              offset and size of the string table, the offset and number of
+#              the line records, and the offset and size of the extras.
+#   strings    The UTF-8 encoded filenames, function names and sources, back
+#              to back.
+#   functions  One LPROF_FUNCTION entry per function: the offsets and lengths
+#              of its filename and name in the string table, its first line
+#              number, the index and number of its line records, and the
+#              offset, length and number of lines of its source in the string
+#              table. The source lines are joined with newlines, and a source
+#              of 0 lines means that none was recorded.
+#   records    (lineno, nhits, total_time) as three int64s per line, in line
+#              order within each function. They start on an 8 byte boundary,
+#              so they can be viewed as an int64 array of shape (nrecords, 3).
+#   extras     The other LineStats attributes, like the per-thread and
+#              per-process timings, as a UTF-8 encoded JSON object, or empty.
+#              Dictionaries and tuples are stored as {"d": [[key, value], ...]}
+#              and {"t": [item, ...]} so that they come back as they were.
+#
+# The reserved header field is zero in version 1.
+
+LPROF_MAGIC = b'LPROF\x00\r\n'
+LPROF_VERSION = 1
+LPROF_HEADER = struct.Struct('<8sIIddQQQQQQQQ')
+LPROF_FUNCTION = struct.Struct('<IIIIqQQQQQ')
+LPROF_RECORD = struct.Struct('<qqq')
+
+# LineStats attributes that are stored outside of the extras.
+_LPROF_FIELDS = ('timings', 'unit', 'overhead', 'sources')
+
+if PY3:
+    _JSON_SCALARS = (bool, int, float, str)
+else:
+    _JSON_SCALARS = (bool, int, long, float, str, unicode)
+
+
+def write_stats(lstats, filename, legacy=False):
+    """ Utility function to write a LineStats object to a given filename in
+    the binary .lprof format, or as a pickle with `legacy`.
+
+    The data is written to a temporary file in the same directory, which then
+    replaces `filename`, so readers never see a partially written file.
+    """
+    tmpname = '%s.%d-%d.tmp' % (filename, os.getpid(), get_ident())
+    try:
+        with open(tmpname, 'wb') as f:
+            if legacy:
+                pickle.dump(lstats, f, pickle.HIGHEST_PROTOCOL)
+            else:
+                _write_lprof(lstats, f)
+        if PY3:
+            os.replace(tmpname, filename)
+        else:
+            if os.name == 'nt' and os.path.exists(filename):
+                os.remove(filename)
+            os.rename(tmpname, filename)
+    except BaseException:
+        if os.path.exists(tmpname):
+            os.remove(tmpname)
+        raise
+
+
+def _write_lprof(lstats, f):
+    """ Write a LineStats object to an open file in the binary .lprof format.
+    """
+    strings = []
+    string_offsets = {}
+    strings_size = [0]
+
+    def add_string(s):
+        if not isinstance(s, bytes):
+            s = s.encode('utf-8', 'surrogateescape' if PY3 else 'strict')
+        if s not in string_offsets:
+            string_offsets[s] = strings_size[0]
+            strings.append(s)
+            strings_size[0] += len(s)
+        return string_offsets[s], len(s)
+
+    sources = dict(lstats.sources or {})
+    functions = []
+    nrecords = 0
+    for key in sorted(lstats.timings):
+        filename, first_lineno, name = key
+        entries = lstats.timings[key]
+        source = sources.pop(key, None) or []
+        functions.append(add_string(filename) + add_string(name) +
+            (first_lineno, nrecords, len(entries)) +
+            add_string('\n'.join(source)) + (len(source),))
+        nrecords += len(entries)
+    strings_size = strings_size[0]
+
+    extras = dict((name, value) for name, value in vars(lstats).items()
+        if name not in _LPROF_FIELDS and value is not None)
+    if sources:
+        # Sources of functions without timings.
+        extras['sources'] = sources
+    extras = json.dumps(_to_json(extras), separators=(',', ':')).encode(
+        'utf-8') if extras else b''
+
+    strings_offset = LPROF_HEADER.size
+    functions_offset = _align8(strings_offset + strings_size)
+    records_offset = functions_offset + LPROF_FUNCTION.size * len(functions)
+    extras_offset = records_offset + LPROF_RECORD.size * nrecords
+
+    f.write(LPROF_HEADER.pack(LPROF_MAGIC, LPROF_VERSION, 0, lstats.unit,
+        lstats.overhead, len(functions), functions_offset, strings_offset,
+        strings_size, records_offset, nrecords, extras_offset, len(extras)))
+    f.write(b''.join(strings))
+    f.write(b'\x00' * (functions_offset - strings_offset - strings_size))
+    for function in functions:
+        f.write(LPROF_FUNCTION.pack(*function))
+    for key in sorted(lstats.timings):
+        f.write(b''.join([LPROF_RECORD.pack(lineno, nhits, int(time))
+            for lineno, nhits, time in lstats.timings[key]]))
+    f.write(extras)
+
+
+def _align8(offset):
+    return (offset + 7) & ~7
+
+
+def _to_json(value):
+    """ Convert a LineStats attribute to JSON data, tagging dictionaries and
+    tuples so that `_from_json()` can restore them.
+    """
+    if isinstance(value, dict):
+        return {'d': [[_to_json(key), _to_json(item)]
+            for key, item in value.items()]}
+    if isinstance(value, tuple):
+        return {'t': [_to_json(item) for item in value]}
+    if isinstance(value, list):
+        return [_to_json(item) for item in value]
+    if value is None or isinstance(value, _JSON_SCALARS):
+        return value
+    raise TypeError('Cannot store a %s in a .lprof file. Use legacy=True to '
+        'write a pickle instead.' % (type(value).__name__,))
+
+
+def _from_json(value):
+    """ Undo `_to_json()`.
+    """
+    if isinstance(value, dict):
+        if 'd' in value:
+            return dict((_from_json(key), _from_json(item))
+                for key, item in value['d'])
+        return tuple(_from_json(item) for item in value['t'])
+    if isinstance(value, list):
+        return [_from_json(item) for item in value]
+    return value
+
+
+class MappedLineStats(object):
+    """ Read-only access to a binary .lprof file through `mmap`, without
+    building the full LineStats.
+
+    Only the header and the function table are read up front. The line
+    records of a function are unpacked when they are asked for, or can be
+    viewed in place as NumPy arrays. The sources are decoded when they are
+    asked for, and the other LineStats attributes, like `threads` and
+    `processes`, the first time one is accessed.
+
+    The file stays mapped until `close()` is called or the object is used as
+    a context manager, and as long as NumPy views of it are alive.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            self._read_header()
+        except Exception:
+            self._map.close()
+            raise
+        self._extras = None
+        self._sources = None
+
+    def _read_header(self):
+        if len(self._map) < LPROF_HEADER.size:
+            raise ValueError('%s is not a .lprof file.' % (self.filename,))
+        (magic, version, reserved, self.unit, self.overhead, nfunctions,
+            functions_offset, strings_offset, strings_size, records_offset,
+            self.nrecords, self._extras_offset,
+            self._extras_size) = LPROF_HEADER.unpack_from(self._map, 0)
+        if magic != LPROF_MAGIC:
+            raise ValueError('%s is not a .lprof file.' % (self.filename,))
+        if version > LPROF_VERSION:
+            raise ValueError('%s uses .lprof format version %d, but only '
+                'versions up to %d are supported.' % (self.filename, version,
+                LPROF_VERSION))
+        self._records_offset = records_offset
+        self._strings_offset = strings_offset
+        self._functions = {}
+        self._source_spans = {}
+        for i in range(nfunctions):
+            (filename_offset, filename_size, name_offset, name_size,
+                first_lineno, start, count, source_offset, source_size,
+                source_nlines) = LPROF_FUNCTION.unpack_from(self._map,
+                functions_offset + i * LPROF_FUNCTION.size)
+            key = (self._string(filename_offset, filename_size), first_lineno,
+                self._string(name_offset, name_size))
+            self._functions[key] = (start, count)
+            if source_nlines:
+                self._source_spans[key] = (source_offset, source_size)
+
+    def _string(self, offset, size):
+        offset += self._strings_offset
+        return _decode(self._map[offset:offset + size])
+
+    def keys(self):
+        """ Return the (filename, first_lineno, function name) keys of the
+        profiled functions.
+        """
+        return list(self._functions)
+
+    def __contains__(self, key):
+        return key in self._functions
+
+    def __len__(self):
+        return len(self._functions)
+
+    def records(self, key):
+        """ Return the (lineno, nhits, total_time) tuples of one function.
+        """
+        start, count = self._functions[key]
+        return self._unpack_records(start, count)
+
+    def _unpack_records(self, start, count):
+        offset = self._records_offset + start * LPROF_RECORD.size
+        if PY3:
+            return list(LPROF_RECORD.iter_unpack(
+                self._map[offset:offset + count * LPROF_RECORD.size]))
+        return [LPROF_RECORD.unpack_from(self._map,
+            offset + i * LPROF_RECORD.size) for i in range(count)]
+
+    def array(self, key=None):
+        """ Return an int64 NumPy array of shape (n, 3) viewing the records of
+        one function in place, or all records with no `key`.
+
+        In the whole array, the records of each function form the slice given
+        by `record_range(key)`.
+        """
+        import numpy
+        start, count = (0, self.nrecords) if key is None else (
+            self._functions[key])
+        return numpy.frombuffer(self._map, dtype='<i8', count=count * 3,
+            offset=self._records_offset + start * LPROF_RECORD.size).reshape(
+            count, 3)
+
+    def record_range(self, key):
+        """ Return the (start, stop) indices of a function's records among all
+        records of the file.
+        """
+        start, count = self._functions[key]
+        return start, start + count
+
+    @property
+    def timings(self):
+        """ The timings of all functions, as in `LineStats.timings`.
+        """
+        records = self._unpack_records(0, self.nrecords)
+        return dict((key, records[start:start + count])
+            for key, (start, count) in self._functions.items())
+
+    def source(self, key):
+        """ Return the source lines of one function, or None if they were not
+        recorded.
+        """
+        span = self._source_spans.get(key)
+        if span is None:
+            return (self.extras.get('sources') or {}).get(key)
+        return self._string(*span).split('\n')
+
+    @property
+    def sources(self):
+        """ The sources of all functions, as in `LineStats.sources`.
+        """
+        if self._sources is None:
+            sources = dict(self.extras.get('sources') or {})
+            for key in self._source_spans:
+                sources[key] = self.source(key)
+            self._sources = sources or None
+        return self._sources
+
+    @property
+    def extras(self):
+        """ The LineStats attributes other than the timings, unit, overhead and
+        sources.
+        """
+        if self._extras is None:
+            self._extras = {}
+            if self._extras_size:
+                self._extras = _from_json(json.loads(self._map[
+                    self._extras_offset:self._extras_offset +
+                    self._extras_size].decode('utf-8')))
+        return self._extras
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        try:
+            return self.extras[name]
+        except KeyError:
+            # Fall back on the class defaults of LineStats.
+            return getattr(LineStats, name)
+
+    def to_line_stats(self):
+        """ Build the full LineStats object.
+        """
+        lstats = LineStats(self.timings, self.unit, self.overhead)
+        for name, value in self.extras.items():
+            setattr(lstats, name, value)
+        lstats.sources = self.sources
+        return lstats
+
+    def close(self):
+        try:
+            self._map.close()
+        except BufferError:
+            # NumPy views of the records are still alive. The mapping goes
+            # away with them.
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def _decode(s):
+    if PY3:
+        return s.decode('utf-8', 'surrogateescape')
+    return s
+
+
+def is_lprof_file(filename):
+    """ Return True if `filename` is in the binary .lprof format rather than a
+    legacy pickle.
+    """
+    with open(filename, 'rb') as f:
+        return f.read(len(LPROF_MAGIC)) == LPROF_MAGIC
+
+
 def load_stats(filename):
-    """ Utility function to load a pickled LineStats object from a given
-    filename.
+    """ Utility function to load a LineStats object from a given filename,
+    either in the binary .lprof format or as a legacy pickle.
     """
+    if is_lprof_file(filename):
+        with MappedLineStats(filename) as mapped:
+            return mapped.to_line_stats()
     with open(filename, 'rb') as f:
         return pickle.load(f)
 
 
+# Exporters
+# ===========================================================
+#
+# The exporters write a LineStats object one function at a time, for viewers
+# and tools that do not read .lprof files:
+#
+#   callgrind   The callgrind format of Valgrind, for KCachegrind and
+#               QCachegrind. Each line's cost is its time in timer units and
+#               its hits, and its self time too when it was recorded, so the
+#               source can be annotated line by line.
+#   speedscope  A speedscope (https://www.speedscope.app) sampled profile in
+#               seconds, with one stack of function and line frames for each
+#               line.
+#   json        One document: {"format": "line_profiler", "version": 1,
+#               "unit": <timer unit in seconds>, "functions": [...]}, where
+#               each function is {"filename", "name", "first_lineno",
+#               "lines": [{"lineno", "hits", "time", "self_time"}, ...]}.
+#               Times are in seconds, and "self_time" is only there when self
+#               times were recorded.
+#   ndjson      One JSON object per line of source, with the keys of a
+#               function and of a line of the json format together:
+#               {"filename", "name", "first_lineno", "lineno", "hits",
+#               "time", "self_time"}.
+#
+# The estimated tracer overhead is subtracted from the times, as in the text
+# reports.
+
+EXPORT_FORMATS = ('callgrind', 'speedscope', 'json', 'ndjson')
+
+# The file name suffix of each format, used by `kernprof --export` and to tell
+# the format from a file name.
+EXPORT_SUFFIXES = {
+    'callgrind': '.callgrind',
+    'speedscope': '.speedscope.json',
+    'json': '.json',
+    'ndjson': '.ndjson',
+}
+
+EXPORT_VERSION = 1
+
+
+def export_format(filename):
+    """ Return the export format of `filename` from its name, or None.
+    """
+    basename = os.path.basename(filename)
+    if basename.startswith('callgrind.out'):
+        return 'callgrind'
+    # The longest suffix wins, so .speedscope.json is not taken for .json.
+    for format in sorted(EXPORT_SUFFIXES,
+            key=lambda format: -len(EXPORT_SUFFIXES[format])):
+        if basename.endswith(EXPORT_SUFFIXES[format]):
+            return format
+    if basename.endswith('.jsonl'):
+        return 'ndjson'
+    return None
+
+
+def export_stats(lstats, filename, format=None):
+    """ Write a LineStats object to `filename` in one of the `EXPORT_FORMATS`.
+    By default, the format is told from the file name, as in `export_format()`.
+    """
+    if format is None:
+        format = export_format(filename)
+        if format is None:
+            raise ValueError('Cannot tell the export format of %r. Pass one '
+                'of %s.' % (filename, ', '.join(EXPORT_FORMATS)))
+    if format not in EXPORT_FORMATS:
+        raise ValueError('format must be one of %s, not %r.' % (
+            ', '.join(EXPORT_FORMATS), format))
+    with open(filename, 'w') as f:
+        _EXPORTERS[format](lstats, f)
+
+
+def _export_lines(lstats):
+    """ Yield the key and the (lineno, nhits, time, self time) of the lines of
+    each function, in timer units and without the tracer overhead. The self
+    time is None if it was not recorded.
+    """
+    overhead = lstats.overhead or 0
+    self_timings = lstats.self_timings
+    for key in sorted(lstats.timings):
+        self_times = {}
+        if self_timings is not None:
+            self_times = dict((lineno, time)
+                for lineno, nhits, time in self_timings.get(key, []))
+        lines = []
+        for lineno, nhits, time in sorted(lstats.timings[key]):
+            if overhead:
+                time = max(0.0, time - nhits * overhead)
+            self_time = None
+            if self_timings is not None:
+                self_time = self_times.get(lineno, 0)
+                if overhead:
+                    self_time = max(0.0, self_time - nhits * overhead)
+            lines.append((lineno, nhits, time, self_time))
+        yield key, lines
+
+
+def _export_callgrind(lstats, f):
+    with_self = lstats.self_timings is not None
+    f.write('# callgrind format\nversion: 1\ncreator: line_profiler\n'
+        'positions: line\n')
+    f.write('event: Time : Time (%g s)\n' % lstats.unit)
+    f.write('event: Hits : Hits\n')
+    if with_self:
+        f.write('event: Self : Self time (%g s)\n' % lstats.unit)
+        f.write('events: Time Hits Self\n')
+    else:
+        f.write('events: Time Hits\n')
+    # Functions with the same name in one file, like methods of different
+    # classes, are told apart by their first line.
+    names = {}
+    for filename, first_lineno, name in lstats.timings:
+        names[filename, name] = names.get((filename, name), 0) + 1
+    totals = [0, 0, 0]
+    for (filename, first_lineno, name), lines in _export_lines(lstats):
+        if names[filename, name] > 1:
+            name = '%s:%d' % (name, first_lineno)
+        f.write('\nfl=%s\nfn=%s\n' % (filename, name))
+        for lineno, nhits, time, self_time in lines:
+            time = int(round(time))
+            totals[0] += time
+            totals[1] += nhits
+            if with_self:
+                self_time = int(round(self_time))
+                totals[2] += self_time
+                f.write('%d %d %d %d\n' % (lineno, time, nhits, self_time))
+            else:
+                f.write('%d %d %d\n' % (lineno, time, nhits))
+    f.write('\ntotals: %s\n' % ' '.join(
+        str(total) for total in totals[:3 if with_self else 2]))
+
+
+def _export_speedscope(lstats, f):
+    # The frames of a function and of its lines come first, and the samples,
+    # one stack of a function and a line frame for each line, refer to them by
+    # their index.
+    f.write('{"$schema": "https://www.speedscope.app/file-format-schema.json",'
+        ' "exporter": "line_profiler", "name": "line_profiler",'
+        ' "activeProfileIndex": 0, "shared": {"frames": [')
+    nframes = 0
+    for (filename, first_lineno, name), lines in _export_lines(lstats):
+        frames = [{'name': name, 'file': filename, 'line': first_lineno}]
+        for lineno, nhits, time, self_time in lines:
+            contents = _source_cache.line(filename, lineno).strip()
+            frames.append({'name': '%s:%d %s' % (name, lineno, contents),
+                'file': filename, 'line': lineno})
+        f.write(('' if nframes == 0 else ', ') +
+            ', '.join(json.dumps(frame, sort_keys=True) for frame in frames))
+        nframes += len(frames)
+    f.write(']}, "profiles": [{"type": "sampled", "name": "line_profiler",'
+        ' "unit": "seconds", "startValue": 0, "samples": [')
+    weights = []
+    function_frame = 0
+    for key, lines in _export_lines(lstats):
+        f.write(('' if function_frame == 0 else ', ') + ', '.join(
+            '[%d, %d]' % (function_frame, function_frame + i + 1)
+            for i in range(len(lines))))
+        weights.extend(time * lstats.unit for lineno, nhits, time, self_time
+            in lines)
+        function_frame += len(lines) + 1
+    f.write('], "weights": [%s], "endValue": %r}]}\n' % (
+        ', '.join(repr(weight) for weight in weights), sum(weights)))
+
+
+def _export_line(line, unit):
+    lineno, nhits, time, self_time = line
+    record = {'lineno': lineno, 'hits': nhits, 'time': time * unit}
+    if self_time is not None:
+        record['self_time'] = self_time * unit
+    return record
+
+
+def _export_json(lstats, f):
+    f.write('{"format": "line_profiler", "version": %d, "unit": %r, '
+        '"functions": [' % (EXPORT_VERSION, lstats.unit))
+    for i, ((filename, first_lineno, name), lines) in enumerate(
+            _export_lines(lstats)):
+        function = {'filename': filename, 'name': name,
+            'first_lineno': first_lineno,
+            'lines': [_export_line(line, lstats.unit) for line in lines]}
+        f.write(('' if i == 0 else ',') + '\n' +
+            json.dumps(function, sort_keys=True))
+    f.write('\n]}\n')
+
+
+def _export_ndjson(lstats, f):
+    for (filename, first_lineno, name), lines in _export_lines(lstats):
+        for line in lines:
+            record = _export_line(line, lstats.unit)
+            record.update(filename=filename, name=name,
+                first_lineno=first_lineno)
+            f.write(json.dumps(record, sort_keys=True) + '\n')
+
+
+_EXPORTERS = {
+    'callgrind': _export_callgrind,
+    'speedscope': _export_speedscope,
+    'json': _export_json,
+    'ndjson': _export_ndjson,
+}
+
+
+# Remote control
+# ===========================================================
+#
+# A ControlServer lets other processes of the same user control a running
+# LineProfiler through a Unix-domain socket. Each connection sends one command
+# as a line of words and gets one line back, "ok <message>" or
+# "error <message>":
+#
+#   enable [SECONDS]  Enable the profiler, and disable it again after SECONDS
+#                     seconds if given.
+#   disable           Undo an earlier `enable`.
+#   add NAME [...]    Profile the functions with these dotted names, or all the
+#                     functions of these modules and classes.
+#   reset             Clear the timings recorded so far.
+#   stats             Reply "ok <size>" followed by `size` bytes of the results
+#                     so far in the binary .lprof format.
+#   status            Describe the state of the profiler.
+
+CONTROL_COMMANDS = ('enable', 'disable', 'add', 'reset', 'stats', 'status')
+
+
+class ControlServer(object):
+    """ Serve the commands of `python -m line_profiler control` for a
+    LineProfiler on the Unix-domain socket `path`, from a daemon thread.
+
+    The commands run in the server's thread, so the profiler should be made
+    with `all_threads=True` to profile the application's threads. The socket
+    can only be used by its owner. Names given to `add` are looked up in the
+    `namespace` dictionary first, if any, and then imported. A client that
+    sends nothing for `timeout` seconds is disconnected, so that it cannot
+    hold up the others.
+    """
+
+    def __init__(self, prof, path, namespace=None, timeout=5.0):
+        self.prof = prof
+        self.path = path
+        self.namespace = namespace
+        self.timeout = timeout
+        self.enabled = False
+        self.timer = None
+        # Counts the enables and disables, so that a timer can tell whether it
+        # is still current.
+        self.generation = 0
+        self.lock = threading.Lock()
+        self.sock = None
+        self.stopped = threading.Event()
+
+    def start(self):
+        """ Listen on the socket and start serving commands.
+        """
+        if os.path.exists(self.path) and stat.S_ISSOCK(
+                os.stat(self.path).st_mode):
+            # Left behind by a process that did not stop its server.
+            os.remove(self.path)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.bind(self.path)
+            # Nobody can connect before listen(). Changing the umask instead
+            # would affect the files that other threads create meanwhile.
+            os.chmod(self.path, 0o600)
+            sock.listen(5)
+        except BaseException:
+            sock.close()
+            raise
+        self.sock = sock
+        thread = threading.Thread(target=self._serve,
+            name='line_profiler control')
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        """ Stop serving, undo a remote `enable` and remove the socket.
+        """
+        if self.sock is None:
+            return
+        self.stopped.set()
+        # Wake up the server from accept().
+        try:
+            _connect(self.path).close()
+        except socket.error:
+            pass
+        self.sock.close()
+        self.sock = None
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self.command('disable')
+
+    def _serve(self):
+        sock = self.sock
+        while not self.stopped.is_set():
+            try:
+                conn, address = sock.accept()
+            except socket.error:
+                return
+            try:
+                conn.settimeout(self.timeout)
+                self._handle(conn)
+            except socket.error:
+                # Including timeouts.
+                pass
+            finally:
+                conn.close()
+
+    def _handle(self, conn):
+        f = conn.makefile('rb')
+        try:
+            line = f.readline(4096)
+        finally:
+            # The file keeps the connection open until it is closed too.
+            f.close()
+        words = line.decode('utf-8').split()
+        if not words:
+            return
+        try:
+            reply = self.command(*words)
+        except Exception as e:
+            conn.sendall(('error %s\n' % (e,)).encode('utf-8'))
+            return
+        if isinstance(reply, bytes):
+            conn.sendall(('ok %d\n' % len(reply)).encode('ascii') + reply)
+        else:
+            conn.sendall(('ok %s\n' % reply).encode('utf-8'))
+
+    def command(self, name, *args):
+        """ Run one command and return its reply: a message, or the bytes of
+        the results for `stats`.
+        """
+        if name not in CONTROL_COMMANDS:
+            raise ValueError('Unknown command %r. Use one of %s.' % (name,
+                ', '.join(CONTROL_COMMANDS)))
+        with self.lock:
+            return getattr(self, '_command_' + name)(*args)
+
+    def _command_enable(self, seconds=None):
+        self.generation += 1
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if seconds is not None:
+            seconds = float(seconds)
+            self.timer = threading.Timer(seconds, self._expire,
+                (self.generation,))
+            self.timer.daemon = True
+            self.timer.start()
+        if not self.enabled:
+            self.prof.enable_by_count()
+            self.enabled = True
+        if seconds is None:
+            return 'enabled'
+        return 'enabled for %g s' % seconds
+
+    def _expire(self, generation):
+        with self.lock:
+            # A later `enable` or `disable` may have come while the timer was
+            # waiting for the lock.
+            if generation == self.generation:
+                self._command_disable()
+
+    def _command_disable(self):
+        self.generation += 1
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if self.enabled:
+            self.prof.disable_by_count()
+            self.enabled = False
+        return 'disabled'
+
+    def _command_add(self, *names):
+        if not names:
+            raise ValueError('add needs the dotted names to profile.')
+        count = 0
+        for name in names:
+            obj = _resolve(name, self.namespace)
+            if inspect.ismodule(obj) or inspect.isclass(obj):
+                count += self.prof.add_module(obj)
+            else:
+                self.prof.add_function(obj)
+                count += 1
+        return 'added %d functions' % count
+
+    def _command_reset(self):
+        self.prof.reset_stats()
+        return 'reset'
+
+    def _command_stats(self):
+        f = BytesIO()
+        _write_lprof(self.prof.get_stats(), f)
+        return f.getvalue()
+
+    def _command_status(self):
+        return '%s, enable count %d, %d functions' % (
+            'enabled' if self.enabled else 'disabled', self.prof.enable_count,
+            len(self.prof.functions))
+
+
+def _resolve(name, namespace=None):
+    """ Return the object with a dotted name, starting from `namespace` or
+    importing its module.
+    """
+    parts = name.split('.')
+    if namespace is not None and parts[0] in namespace:
+        obj = namespace[parts[0]]
+        try:
+            for part in parts[1:]:
+                obj = getattr(obj, part)
+        except AttributeError:
+            raise ValueError('Cannot find %r.' % (name,))
+        return obj
+    for i in range(len(parts), 0, -1):
+        try:
+            obj = importlib.import_module('.'.join(parts[:i]))
+        except ImportError:
+            continue
+        try:
+            for part in parts[i:]:
+                obj = getattr(obj, part)
+        except AttributeError:
+            break
+        return obj
+    raise ValueError('Cannot find %r.' % (name,))
+
+
+def _connect(path):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except socket.error:
+        sock.close()
+        raise
+    return sock
+
+
+def send_control(path, name, *args):
+    """ Send a command to the ControlServer listening on `path` and return its
+    reply: a message, or the bytes of the results for `stats`. Raises
+    RuntimeError if the command failed.
+    """
+    sock = _connect(path)
+    try:
+        sock.sendall((' '.join((name,) + args) + '\n').encode('utf-8'))
+        f = sock.makefile('rb')
+        status, _, message = f.readline().decode('utf-8').rstrip('\n'
+            ).partition(' ')
+        if status != 'ok':
+            raise RuntimeError(message or 'The connection was closed.')
+        if name != 'stats':
+            return message
+        size = int(message)
+        payload = f.read(size)
+        if len(payload) != size:
+            raise RuntimeError('The connection was closed.')
+        return payload
+    finally:
+        sock.close()
+
+
+def merge_stats(stats_list, process_ids=None):
+    """ Combine several LineStats objects into one by summing the timings of
+    each line.
+
+    The result uses the finest timer unit among the inputs, and the times of
+    the other inputs are rescaled to it. The tracer overheads are averaged,
+    weighted by the number of hits. If `process_ids` is given, it holds the
+    process id of each LineStats, and the result keeps the timings of each
+    process in its `processes` attribute. Inputs that were themselves merged
+    from several processes contribute their own per-process timings.
+    Per-thread and per-task timings are not kept, and self times, histograms,
+    memory counts and instruction timings are only kept if all of the inputs
+    have them. The inputs must all have been sampled at the same interval, or
+    all traced.
+    """
+    stats_list = list(stats_list)
+    if not stats_list:
+        raise ValueError("Need at least one LineStats object to merge.")
+    sample_interval = stats_list[0].sample_interval
+    for lstats in stats_list[1:]:
+        if lstats.sample_interval != sample_interval:
+            raise ValueError("Cannot merge results sampled at interval %r "
+                "with results sampled at interval %r." % (
+                lstats.sample_interval, sample_interval))
+    unit = min(lstats.unit for lstats in stats_list)
+    timings_list = []
+    processes = {} if process_ids is not None else None
+    overhead_time = 0.0
+    total_hits = 0
+    for i, lstats in enumerate(stats_list):
+        scale = lstats.unit / unit
+        timings = _rescale_timings(lstats.timings, scale)
+        timings_list.append(timings)
+        nhits = sum(nhits for entries in lstats.timings.values()
+            for lineno, nhits, time in entries)
+        overhead_time += lstats.overhead * scale * nhits
+        total_hits += nhits
+        if processes is not None:
+            if lstats.processes:
+                for pid, proc_timings in lstats.processes.items():
+                    processes[pid] = _rescale_timings(proc_timings, scale)
+            else:
+                processes[process_ids[i]] = timings
+    overhead = overhead_time / total_hits if total_hits else 0.0
+    sources = {}
+    for lstats in stats_list:
+        sources.update(lstats.sources or {})
+    self_timings = None
+    if all(lstats.self_timings is not None for lstats in stats_list):
+        self_timings = merge_timings([
+            _rescale_timings(lstats.self_timings, lstats.unit / unit)
+            for lstats in stats_list])
+    histograms = None
+    if all(lstats.histograms is not None for lstats in stats_list):
+        histograms = _merge_histograms([(lstats.histograms, lstats.unit / unit)
+            for lstats in stats_list])
+    memory = None
+    if all(lstats.memory is not None for lstats in stats_list):
+        # The counts are in bytes, whatever the timer.
+        memory = merge_timings([lstats.memory for lstats in stats_list])
+    instructions = None
+    if all(lstats.instructions is not None for lstats in stats_list):
+        instructions = _merge_instructions([(lstats.instructions,
+            lstats.unit / unit) for lstats in stats_list])
+    return LineStats(merge_timings(timings_list), unit, overhead,
+        processes=processes, sample_interval=sample_interval,
+        sources=sources or None, self_timings=self_timings,
+        histograms=histograms, memory=memory, instructions=instructions)
+
+
+def _merge_instructions(instructions_list):
+    """ Sum (instructions, scale) pairs in the format of
+    `LineStats.instructions`, after multiplying their times by `scale`.
+    """
+    merged = {}
+    for instructions, scale in instructions_list:
+        for key, entries in instructions.items():
+            key_entries = merged.setdefault(key, {})
+            for entry in entries:
+                offset = entry[1]
+                nhits = entry[5]
+                time = entry[6] * scale
+                if offset in key_entries:
+                    old = key_entries[offset]
+                    nhits += old[5]
+                    time += old[6]
+                key_entries[offset] = tuple(entry[:5]) + (nhits, time)
+    return dict((key, [key_entries[offset] for offset in sorted(key_entries)])
+        for key, key_entries in merged.items())
+
+
+def _merge_histograms(histograms_list):
+    """ Sum (histograms, scale) pairs in the format of `LineStats.histograms`,
+    after multiplying their times by `scale`.
+
+    The buckets are shifted by the nearest power of two of the scale, so
+    histograms recorded with timer units that are not powers of two apart are
+    only approximately merged.
+    """
+    lines = {}
+    for histograms, scale in histograms_list:
+        shift = int(round(math.log(scale, 2))) if scale != 1 else 0
+        for key, entries in histograms.items():
+            key_lines = lines.setdefault(key, {})
+            for lineno, min_time, max_time, counts in entries:
+                min_time = int(round(min_time * scale))
+                max_time = int(round(max_time * scale))
+                counts = _shift_buckets(counts, shift)
+                if lineno in key_lines:
+                    old_min, old_max, old_counts = key_lines[lineno]
+                    min_time = min(min_time, old_min)
+                    max_time = max(max_time, old_max)
+                    if len(old_counts) > len(counts):
+                        counts, old_counts = old_counts, counts
+                    counts = tuple([count + old_count for count, old_count in
+                        zip(counts, tuple(old_counts) +
+                            (0,) * (len(counts) - len(old_counts)))])
+                key_lines[lineno] = (min_time, max_time, counts)
+    merged = {}
+    for key, key_lines in lines.items():
+        merged[key] = sorted((lineno,) + entry
+            for lineno, entry in key_lines.items())
+    return merged
+
+
+def _shift_buckets(counts, shift):
+    """ Move log2 bucket counts `shift` buckets up, or down for a negative
+    shift, keeping the counts that fall off the bottom in bucket 0.
+    """
+    if shift >= 0:
+        return (0,) * shift + tuple(counts)
+    counts = tuple(counts)
+    return (sum(counts[:1 - shift]),) + counts[1 - shift:]
+
+
+def _rescale_timings(timings, scale):
+    """ Multiply the times in a `LineStats.timings` mapping by `scale`.
+    """
+    if scale == 1:
+        return timings
+    rescaled = {}
+    for key, entries in timings.items():
+        rescaled[key] = [(lineno, nhits, int(round(time * scale)))
+            for lineno, nhits, time in entries]
+    return rescaled
+
+
+def show_diff(diff, stream=None, nlines=20):
+    """ Show the functions and the `nlines` lines whose time changed the most
+    in a LineStatsDiff, largest increase first.
+    """
+    if stream is None:
+        stream = sys.stdout
+    unit = diff.unit
+
+    template = '%12s %12s %12s %8s %10s %10s  %-s'
+    header = template % ('Base Time', 'New Time', 'Change', '% Change',
+        'Base Hits', 'New Hits', 'Function')
+    stream.write('Timer unit: %g s\n\n' % unit)
+    stream.write(header + '\n')
+    stream.write('=' * len(header) + '\n')
+    for base_key, new_key, base_hits, new_hits, base_time, new_time in (
+            diff.functions):
+        key = new_key or base_key
+        stream.write(template % (base_time, new_time, new_time - base_time,
+            _percent_change(base_time, new_time, base_key, new_key),
+            base_hits, new_hits, '%s at %s:%s' % (key[2], key[0], key[1])))
+        stream.write('\n')
+
+    stream.write('\n')
+    header = template % ('Base Time', 'New Time', 'Change', '% Change',
+        'Base Hits', 'New Hits', 'Line')
+    stream.write(header + '\n')
+    stream.write('=' * len(header) + '\n')
+    for (base_key, new_key, base_lineno, new_lineno, base_hits, new_hits,
+            base_time, new_time) in diff.lines[:nlines]:
+        key, lineno = (new_key, new_lineno) if new_lineno is not None else (
+            base_key, base_lineno)
+        source = diff.sources.get(key) or []
+        index = lineno - key[1]
+        contents = source[index].strip() if 0 <= index < len(source) else ''
+        stream.write(template % (base_time, new_time, new_time - base_time,
+            _percent_change(base_time, new_time, base_lineno, new_lineno),
+            base_hits, new_hits, '%s:%s  %s' % (key[0], lineno, contents)))
+        stream.write('\n')
+
+
+def _percent_change(base_time, new_time, base_id, new_id):
+    if base_id is None:
+        return 'new'
+    if new_id is None:
+        return 'gone'
+    if not base_time:
+        return '' if not new_time else 'inf'
+    return '%+.1f' % (100.0 * (new_time - base_time) / base_time)
+
+
+def diff_main(args):
+    usage = "usage: %prog diff base.lprof new.lprof"
+    parser = optparse.OptionParser(usage=usage)
+    parser.add_option('-n', '--lines', type='int', default=20,
+        help="Number of lines to show.")
+    parser.add_option('--threshold', type='float', default=None,
+        metavar='PERCENT',
+        help="Exit with status 1 if any line got slower by more than PERCENT "
+            "percent.")
+    parser.add_option('--min-time', type='float', default=0.0,
+        metavar='SECONDS',
+        help="With --threshold, ignore lines that got slower by no more than "
+            "SECONDS seconds in total.")
+    parser.add_option('--per-hit', action='store_true',
+        help="With --threshold, compare the time per hit of each line instead "
+            "of its total time.")
+
+    options, args = parser.parse_args(args)
+    if len(args) != 2:
+        parser.error("Must provide the two files to compare.")
+    diff = load_stats(args[0]).diff(load_stats(args[1]))
+    show_diff(diff, nlines=options.lines)
+    if options.threshold is not None:
+        regressions = diff.regressions(options.threshold / 100.0,
+            options.min_time, per_hit=bool(options.per_hit))
+        if regressions:
+            print('\n%d lines got slower by more than %g%%.' % (
+                len(regressions), options.threshold))
+            return 1
+    return 0
+
+
+def merge_files(filenames, jobs=None, chunk_size=32):
+    """ Load and merge many results files with `merge_stats()`, in parallel.
+
+    The files are split into chunks of at most `chunk_size` files, and each
+    chunk is loaded and merged by one of `jobs` worker processes (by default,
+    one per CPU). The partial results are folded into the total as they
+    arrive, so only the total and about one chunk per worker are in memory at
+    any time. With `jobs=1`, everything happens in the current process.
+    Per-thread and per-process timings are not kept.
+    """
+    filenames = list(filenames)
+    if not filenames:
+        raise ValueError("Need at least one file to merge.")
+    if jobs is None:
+        import multiprocessing
+        jobs = multiprocessing.cpu_count()
+    # Give each worker a few chunks so that the work stays balanced.
+    chunk_size = max(1, min(chunk_size, -(-len(filenames) // (jobs * 4))))
+    chunks = [filenames[i:i + chunk_size]
+        for i in range(0, len(filenames), chunk_size)]
+    if jobs == 1 or len(chunks) == 1:
+        partials = (_merge_chunk(chunk) for chunk in chunks)
+        return _fold_stats(partials)
+    import multiprocessing
+    pool = multiprocessing.Pool(min(jobs, len(chunks)))
+    try:
+        lstats = _fold_stats(pool.imap_unordered(_merge_chunk, chunks))
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+    return lstats
+
+
+def _merge_chunk(filenames):
+    """ Load and merge one chunk of results files.
+    """
+    return merge_stats([load_stats(filename) for filename in filenames])
+
+
+def _fold_stats(stats_iter):
+    """ Merge LineStats objects one by one as they come.
+    """
+    total = None
+    for lstats in stats_iter:
+        total = lstats if total is None else merge_stats([total, lstats])
+    # Drop the per-thread and per-process timings of a single input, too.
+    return merge_stats([total])
+
+
+def merge_main(args):
+    usage = "usage: %prog merge -o combined.lprof profile.lprof [...]"
+    parser = optparse.OptionParser(usage=usage)
+    parser.add_option('-o', '--outfile', default=None,
+        help="Write the merged results to this file.")
+    parser.add_option('-j', '--jobs', type='int', default=None,
+        help="Number of worker processes. Defaults to the number of CPUs.")
+    parser.add_option('--chunk-size', type='int', default=32,
+        help="Maximum number of files that a worker loads before handing its "
+            "partial result back. Bounds the memory used by each worker.")
+    parser.add_option('-v', '--view', action='store_true',
+        help="Show the merged results.")
+
+    options, args = parser.parse_args(args)
+    if not args:
+        parser.error("Must provide the files to merge.")
+    if not options.outfile:
+        parser.error("Must provide an output file with -o.")
+    if options.jobs is not None and options.jobs < 1:
+        parser.error("--jobs must be at least 1.")
+    if options.chunk_size < 1:
+        parser.error("--chunk-size must be at least 1.")
+    try:
+        lstats = merge_files(args, jobs=options.jobs,
+            chunk_size=options.chunk_size)
+    except ValueError as e:
+        parser.error(str(e))
+    write_stats(lstats, options.outfile)
+    print('Merged %d files into %s' % (len(args), options.outfile))
+    if options.view:
+        show_text(lstats.timings, lstats.unit, overhead=lstats.overhead,
+            sample_interval=lstats.sample_interval,
+            self_timings=lstats.self_timings, histograms=lstats.histograms,
+            memory=lstats.memory, instructions=lstats.instructions)
+
+
+def export_main(args):
+    usage = "usage: %prog export [-f FORMAT] -o exported profile.lprof"
+    parser = optparse.OptionParser(usage=usage)
+    parser.add_option('-o', '--outfile', default=None,
+        help="Write the exported results to this file.")
+    parser.add_option('-f', '--format', default=None,
+        choices=list(EXPORT_FORMATS),
+        help="The export format: %s. Defaults to the one that goes with the "
+            "name of the output file." % ', '.join(EXPORT_FORMATS))
+
+    options, args = parser.parse_args(args)
+    if len(args) != 1:
+        parser.error("Must provide a filename.")
+    if not options.outfile:
+        parser.error("Must provide an output file with -o.")
+    if options.format is None and export_format(options.outfile) is None:
+        parser.error("Cannot tell the format from %r. Use -f." % (
+            options.outfile,))
+    export_stats(load_stats(args[0]), options.outfile, format=options.format)
+
+
+def control_main(args):
+    usage = ("usage: %prog control SOCKET COMMAND [ARG ...]\n\n"
+        "Commands: enable [SECONDS], disable, add NAME [...], reset, stats, "
+        "status")
+    parser = optparse.OptionParser(usage=usage)
+    parser.add_option('-o', '--outfile', default=None,
+        help="With stats, write the results to this file instead of showing "
+            "them.")
+
+    options, args = parser.parse_args(args)
+    if len(args) < 2:
+        parser.error("Must provide the socket and a command.")
+    path, name = args[:2]
+    if name not in CONTROL_COMMANDS:
+        parser.error("Unknown command %r." % (name,))
+    try:
+        reply = send_control(path, name, *args[2:])
+    except (socket.error, RuntimeError) as e:
+        sys.stderr.write('%s\n' % (e,))
+        return 1
+    if name != 'stats':
+        print(reply)
+        return 0
+    if options.outfile:
+        with open(options.outfile, 'wb') as f:
+            f.write(reply)
+        print('Wrote profile results to %s' % options.outfile)
+        return 0
+    fd, filename = tempfile.mkstemp(suffix='.lprof')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(reply)
+        lstats = load_stats(filename)
+    finally:
+        os.remove(filename)
+    show_text(lstats.timings, lstats.unit, overhead=lstats.overhead,
+        sample_interval=lstats.sample_interval,
+        self_timings=lstats.self_timings, histograms=lstats.histograms,
+        memory=lstats.memory, instructions=lstats.instructions)
+    return 0
+
+
 def main():
-    usage = "usage: %prog profile.lprof"
+    if sys.argv[1:2] == ['merge']:
+        return merge_main(sys.argv[2:])
+    if sys.argv[1:2] == ['diff']:
+        return diff_main(sys.argv[2:])
+    if sys.argv[1:2] == ['export']:
+        return export_main(sys.argv[2:])
+    if sys.argv[1:2] == ['control']:
+        return control_main(sys.argv[2:])
+    usage = ("usage: %prog [-o report.txt] profile.lprof\n"
+        "       %prog merge -o combined.lprof profile.lprof [...]\n"
+        "       %prog diff base.lprof new.lprof\n"
+        "       %prog export [-f FORMAT] -o exported profile.lprof\n"
+        "       %prog control SOCKET COMMAND [ARG ...]")
     parser = optparse.OptionParser(usage=usage, version='%prog 1.0b2')
+    parser.add_option('-o', '--outfile', default=None,
+        help="Write the report to this file instead of showing it.")
+    parser.add_option('-j', '--jobs', type='int', default=None,
+        help="With --outfile, the number of worker processes that format the "
+            "report. Defaults to the number of CPUs.")
+    parser.add_option('-n', '--top', type='int', default=None,
+        help="Only show the TOP hottest lines of all functions, in one table.")
+    parser.add_option('--sort', default='time', choices=list(SORT_KEYS),
+        help="How --top and --cumulative rank the lines: time, self (needs "
+            "self times) or per_hit. [default: %default]")
+    parser.add_option('--cumulative', type='float', default=None,
+        metavar='PERCENT',
+        help="Show the hottest lines of all functions until they cover PERCENT "
+            "percent of the time.")
+    parser.add_option('--threads', action='store_true',
+        help="Also show the timings of each thread, if they were recorded.")
+    parser.add_option('--tasks', action='store_true',
+        help="Also show the timings of each asyncio task, if they were "
+            "recorded.")
+    parser.add_option('--processes', action='store_true',
+        help="Also show the timings of each process, if they were merged from "
+            "several processes.")
 
     options, args = parser.parse_args()
     if len(args) != 1:
         parser.error("Must provide a filename.")
+    if options.jobs is not None and options.jobs < 1:
+        parser.error("--jobs must be at least 1.")
     lstats = load_stats(args[0])
-    show_text(lstats.timings, lstats.unit)
+    if options.sort == 'self' and lstats.self_timings is None:
+        parser.error("--sort=self needs results recorded with self times.")
+    summary = options.top is not None or options.cumulative is not None
+    stream = open(options.outfile, 'w') if options.outfile else sys.stdout
+    if options.outfile and not summary:
+        write_text(lstats, stream, jobs=options.jobs)
+    else:
+        show_text(lstats.timings, lstats.unit, stream=stream,
+            overhead=lstats.overhead, sample_interval=lstats.sample_interval,
+            self_timings=lstats.self_timings, histograms=lstats.histograms,
+            memory=lstats.memory, instructions=lstats.instructions,
+            top=options.top, sort=options.sort,
+            cumulative=options.cumulative)
+    try:
+        if options.threads and lstats.threads:
+            show_thread_text(lstats.threads, lstats.unit, stream=stream,
+                overhead=lstats.overhead)
+        if options.tasks and lstats.tasks:
+            show_task_text(lstats.tasks, lstats.unit, stream=stream,
+                overhead=lstats.overhead)
+        if options.processes and lstats.processes:
+            show_process_text(lstats.processes, lstats.unit, stream=stream,
+                overhead=lstats.overhead)
+    finally:
+        if options.outfile:
+            stream.close()
 
 if __name__ == '__main__':
-    main()
+    sys.exit(main())
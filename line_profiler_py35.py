@@ -1,12 +1,15 @@
 """ This file is only imported in python 3.5 environments """
 import functools
 
-def wrap_coroutine(self, func):
+def wrap_coroutine(self, func, sampler=None):
     """
-    Wrap a Python 3.5 coroutine to profile it.
+    Wrap a Python 3.5 coroutine to profile it, or only the calls chosen by
+    `sampler`, a CallSampler.
     """
     @functools.wraps(func)
     async def wrapper(*args, **kwds):
+        if sampler is not None and not sampler.sample():
+            return await func(*args, **kwds)
         self.enable_by_count()
         try:
             result = await func(*args, **kwds)
@@ -50,8 +50,9 @@ setup(
     download_url = 'https://github.com/rkern/line_profiler/tarball/2.1',
     ext_modules = [
         Extension('_line_profiler',
-                  sources=[line_profiler_source, 'timers.c', 'unset_trace.c'],
-                  depends=['python25.pxd'],
+                  sources=[line_profiler_source, 'timers.c', 'unset_trace.c',
+                           'thread_trace.c', 'tracer_filter.c'],
+                  depends=['python25.pxd', 'frame_compat.h', 'histogram.h'],
         ),
     ],
     license = "BSD",
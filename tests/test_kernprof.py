@@ -1,5 +1,10 @@
-import unittest
+import os
+import shutil
+import signal
+import subprocess
 import sys
+import tempfile
+import unittest
 
 from kernprof import ContextualProfile
 
@@ -77,6 +82,200 @@ class TestKernprof(unittest.TestCase):
             next(i)
         self.assertEqual(profile.enable_count, 0)
 
+    def test_calibrate_sample(self):
+        kernprof = os.path.join(os.path.dirname(os.path.dirname(
+            os.path.abspath(__file__))), 'kernprof.py')
+        proc = subprocess.Popen([sys.executable, kernprof, '-l', '--calibrate',
+            '--sample', '0.001', 'script.py'], stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE)
+        err = proc.communicate()[1]
+        self.assertEqual(proc.returncode, 2)
+        self.assertIn(b'--calibrate cannot be used with --sample', err)
+
+    @unittest.skipUnless(hasattr(os, 'register_at_fork'), 'requires fork hooks')
+    def test_forked_child_profiles(self):
+        import line_profiler
+
+        script = (
+            "import os, sys\n"
+            "@profile\n"
+            "def f(x):\n"
+            "    return x + 1\n"
+            "f(1)\n"
+            "if os.fork() == 0:\n"
+            "    f(2)\n"
+            "    f(3)\n"
+            "    import signal\n"
+            "    print(signal.getsignal(signal.SIGTERM) == signal.SIG_DFL)\n"
+            "    sys.exit(0)\n"
+            "os.wait()\n"
+        )
+        kernprof = os.path.join(os.path.dirname(os.path.dirname(
+            os.path.abspath(__file__))), 'kernprof.py')
+        tmpdir = tempfile.mkdtemp()
+        try:
+            with open(os.path.join(tmpdir, 'script.py'), 'w') as f:
+                f.write(script)
+            # The child files of another run are neither merged nor removed.
+            other_run = os.path.join(tmpdir, 'script.py.lprof.1')
+            line_profiler.LineProfiler().dump_stats(other_run)
+            env = dict(os.environ)
+            env['PYTHONPATH'] = os.pathsep.join(sys.path)
+            proc = subprocess.Popen([sys.executable, kernprof, '-l',
+                'script.py'], cwd=tmpdir, env=env, stdout=subprocess.PIPE)
+            out = proc.communicate()[0]
+            self.assertEqual(proc.returncode, 0)
+            # Only multiprocessing children get a SIGTERM handler.
+            self.assertIn(b'True', out)
+            lstats = line_profiler.load_stats(
+                os.path.join(tmpdir, 'script.py.lprof'))
+            self.assertEqual(len(lstats.processes), 2)
+            hits = sorted(
+                sum(nhits for lineno, nhits, time in timings)
+                for proc_stats in lstats.processes.values()
+                for timings in proc_stats.values())
+            self.assertEqual(hits, [1, 2])
+            timings = list(lstats.timings.values())[0]
+            self.assertEqual(timings[0][1], 3)
+            self.assertEqual(sorted(os.listdir(tmpdir)),
+                ['script.py', 'script.py.lprof', 'script.py.lprof.1'])
+        finally:
+            shutil.rmtree(tmpdir)
+
+    @unittest.skipUnless(hasattr(os, 'register_at_fork'), 'requires fork hooks')
+    def test_pool_worker_profiles(self):
+        import line_profiler
+
+        # The pool pickles functions by module and name, so they live in
+        # a module of their own.
+        module = (
+            "@profile\n"
+            "def f(x):\n"
+            "    return x + 1\n"
+            "def work(x):\n"
+            "    return f(x)\n"
+        )
+        # Leaving the with block terminates the workers with SIGTERM.
+        script = (
+            "import multiprocessing, work\n"
+            "ctx = multiprocessing.get_context('fork')\n"
+            "with ctx.Pool(4) as pool:\n"
+            "    pool.map(work.work, range(40), chunksize=1)\n"
+        )
+        kernprof = os.path.join(os.path.dirname(os.path.dirname(
+            os.path.abspath(__file__))), 'kernprof.py')
+        tmpdir = tempfile.mkdtemp()
+        try:
+            with open(os.path.join(tmpdir, 'work.py'), 'w') as f:
+                f.write(module)
+            with open(os.path.join(tmpdir, 'script.py'), 'w') as f:
+                f.write(script)
+            env = dict(os.environ)
+            env['PYTHONPATH'] = os.pathsep.join([tmpdir] + sys.path)
+            subprocess.check_call([sys.executable, kernprof, '-l', 'script.py'],
+                cwd=tmpdir, env=env, stdout=subprocess.PIPE)
+            lstats = line_profiler.load_stats(
+                os.path.join(tmpdir, 'script.py.lprof'))
+            self.assertEqual(len(lstats.processes), 5)
+            timings = list(lstats.timings.values())[0]
+            self.assertEqual(timings[0][1], 40)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    @unittest.skipUnless(hasattr(signal, 'SIGUSR1'), 'requires SIGUSR1')
+    def test_snapshots(self):
+        import line_profiler
+
+        script = (
+            "import os, signal\n"
+            "@profile\n"
+            "def f(x):\n"
+            "    return x + 1\n"
+            "f(1)\n"
+            "os.kill(os.getpid(), signal.SIGUSR1)\n"
+            "f(2)\n"
+            "f(3)\n"
+            "os.kill(os.getpid(), signal.SIGUSR1)\n"
+            "f(4)\n"
+        )
+        kernprof = os.path.join(os.path.dirname(os.path.dirname(
+            os.path.abspath(__file__))), 'kernprof.py')
+        tmpdir = tempfile.mkdtemp()
+        try:
+            with open(os.path.join(tmpdir, 'script.py'), 'w') as f:
+                f.write(script)
+            env = dict(os.environ)
+            env['PYTHONPATH'] = os.pathsep.join(sys.path)
+            subprocess.check_call([sys.executable, kernprof, '-l',
+                '--snapshot-signal', '--snapshot-reset', 'script.py'],
+                cwd=tmpdir, env=env, stdout=subprocess.PIPE)
+            hits = []
+            for name in ['script.py.lprof.snapshot-1',
+                    'script.py.lprof.snapshot-2', 'script.py.lprof']:
+                lstats = line_profiler.load_stats(os.path.join(tmpdir, name))
+                timings = list(lstats.timings.values())[0]
+                hits.append(timings[0][1])
+            self.assertEqual(hits, [1, 2, 1])
+            self.assertFalse([name for name in os.listdir(tmpdir)
+                if name.endswith('.tmp')])
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_prof_mod(self):
+        import line_profiler
+
+        package = (
+            "import functools\n"
+            "def deco(func):\n"
+            "    @functools.wraps(func)\n"
+            "    def wrapper(*args):\n"
+            "        return func(*args)\n"
+            "    return wrapper\n"
+            "@deco\n"
+            "def top(x):\n"
+            "    square = lambda v: v * v\n"
+            "    def inner(y):\n"
+            "        return sum(square(i) for i in range(y))\n"
+            "    return inner(x)\n"
+            "class K(object):\n"
+            "    @property\n"
+            "    def p(self):\n"
+            "        return 1\n"
+            "    @staticmethod\n"
+            "    def s():\n"
+            "        return 2\n"
+        )
+        script = (
+            "import sys\n"
+            "assert 'pkg' not in sys.modules\n"
+            "import pkg.mod\n"
+            "pkg.top(3), pkg.K().p, pkg.K.s(), pkg.mod.work()\n"
+        )
+        kernprof = os.path.join(os.path.dirname(os.path.dirname(
+            os.path.abspath(__file__))), 'kernprof.py')
+        tmpdir = tempfile.mkdtemp()
+        try:
+            os.mkdir(os.path.join(tmpdir, 'pkg'))
+            with open(os.path.join(tmpdir, 'pkg', '__init__.py'), 'w') as f:
+                f.write(package)
+            with open(os.path.join(tmpdir, 'pkg', 'mod.py'), 'w') as f:
+                f.write("def work():\n    return 4\n")
+            with open(os.path.join(tmpdir, 'script.py'), 'w') as f:
+                f.write(script)
+            env = dict(os.environ)
+            env['PYTHONPATH'] = os.pathsep.join(sys.path)
+            subprocess.check_call([sys.executable, kernprof, '-l',
+                '--prof-mod', 'pkg', 'script.py'],
+                cwd=tmpdir, env=env, stdout=subprocess.PIPE)
+            lstats = line_profiler.load_stats(
+                os.path.join(tmpdir, 'script.py.lprof'))
+            hit = set(name for (filename, lineno, name), timings in
+                lstats.timings.items() if timings)
+            self.assertTrue(set(['wrapper', 'top', '<lambda>', 'inner', 'p',
+                's', 'work']) <= hit)
+        finally:
+            shutil.rmtree(tmpdir)
+
     if PY35:
         import _test_kernprof_py35
         test_coroutine_decorator = _test_kernprof_py35.test_coroutine_decorator
@@ -1,6 +1,28 @@
+import gc
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import unittest
+import weakref
 
-from line_profiler import LineProfiler
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+import line_profiler
+from line_profiler import (ControlServer, LineProfiler, LineStats,
+    MappedLineStats, SourceCache, export_format, export_stats, is_lprof_file,
+    load_stats, merge_files, merge_stats, send_control, show_diff, show_text,
+    write_stats, write_text)
+from _line_profiler import (available_timers, histogram_percentile, label,
+    merge_timings, monitoring_available)
 
 
 def f(x):
@@ -13,6 +35,65 @@ def g(x):
     yield y + 20
 
 
+def countdown(n):
+    while n > 0:
+        n = (yield n) - 1
+
+
+def drain(generator):
+    value = next(generator)
+    try:
+        while True:
+            value = generator.send(value)
+    except StopIteration:
+        pass
+
+
+def busy(duration):
+    end = time.time() + duration
+    while time.time() < end:
+        pass
+
+
+def call_busy(duration):
+    busy(duration)
+    return duration
+
+
+def allocate(n):
+    size = len([0] * (4 * n))
+    kept = [0] * n
+    return kept
+
+
+def call_allocate(n):
+    kept = allocate(n)
+    return kept
+
+
+def combine(a, b):
+    out = [0] * len(a)
+    for i in range(len(a)):
+        out[i] = f(a[i]) * f(b[i])
+    return out
+
+
+# Kept in a string so that this module still compiles on Python 2.
+ASYNC_SOURCE = """
+import asyncio
+
+async def wait_and_spin(delay, duration):
+    await asyncio.sleep(delay)
+    busy(duration)
+
+async def run_tasks():
+    await asyncio.gather(
+        asyncio.ensure_future(wait_and_spin(0.05, 0.01)),
+        asyncio.get_event_loop().create_task(wait_and_spin(0.0, 0.03),
+            name='fast'))
+"""
+
+
 class TestLineProfiler(unittest.TestCase):
 
     def test_init(self):
@@ -21,13 +102,11 @@ class TestLineProfiler(unittest.TestCase):
         self.assertEqual(lp.code_map, {})
         lp = LineProfiler(f)
         self.assertEqual(lp.functions, [f])
-        self.assertEqual(lp.code_map, {f.__code__: {}})
+        self.assertEqual(list(lp.code_map), [f.__code__])
+        self.assertEqual(lp.code_map[f.__code__].astuples(), [])
         lp = LineProfiler(f, g)
         self.assertEqual(lp.functions, [f, g])
-        self.assertEqual(lp.code_map, {
-            f.__code__: {},
-            g.__code__: {},
-        })
+        self.assertEqual(set(lp.code_map), set([f.__code__, g.__code__]))
 
     def test_enable_disable(self):
         lp = LineProfiler()
@@ -70,10 +149,911 @@ class TestLineProfiler(unittest.TestCase):
         self.assertEqual(profile.enable_count, 0)
         self.assertEqual(value, f(10))
 
-        timings = profile.code_map[f.__code__]
+        timings = profile.code_map[f.__code__].astuples()
         self.assertEqual(len(timings), 2)
-        for timing in timings.values():
-            self.assertEqual(timing.nhits, 1)
+        for lineno, nhits, time in timings:
+            self.assertEqual(nhits, 1)
+
+    def test_sampled_decorator(self):
+        profile = LineProfiler()
+        f_wrapped = profile(every=10)(f)
+        self.assertEqual(f_wrapped.__name__, 'f')
+        self.assertEqual([f_wrapped(i) for i in range(25)],
+            [f(i) for i in range(25)])
+        self.assertEqual(profile.enable_count, 0)
+        self.assertEqual([nhits for lineno, nhits, time in
+            profile.code_map[f.__code__].astuples()], [3, 3])
+
+        g_wrapped = profile(g, every=2)
+        for i in range(4):
+            self.assertEqual(next(g_wrapped(i)), i + 10)
+        self.assertEqual([nhits for lineno, nhits, time in
+            profile.code_map[g.__code__].astuples()], [2])
+        with self.assertRaises(ValueError):
+            profile(g, threshold=0.1)
+        with self.assertRaises(ValueError):
+            profile(f, every=0)
+
+        # Only the calls that take at least the threshold are kept, with the
+        # calls that they make.
+        profile = LineProfiler(busy)
+        call_busy_wrapped = profile(call_busy, threshold=0.02)
+        for duration in [0.0, 0.03, 0.0, 0.0]:
+            call_busy_wrapped(duration)
+        self.assertEqual(profile.enable_count, 0)
+        lstats = profile.get_stats()
+        timings = lstats.timings[label(call_busy.__code__)]
+        self.assertEqual([nhits for lineno, nhits, time in timings], [1, 1])
+        self.assertTrue(timings[0][2] * lstats.unit >= 0.03)
+        self.assertEqual(lstats.timings[label(busy.__code__)][0][1], 1)
+
+    def test_wrappers(self):
+        profile = LineProfiler()
+        closed = []
+
+        def echo():
+            try:
+                while True:
+                    try:
+                        yield 1
+                    except ValueError:
+                        yield 'caught'
+            finally:
+                closed.append(True)
+
+        i = profile(echo)()
+        self.assertEqual(next(i), 1)
+        self.assertEqual(i.throw(ValueError), 'caught')
+        self.assertEqual(profile.enable_count, 0)
+        i.close()
+        self.assertEqual(closed, [True])
+        self.assertEqual(profile.enable_count, 0)
+
+        class Adder(object):
+            def add(self, x):
+                return x + 1
+            add = profile(add)
+        self.assertEqual(Adder().add(1), 2)
+        self.assertEqual(Adder.add.__name__, 'add')
+        self.assertEqual(len(profile.code_map[Adder.add.func.__code__]
+            .astuples()), 1)
+
+    def test_get_stats(self):
+        profile = LineProfiler()
+        f_wrapped = profile(f)
+        for i in range(3):
+            f_wrapped(i)
+        lstats = profile.get_stats()
+        self.assertEqual(lstats.unit, profile.timer_unit)
+        timings = lstats.timings[f.__code__.co_filename,
+            f.__code__.co_firstlineno, 'f']
+        self.assertEqual([lineno for lineno, nhits, time in timings],
+            [f.__code__.co_firstlineno + 1, f.__code__.co_firstlineno + 2])
+        self.assertEqual([nhits for lineno, nhits, time in timings], [3, 3])
+
+        key = label(f.__code__)
+        with profile:
+            lstats = profile.get_stats(reset=True)
+            f(1)
+        self.assertEqual([nhits for lineno, nhits, time in
+            lstats.timings[key]], [3, 3])
+        self.assertEqual([nhits for lineno, nhits, time in
+            profile.get_stats().timings[key]], [1, 1])
+
+    def test_timers(self):
+        timers = available_timers()
+        self.assertTrue(len(timers) >= 1)
+        for timer in timers:
+            profile = LineProfiler(timer=timer)
+            self.assertEqual(profile.timer, timer)
+            self.assertTrue(0 < profile.timer_unit < 1e-3)
+            f_wrapped = profile(f)
+            f_wrapped(10)
+            self.assertEqual(profile.get_stats().unit, profile.timer_unit)
+        self.assertEqual(LineProfiler().timer, timers[0])
+        with self.assertRaises(ValueError):
+            LineProfiler(timer='sundial')
+
+    def test_calibrate(self):
+        profile = LineProfiler()
+        overhead = profile.calibrate(number=1000, repeat=2)
+        self.assertTrue(overhead >= 0)
+        self.assertEqual(profile.overhead, overhead)
+        f_wrapped = profile(f)
+        f_wrapped(10)
+        lstats = profile.get_stats()
+        self.assertEqual(lstats.overhead, overhead)
+        corrected = lstats.corrected_timings()
+        for key, timings in lstats.timings.items():
+            for raw, fixed in zip(timings, corrected[key]):
+                self.assertEqual(raw[:2], fixed[:2])
+                self.assertTrue(0 <= fixed[2] <= raw[2])
+
+        lstats.overhead = 1.0
+        stream = StringIO()
+        show_text(lstats.timings, lstats.unit, stream=stream,
+            overhead=lstats.overhead)
+        self.assertIn('Corrected', stream.getvalue())
+        self.assertIn('Tracer overhead', stream.getvalue())
+
+        with profile:
+            with self.assertRaises(RuntimeError):
+                profile.calibrate()
+        with self.assertRaises(ValueError):
+            profile.calibrate(repeat=0)
+
+    @unittest.skipUnless(sys.version_info >= (3, 9), 'needs Python 3.9+')
+    def test_calibrate_options(self):
+        # The calibration is traced with the profiler's own options, and
+        # tracking memory costs far more than plain tracing.
+        plain = LineProfiler().calibrate(number=20000, repeat=3)
+        memory = LineProfiler(memory=True).calibrate(number=20000, repeat=3)
+        self.assertTrue(memory > 1.5 * plain)
+
+    def test_all_threads(self):
+        profile = LineProfiler(f, all_threads=True)
+        started = threading.Event()
+        go = threading.Event()
+
+        def target():
+            started.set()
+            go.wait()
+            for i in range(5):
+                f(i)
+
+        # One thread exists before the profiler is enabled, one is started
+        # after.
+        before = threading.Thread(target=target)
+        before.start()
+        started.wait()
+        profile.enable_by_count()
+        try:
+            after = threading.Thread(target=target)
+            after.start()
+            go.set()
+            before.join()
+            after.join()
+            f(0)
+        finally:
+            profile.disable_by_count()
+
+        lstats = profile.get_stats()
+        key = (f.__code__.co_filename, f.__code__.co_firstlineno, 'f')
+        self.assertEqual([nhits for lineno, nhits, time in lstats.timings[key]],
+            [11, 11])
+        per_thread = sorted(
+            sum(nhits for lineno, nhits, time in stats[key]) // 2
+            for stats in lstats.threads.values())
+        self.assertEqual([n for n in per_thread if n], [1, 5, 5])
+
+    def test_all_threads_reused_ids(self):
+        # Short-lived threads often get the id of the thread before them, but
+        # each one is still reported on its own.
+        engines = ['settrace'] + (['monitoring'] if monitoring_available()
+            else [])
+        for engine in engines:
+            profile = LineProfiler(f, engine=engine, all_threads=True)
+            with profile:
+                for i in range(9):
+                    thread = threading.Thread(target=f, args=(i,))
+                    thread.start()
+                    thread.join()
+            lstats = profile.get_stats()
+            key = label(f.__code__)
+            per_thread = [
+                sum(nhits for lineno, nhits, time in stats[key]) // 2
+                for stats in lstats.threads.values()]
+            self.assertEqual([n for n in per_thread if n], [1] * 9)
+
+    @unittest.skipUnless(sys.version_info >= (3, 7), 'requires -X dev')
+    def test_all_threads_running_threads(self):
+        # Installing the tracer on threads that are already running Python
+        # code must not touch their thread states from another thread, which
+        # the debug checks of -X dev abort on.
+        script = (
+            'import threading\n'
+            'from line_profiler import LineProfiler\n'
+            'def f(x):\n'
+            '    return x + 1\n'
+            'stop = threading.Event()\n'
+            'def spin():\n'
+            '    while not stop.is_set():\n'
+            '        f(0)\n'
+            'threads = [threading.Thread(target=spin) for i in range(3)]\n'
+            'for thread in threads:\n'
+            '    thread.start()\n'
+            'profile = LineProfiler(f, engine="settrace", all_threads=True)\n'
+            'profile.enable()\n'
+            'stop.wait(0.1)\n'
+            'profile.disable()\n'
+            'stop.set()\n'
+            'for thread in threads:\n'
+            '    thread.join()\n'
+            'timings = profile.get_stats().threads.values()\n'
+            'print(len([t for t in timings if any(t.values())]))\n'
+        )
+        env = dict(os.environ, PYTHONPATH=os.path.dirname(
+            os.path.abspath(line_profiler.__file__)))
+        output = subprocess.check_output(
+            [sys.executable, '-X', 'dev', '-c', script], env=env)
+        self.assertEqual(int(output), 3)
+
+    def test_merge_stats(self):
+        key = ('file.py', 1, 'func')
+        a = LineStats({key: [(2, 1, 10), (3, 2, 20)]}, 1e-6)
+        b = LineStats({key: [(3, 1, 1000)], ('file.py', 9, 'other'): []}, 1e-9)
+        merged = merge_stats([a, b], [100, 200])
+        self.assertEqual(merged.unit, 1e-9)
+        self.assertEqual(merged.timings, {
+            key: [(2, 1, 10000), (3, 3, 21000)],
+            ('file.py', 9, 'other'): [],
+        })
+        self.assertEqual(merged.processes[100], {
+            key: [(2, 1, 10000), (3, 2, 20000)],
+        })
+        self.assertEqual(merged.processes[200], b.timings)
+        self.assertIsNone(merged.sample_interval)
+
+    def test_merge_sampled_stats(self):
+        key = ('file.py', 1, 'func')
+        a = LineStats({key: [(2, 1, 10)]}, 1e-6, sample_interval=0.001)
+        b = LineStats({key: [(2, 2, 20)]}, 1e-6, sample_interval=0.001)
+        merged = merge_stats([a, b])
+        self.assertEqual(merged.sample_interval, 0.001)
+        self.assertEqual(merged.timings, {key: [(2, 3, 30)]})
+        c = LineStats({key: [(2, 1, 10)]}, 1e-6, sample_interval=0.01)
+        with self.assertRaises(ValueError):
+            merge_stats([a, c])
+        with self.assertRaises(ValueError):
+            merge_stats([a, LineStats({key: [(2, 1, 10)]}, 1e-6)])
+
+    def test_merge_files(self):
+        key = ('file.py', 1, 'func')
+        tmpdir = tempfile.mkdtemp()
+        try:
+            filenames = []
+            for i, unit in enumerate([1e-6, 1e-9, 1e-6, 1e-9, 1e-6]):
+                filenames.append(os.path.join(tmpdir, '%d.lprof' % i))
+                write_stats(LineStats({key: [(2, 1, 1), (3, i, 2)]}, unit),
+                    filenames[-1])
+            expected = {key: [(2, 5, 3002), (3, 10, 6004)]}
+            for jobs in [1, 2]:
+                merged = merge_files(filenames, jobs=jobs, chunk_size=2)
+                self.assertEqual(merged.unit, 1e-9)
+                self.assertEqual(merged.timings, expected)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_diff(self):
+        base_key = ('file.py', 1, 'func')
+        new_key = ('file.py', 11, 'func')
+        base = LineStats({base_key: [(2, 1, 100), (3, 1, 100)]}, 1e-6,
+            sources={base_key: ['def func():', '    a()', '    b()']})
+        new = LineStats(
+            {new_key: [(12, 1, 5000), (13, 1, 100000), (14, 1, 300000)]},
+            1e-9, sources={
+                new_key: ['def func():', '    x()', '    a()', '    b()']})
+        diff = base.diff(new)
+        self.assertEqual(diff.unit, 1e-9)
+        self.assertEqual(diff.functions,
+            [(base_key, new_key, 2, 3, 200000, 405000)])
+        self.assertEqual(diff.lines, [
+            (base_key, new_key, 3, 14, 1, 1, 100000, 300000),
+            (base_key, new_key, None, 12, 0, 1, 0, 5000),
+            (base_key, new_key, 2, 13, 1, 1, 100000, 100000),
+        ])
+        self.assertEqual(diff.regressions(0.5), diff.lines[:2])
+        self.assertEqual(diff.regressions(0.5, min_time=1e-5), diff.lines[:1])
+        self.assertEqual(diff.regressions(3.0), diff.lines[1:2])
+
+        # Without the sources, lines are matched by their offset.
+        base.sources = None
+        diff = base.diff(new)
+        self.assertEqual(sorted(diff.lines, key=lambda line: line[3]), [
+            (base_key, new_key, 2, 12, 1, 1, 100000, 5000),
+            (base_key, new_key, 3, 13, 1, 1, 100000, 100000),
+            (base_key, new_key, None, 14, 0, 1, 0, 300000),
+        ])
+
+        stream = StringIO()
+        show_diff(diff, stream=stream)
+        self.assertIn('func at file.py:11', stream.getvalue())
+
+    def test_exclusive(self):
+        profile = LineProfiler(call_busy)
+        profile.runcall(call_busy, 0.01)
+        self.assertEqual(profile.get_stats().self_timings, None)
+
+        for mode in ['trace', 'sample']:
+            profile = LineProfiler(busy, call_busy, mode=mode, exclusive=True)
+            profile.runcall(call_busy, 0.1)
+            lstats = profile.get_stats()
+            call_line = call_busy.__code__.co_firstlineno + 1
+            for timings in [lstats.timings, lstats.self_timings]:
+                self.assertEqual(
+                    [lineno for lineno, nhits, time in timings[label(
+                        call_busy.__code__)]][:1], [call_line])
+            call_time = lstats.timings[label(call_busy.__code__)][0][2]
+            call_self_time = lstats.self_timings[label(call_busy.__code__)][0][2]
+            self.assertTrue(call_time * lstats.unit > 0.05)
+            self.assertTrue(call_self_time * lstats.unit < 0.02)
+            self.assertEqual(
+                sum(time for lineno, nhits, time in
+                    lstats.self_timings[label(busy.__code__)]),
+                sum(time for lineno, nhits, time in
+                    lstats.timings[label(busy.__code__)]))
+
+            stream = StringIO()
+            profile.print_stats(stream=stream)
+            self.assertIn('Self', stream.getvalue())
+
+    def test_histogram(self):
+        with self.assertRaises(ValueError):
+            LineProfiler(mode='sample', histogram=True)
+        profile = LineProfiler(f, histogram=True)
+        for x in range(100):
+            profile.runcall(f, x)
+        lstats = profile.get_stats()
+        timings = lstats.timings[label(f.__code__)]
+        histograms = lstats.histograms[label(f.__code__)]
+        self.assertEqual([entry[0] for entry in histograms],
+            [lineno for lineno, nhits, time in timings])
+        for (lineno, min_time, max_time, counts), (_, nhits, time) in zip(
+                histograms, timings):
+            self.assertEqual(sum(counts), nhits)
+            self.assertTrue(min_time <= max_time)
+            self.assertTrue(min_time * nhits <= time <= max_time * nhits)
+            p50 = histogram_percentile(counts, 0.5, min_time, max_time)
+            p99 = histogram_percentile(counts, 0.99, min_time, max_time)
+            self.assertTrue(min_time <= p50 <= p99 <= max_time)
+
+        merged = merge_stats([lstats, lstats])
+        self.assertEqual(merged.histograms[label(f.__code__)],
+            [(lineno, min_time, max_time, tuple(2 * c for c in counts))
+                for lineno, min_time, max_time, counts in histograms])
+
+        stream = StringIO()
+        profile.print_stats(stream=stream)
+        self.assertIn('p99', stream.getvalue())
+
+    @unittest.skipUnless(sys.version_info >= (3, 9), 'needs Python 3.9+')
+    def test_memory(self):
+        import tracemalloc
+        with self.assertRaises(ValueError):
+            LineProfiler(mode='sample', memory=True)
+        n = 100000
+        profile = LineProfiler(allocate, call_allocate, memory=True)
+        profile.runcall(call_allocate, n)
+        self.assertFalse(tracemalloc.is_tracing())
+        lstats = profile.get_stats()
+        line = allocate.__code__.co_firstlineno
+        memory = dict((lineno, (allocated, retained)) for lineno, allocated,
+            retained in lstats.memory[label(allocate.__code__)])
+        self.assertEqual(sorted(memory), [line + 1, line + 2, line + 3])
+        # The temporary list is freed within its line.
+        self.assertTrue(memory[line + 1][0] >= 32 * n)
+        self.assertTrue(memory[line + 1][1] < n)
+        self.assertTrue(memory[line + 2][1] >= 8 * n)
+        # The caller's line includes the peak within the profiled callee.
+        line = call_allocate.__code__.co_firstlineno
+        allocated, retained = dict((lineno, (allocated, retained))
+            for lineno, allocated, retained in
+            lstats.memory[label(call_allocate.__code__)])[line + 1]
+        self.assertTrue(allocated >= 32 * n)
+        self.assertTrue(retained >= 8 * n)
+
+        merged = merge_stats([lstats, lstats])
+        self.assertEqual(merged.memory[label(allocate.__code__)],
+            [(lineno, 2 * allocated, 2 * retained) for lineno, allocated,
+                retained in lstats.memory[label(allocate.__code__)]])
+        stream = StringIO()
+        profile.print_stats(stream=stream)
+        self.assertIn('Alloc', stream.getvalue())
+        self.assertIn('KiB', stream.getvalue())
+
+    def test_add_package(self):
+        sys.modules.pop('json.tool', None)
+        profile = LineProfiler()
+        try:
+            self.assertTrue(profile.add_package('json') > 0)
+            import json.decoder
+            self.assertIn(json.decoder.JSONDecoder.decode.__code__,
+                profile.code_map)
+            # Submodules are only added when they are imported.
+            self.assertNotIn('json.tool', sys.modules)
+            import json.tool
+            self.assertIn(json.tool.main.__code__, profile.code_map)
+            self.assertIs(json.tool.__loader__, json.tool.__spec__.loader)
+        finally:
+            sys.meta_path.remove(profile.import_hook)
+        profile = LineProfiler()
+        self.assertEqual(profile.add_package('line_profiler_missing'), 0)
+        sys.meta_path.remove(profile.import_hook)
+
+    @unittest.skipIf(sys.version_info < (3, 7), "Needs opcode events.")
+    def test_instructions(self):
+        with self.assertRaises(ValueError):
+            LineProfiler(mode='sample').add_line(combine,
+                combine.__code__.co_firstlineno + 3)
+        profile = LineProfiler()
+        with self.assertRaises(ValueError):
+            profile.add_line(combine, combine.__code__.co_firstlineno + 10)
+        line = combine.__code__.co_firstlineno + 3
+        engines = ['settrace'] + (['monitoring'] if monitoring_available()
+            else [])
+        for engine in engines:
+            profile = LineProfiler(engine=engine)
+            profile.add_line(combine, line)
+            self.assertEqual(profile.instruction_lines,
+                {combine.__code__: set([line])})
+            profile.runcall(combine, [1, 2, 3], [4, 5, 6])
+            lstats = profile.get_stats()
+            key = label(combine.__code__)
+            instructions = lstats.instructions[key]
+            self.assertTrue(instructions)
+            self.assertEqual(set(entry[0] for entry in instructions),
+                set([line]))
+            opnames = [entry[2] for entry in instructions]
+            self.assertEqual([entry[5] for entry in instructions],
+                [3] * len(instructions))
+            self.assertTrue(any(opname.startswith('CALL')
+                for opname in opnames))
+            self.assertTrue(any(opname.startswith('BINARY')
+                for opname in opnames))
+            line_time = dict((lineno, time) for lineno, nhits, time in
+                lstats.timings[key])[line]
+            self.assertTrue(sum(entry[6] for entry in instructions) <=
+                line_time)
+            if sys.version_info >= (3, 11):
+                source = 'out[i] = f(a[i]) * f(b[i])'
+                calls = [source[entry[3] - 8:entry[4] - 8]
+                    for entry in instructions if entry[2] == 'CALL']
+                self.assertEqual(calls, ['f(a[i])', 'f(b[i])'])
+
+            merged = merge_stats([lstats, lstats])
+            self.assertEqual([entry[5] for entry in merged.instructions[key]],
+                [6] * len(instructions))
+            stream = StringIO()
+            profile.print_stats(stream=stream)
+            self.assertIn('@%d %s' % instructions[0][1:3], stream.getvalue())
+            profile.reset_stats()
+            self.assertEqual(profile.get_stats().instructions, {key: []})
+
+    def test_render(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmpdir, 'module.py')
+            with open(filename, 'w') as f:
+                for i in range(20):
+                    f.write('def func_%d(x):\n    y = x + 1\n'
+                        '    return y\n\n' % i)
+            cache = SourceCache()
+            self.assertEqual(cache.function_lines(filename, 5),
+                ['def func_1(x):\n', '    y = x + 1\n', '    return y\n'])
+            self.assertEqual(cache.function_lines(filename + 'c', 1), None)
+            with open(filename, 'w') as f:
+                f.write('def changed(x):\n    return x\n')
+            # Files are only checked again after a refresh.
+            self.assertEqual(len(cache.function_lines(filename, 1)), 3)
+            cache.refresh()
+            self.assertEqual(cache.function_lines(filename, 1),
+                ['def changed(x):\n', '    return x\n'])
+
+            with open(filename, 'w') as f:
+                for i in range(20):
+                    f.write('def func_%d(x):\n    y = x + 1\n'
+                        '    return y\n\n' % i)
+            timings = {}
+            for i in range(20):
+                timings[filename, 4 * i + 1, 'func_%d' % i] = [
+                    (4 * i + 2, 1, 10 * i + 1), (4 * i + 3, 1, 5)]
+            lstats = LineStats(timings, 1e-9)
+            expected = StringIO()
+            show_text(lstats.timings, lstats.unit, stream=expected)
+            self.assertIn('    return y', expected.getvalue())
+            for jobs in [1, 2]:
+                stream = StringIO()
+                write_text(lstats, stream, jobs=jobs, chunk_size=3)
+                self.assertEqual(stream.getvalue(), expected.getvalue())
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_top_lines(self):
+        timings = {
+            ('a.py', 1, 'f'): [(2, 1, 50), (3, 10, 30)],
+            ('b.py', 5, 'g'): [(6, 2, 15), (7, 1, 5)],
+        }
+        self_timings = {
+            ('a.py', 1, 'f'): [(2, 1, 10), (3, 10, 30)],
+            ('b.py', 5, 'g'): [(6, 2, 15), (7, 1, 5)],
+        }
+
+        def locations(**kwds):
+            stream = StringIO()
+            show_text(timings, 1e-6, stream=stream, **kwds)
+            return [line.split()[-2] for line in
+                stream.getvalue().splitlines() if line.strip()[:1].isdigit()]
+
+        self.assertEqual(locations(top=2), ['a.py:2', 'a.py:3'])
+        self.assertEqual(locations(top=10), ['a.py:2', 'a.py:3', 'b.py:6',
+            'b.py:7'])
+        # The line that crosses the cutoff is included.
+        self.assertEqual(locations(cumulative=60), ['a.py:2', 'a.py:3'])
+        self.assertEqual(locations(top=2, sort='per_hit'), ['a.py:2',
+            'b.py:6'])
+        self.assertEqual(locations(top=1, sort='self',
+            self_timings=self_timings), ['a.py:3'])
+        self.assertRaises(ValueError, locations, top=1, sort='self')
+        self.assertRaises(ValueError, locations, top=1, sort='name')
+
+    def test_export(self):
+        key = ('file.py', 1, 'func')
+        other = ('file.py', 9, 'func')
+        lstats = LineStats({key: [(3, 2, 20), (2, 1, 10)], other: [(10, 1, 5)]},
+            0.5, self_timings={key: [(2, 1, 10), (3, 2, 4)], other: []})
+        self.assertEqual(export_format('out.speedscope.json'), 'speedscope')
+        self.assertEqual(export_format('out.json'), 'json')
+        self.assertEqual(export_format('callgrind.out.123'), 'callgrind')
+        self.assertEqual(export_format('out.txt'), None)
+        tmpdir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmpdir, 'out.json')
+            export_stats(lstats, filename)
+            with open(filename) as f:
+                exported = json.load(f)
+            self.assertEqual(exported['unit'], 0.5)
+            self.assertEqual(exported['functions'][0]['lines'], [
+                {'lineno': 2, 'hits': 1, 'time': 5.0, 'self_time': 5.0},
+                {'lineno': 3, 'hits': 2, 'time': 10.0, 'self_time': 2.0}])
+
+            filename = os.path.join(tmpdir, 'out.ndjson')
+            export_stats(lstats, filename)
+            with open(filename) as f:
+                records = [json.loads(line) for line in f]
+            self.assertEqual([(r['first_lineno'], r['lineno'], r['self_time'])
+                for r in records], [(1, 2, 5.0), (1, 3, 2.0), (9, 10, 0)])
+
+            filename = os.path.join(tmpdir, 'out.speedscope.json')
+            export_stats(lstats, filename)
+            with open(filename) as f:
+                profile = json.load(f)
+            frames = profile['shared']['frames']
+            self.assertEqual([frame['line'] for frame in frames],
+                [1, 2, 3, 9, 10])
+            self.assertEqual(profile['profiles'][0]['samples'],
+                [[0, 1], [0, 2], [3, 4]])
+            self.assertEqual(len(profile['profiles'][0]['weights']), 3)
+
+            filename = os.path.join(tmpdir, 'out')
+            export_stats(lstats, filename, format='callgrind')
+            with open(filename) as f:
+                callgrind = f.read()
+            # Functions with the same name are told apart by their first line.
+            self.assertIn('fl=file.py\nfn=func:1\n2 10 1 10\n3 20 2 4\n',
+                callgrind)
+            self.assertIn('fn=func:9\n10 5 1 0\n', callgrind)
+            self.assertIn('totals: 35 4 14\n', callgrind)
+            self.assertRaises(ValueError, export_stats, lstats, filename)
+            self.assertRaises(ValueError, export_stats, lstats, filename,
+                format='pstats')
+        finally:
+            shutil.rmtree(tmpdir)
+
+    @unittest.skipUnless(hasattr(socket, 'AF_UNIX'), 'needs Unix sockets')
+    def test_control(self):
+        profile = LineProfiler(all_threads=True)
+        tmpdir = tempfile.mkdtemp()
+        path = os.path.join(tmpdir, 'control.sock')
+        server = ControlServer(profile, path)
+        server.start()
+        try:
+            self.assertEqual(os.stat(path).st_mode & 0o777, 0o600)
+            self.assertEqual(send_control(path, 'status'),
+                'disabled, enable count 0, 0 functions')
+            self.assertEqual(send_control(path, 'add', __name__ + '.f'),
+                'added 1 functions')
+            self.assertEqual(profile.functions, [f])
+            send_control(path, 'enable')
+            f(1)
+            send_control(path, 'disable')
+            f(2)
+            self.assertEqual(profile.enable_count, 0)
+
+            filename = os.path.join(tmpdir, 'stats.lprof')
+            with open(filename, 'wb') as stats:
+                stats.write(send_control(path, 'stats'))
+            timings = load_stats(filename).timings[label(f.__code__)]
+            self.assertEqual([nhits for lineno, nhits, time in timings],
+                [1, 1])
+            send_control(path, 'reset')
+            self.assertEqual(profile.get_stats().timings[label(f.__code__)],
+                [])
+
+            send_control(path, 'enable', '0.05')
+            self.assertEqual(profile.enable_count, 1)
+            time.sleep(0.5)
+            self.assertEqual(profile.enable_count, 0)
+            with self.assertRaises(RuntimeError):
+                send_control(path, 'rewind')
+            with self.assertRaises(RuntimeError):
+                send_control(path, 'add', 'no_such_module.f')
+            send_control(path, 'enable')
+        finally:
+            server.stop()
+            shutil.rmtree(tmpdir)
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual(profile.enable_count, 0)
+
+    @unittest.skipUnless(hasattr(socket, 'AF_UNIX'), 'needs Unix sockets')
+    def test_control_idle_client(self):
+        profile = LineProfiler(all_threads=True)
+        tmpdir = tempfile.mkdtemp()
+        path = os.path.join(tmpdir, 'control.sock')
+        server = ControlServer(profile, path, timeout=0.1)
+        server.start()
+        idle = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            idle.connect(path)
+            # The idle client is dropped and the next one is served.
+            self.assertEqual(send_control(path, 'status'),
+                'disabled, enable count 0, 0 functions')
+            idle.settimeout(5)
+            self.assertEqual(idle.recv(1), b'')
+        finally:
+            idle.close()
+            server.stop()
+            shutil.rmtree(tmpdir)
+
+    def test_binary_format(self):
+        key = ('file.py', 1, 'func')
+        other = (u'caf\xe9.py', 9, 'other')
+        lstats = LineStats({key: [(2, 1, 10), (3, 2, 20)], other: []}, 1e-9,
+            overhead=0.5, processes={100: {key: [(2, 1, 10)]}},
+            threads={(7, 'worker'): {key: [(2, 1, 10)]}},
+            sources={key: ['def func():', '', u'    return "caf\xe9"']},
+            histograms={key: [(2, 10, 10, [0, 0, 0, 1])]})
+        tmpdir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmpdir, 'test.lprof')
+            write_stats(lstats, filename)
+            self.assertTrue(is_lprof_file(filename))
+            loaded = load_stats(filename)
+            self.assertEqual(loaded.timings, lstats.timings)
+            self.assertEqual(loaded.unit, 1e-9)
+            self.assertEqual(loaded.overhead, 0.5)
+            self.assertEqual(loaded.processes, lstats.processes)
+            self.assertEqual(loaded.threads, lstats.threads)
+            self.assertEqual(loaded.sources, lstats.sources)
+            self.assertEqual(loaded.histograms, lstats.histograms)
+            self.assertEqual(loaded.self_timings, None)
+
+            with MappedLineStats(filename) as mapped:
+                self.assertEqual(sorted(mapped.keys()), sorted([key, other]))
+                self.assertEqual(mapped.records(key), [(2, 1, 10), (3, 2, 20)])
+                self.assertEqual(mapped.records(other), [])
+                self.assertEqual(mapped.processes, lstats.processes)
+                # The sources are kept out of the extras.
+                self.assertNotIn('sources', mapped.extras)
+                self.assertEqual(mapped.source(key), lstats.sources[key])
+                self.assertEqual(mapped.source(other), None)
+                try:
+                    import numpy
+                except ImportError:
+                    pass
+                else:
+                    self.assertEqual(mapped.array(key).tolist(),
+                        [[2, 1, 10], [3, 2, 20]])
+                    self.assertEqual(mapped.array().shape, (2, 3))
+
+            write_stats(lstats, filename, legacy=True)
+            self.assertFalse(is_lprof_file(filename))
+            self.assertEqual(load_stats(filename).timings, lstats.timings)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_sample_mode(self):
+        with self.assertRaises(ValueError):
+            LineProfiler(mode='guess')
+        profile = LineProfiler(busy, mode='sample', interval=0.001)
+        profile.runcall(busy, 0.2)
+        lstats = profile.get_stats()
+        self.assertEqual(lstats.sample_interval, 0.001)
+        key = (busy.__code__.co_filename, busy.__code__.co_firstlineno, 'busy')
+        timings = lstats.timings[key]
+        self.assertTrue(timings)
+        nsamples = sum(nhits for lineno, nhits, time in timings)
+        self.assertTrue(nsamples > 10)
+        total_time = sum(time for lineno, nhits, time in timings) * lstats.unit
+        self.assertTrue(0.05 < total_time < 0.4)
+        # Nothing is recorded while disabled.
+        busy(0.05)
+        self.assertEqual(
+            sum(nhits for lineno, nhits, time in profile.get_stats().timings[key]),
+            nsamples)
+
+    @unittest.skipUnless(sys.version_info >= (3, 8), 'requires task names')
+    def test_asyncio(self):
+        import asyncio
+        with self.assertRaises(ValueError):
+            LineProfiler(mode='sample', asyncio=True)
+        ns = {'busy': busy}
+        exec(ASYNC_SOURCE, ns)
+        wait_and_spin = ns['wait_and_spin']
+        key = label(wait_and_spin.__code__)
+        await_line = wait_and_spin.__code__.co_firstlineno + 1
+        busy_line = await_line + 1
+        profile = LineProfiler(wait_and_spin, per_task=True)
+        self.assertTrue(profile.asyncio)
+        with profile:
+            asyncio.run(ns['run_tasks']())
+        self.assertEqual(profile.last_time, {})
+        lstats = profile.get_stats()
+        timings = dict((lineno, (nhits, time))
+            for lineno, nhits, time in lstats.timings[key])
+        # Resuming after the await does not count as another hit, and the
+        # sleep is not charged to the await line.
+        self.assertEqual(timings[await_line][0], 2)
+        self.assertEqual(timings[busy_line][0], 2)
+        self.assertTrue(timings[await_line][1] * lstats.unit < 0.02)
+
+        self.assertEqual(len(lstats.tasks), 2)
+        self.assertEqual(merge_timings(list(lstats.tasks.values())),
+            lstats.timings)
+        fast_busy = dict((lineno, time) for lineno, nhits, time in
+            lstats.tasks['fast'][key])[busy_line]
+        self.assertTrue(fast_busy * lstats.unit > 0.02)
+        self.assertTrue(fast_busy > timings[busy_line][1] / 2)
+
+    @unittest.skipUnless(sys.version_info >= (3, 7), 'requires f_trace_lines')
+    def test_unregistered_frames_skip_line_events(self):
+        def unregistered():
+            return sys._getframe().f_trace_lines
+
+        def registered():
+            return sys._getframe().f_trace_lines, unregistered()
+
+        profile = LineProfiler(registered, engine='settrace')
+        self.assertEqual(profile.runcall(registered), (True, False))
+        self.assertEqual(registered(), (True, True))
+
+        # A frame that keeps running after the profiler is disabled gets its
+        # line events back.
+        for all_threads in [False, True]:
+            profile = LineProfiler(registered, engine='settrace',
+                all_threads=all_threads)
+
+            def outlives_profiler():
+                profile.disable()
+                return sys._getframe().f_trace_lines
+
+            profile.enable()
+            self.assertTrue(outlives_profiler())
+
+    def test_engine(self):
+        with self.assertRaises(ValueError):
+            LineProfiler(engine='pdb')
+        engines = ['settrace']
+        if monitoring_available():
+            self.assertEqual(LineProfiler().engine, 'monitoring')
+            engines.append('monitoring')
+        else:
+            self.assertEqual(LineProfiler().engine, 'settrace')
+        for engine in engines:
+            profile = LineProfiler(f, engine=engine)
+            self.assertEqual(profile.engine, engine)
+            profile.runcall(f, 10)
+            profile.runcall(f, 10)
+            timings = profile.code_map[f.__code__].astuples()
+            self.assertEqual([nhits for lineno, nhits, time in timings],
+                [2, 2])
+
+    @unittest.skipUnless(monitoring_available(), 'requires sys.monitoring')
+    def test_monitoring_events(self):
+        # The events of a function stay switched on while its profiler lives,
+        # but only count while the profiler is enabled.
+        def local_events(code):
+            for tool_id in range(6):
+                if sys.monitoring.get_tool(tool_id) == 'line_profiler':
+                    return sys.monitoring.get_local_events(tool_id, code)
+            return 0
+
+        profile = LineProfiler(f, engine='monitoring')
+        self.assertNotEqual(local_events(f.__code__), 0)
+        f(1)
+        profile.runcall(f, 2)
+        f(3)
+        timings = profile.code_map[f.__code__].astuples()
+        self.assertEqual([nhits for lineno, nhits, time in timings], [1, 1])
+        del profile
+        gc.collect()
+        self.assertEqual(local_events(f.__code__), 0)
+
+    @unittest.skipUnless(monitoring_available(), 'requires sys.monitoring')
+    def test_monitoring_add_line(self):
+        # Adding a line re-arms the instruction events of its code object for
+        # line_profiler, but not those that another tool disabled.
+        monitoring = sys.monitoring
+        tool_id = [tool_id for tool_id in (0, 1, 5)
+            if monitoring.get_tool(tool_id) is None][0]
+        calls = []
+
+        def instruction(code, offset):
+            calls.append(offset)
+            return monitoring.DISABLE
+
+        monitoring.use_tool_id(tool_id, 'test')
+        try:
+            monitoring.register_callback(tool_id,
+                monitoring.events.INSTRUCTION, instruction)
+            monitoring.set_local_events(tool_id, f.__code__,
+                monitoring.events.INSTRUCTION)
+            first = f.__code__.co_firstlineno
+            profile = LineProfiler(engine='monitoring')
+            profile.add_line(f, first + 1)
+            profile.runcall(f, 1)
+            ncalls = len(calls)
+            profile.add_line(f, first + 2)
+            profile.runcall(f, 2)
+            self.assertEqual(len(calls), ncalls)
+            instructions = profile.get_stats().instructions[label(f.__code__)]
+            self.assertEqual(sorted(set(entry[0] for entry in instructions)),
+                [first + 1, first + 2])
+        finally:
+            monitoring.set_local_events(tool_id, f.__code__, 0)
+            monitoring.register_callback(tool_id,
+                monitoring.events.INSTRUCTION, None)
+            monitoring.free_tool_id(tool_id)
+
+    @unittest.skipUnless(monitoring_available(), 'requires sys.monitoring')
+    def test_monitoring_tool_id(self):
+        # The standard profilers keep their tool id, and line_profiler gives
+        # its own back once nothing is monitored.
+        import cProfile
+
+        profile = LineProfiler(f, engine='monitoring')
+        self.assertEqual(sys.monitoring.get_tool(sys.monitoring.PROFILER_ID),
+            None)
+        cprofile = cProfile.Profile()
+        cprofile.enable()
+        try:
+            profile.runcall(f, 1)
+        finally:
+            cprofile.disable()
+        del profile
+        gc.collect()
+        self.assertNotIn('line_profiler',
+            [sys.monitoring.get_tool(tool_id) for tool_id in range(6)])
+
+    def test_generator_resume_hits(self):
+        # A generator resuming in the middle of a line does not count another
+        # hit of that line, whatever the engine.
+        engines = ['settrace'] + (['monitoring'] if monitoring_available()
+            else [])
+        for engine in engines:
+            profile = LineProfiler(countdown, engine=engine)
+            profile.runcall(drain, countdown(3))
+            timings = profile.code_map[countdown.__code__].astuples()
+            self.assertEqual([nhits for lineno, nhits, time in timings],
+                [4, 3])
+
+    @unittest.skipUnless(sys.version_info >= (3, 7), 'needs Python 3.7+')
+    def test_code_tables_freed(self):
+        # The tables cached for a code object do not keep it alive.
+        engines = ['settrace'] + (['monitoring'] if monitoring_available()
+            else [])
+        for engine in engines:
+            ns = {}
+            exec('def gen(n):\n'
+                '    while n > 0:\n'
+                '        yield n\n'
+                '        n -= 1\n', ns)
+            code_ref = weakref.ref(ns['gen'].__code__)
+            profile = LineProfiler(engine=engine, asyncio=True)
+            profile.add_line(ns['gen'], 3)
+            profile.runcall(drain, ns['gen'](3))
+            del profile, ns
+            gc.collect()
+            self.assertIsNone(code_ref())
 
     def test_gen_decorator(self):
         profile = LineProfiler()
@@ -86,14 +1066,14 @@ class TestLineProfiler(unittest.TestCase):
         self.assertEqual(profile.enable_count, 0)
         self.assertEqual(next(i), 20)
         self.assertEqual(profile.enable_count, 0)
-        self.assertEqual(len(timings), 1)
+        self.assertEqual(len(timings.astuples()), 1)
         self.assertEqual(i.send(30), 50)
         self.assertEqual(profile.enable_count, 0)
-        self.assertEqual(len(timings), 2)
+        self.assertEqual(len(timings.astuples()), 2)
         with self.assertRaises(StopIteration):
             next(i)
         self.assertEqual(profile.enable_count, 0)
 
-        self.assertEqual(len(timings), 2)
-        for timing in timings.values():
-            self.assertEqual(timing.nhits, 1)
+        self.assertEqual(len(timings.astuples()), 2)
+        for lineno, nhits, time in timings.astuples():
+            self.assertEqual(nhits, 1)
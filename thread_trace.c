@@ -0,0 +1,95 @@
+/* Install C trace functions on threads other than the calling one. */
+
+#include "Python.h"
+#include "frameobject.h"
+
+#include "thread_trace.h"
+
+/* PyEval_SetTrace() only affects the calling thread. From Python 3.9 to 3.11,
+ * _PyEval_SetTrace() takes the thread state to trace instead, and the target
+ * is not running Python code since we hold the GIL. Older versions have no
+ * such function, so the calling thread briefly borrows the thread state of the
+ * target. Python 3.12 aborts on that in debug mode and makes
+ * PyEval_SetTraceAllThreads() the way to trace other threads, so there only
+ * the calling thread can be traced here; see set_trace_all_threads(). Returns
+ * -1 if there is no such thread in the current interpreter, or if it cannot be
+ * traced.
+ */
+int
+set_thread_trace(unsigned long thread_id, Py_tracefunc func, PyObject *arg)
+{
+    PyThreadState *current = PyThreadState_Get();
+    PyThreadState *tstate;
+#if PY_VERSION_HEX >= 0x03090000
+    PyInterpreterState *interp = PyThreadState_GetInterpreter(current);
+#else
+    PyInterpreterState *interp = current->interp;
+#endif
+
+    for (tstate = PyInterpreterState_ThreadHead(interp); tstate != NULL;
+         tstate = PyThreadState_Next(tstate)) {
+        if ((unsigned long)tstate->thread_id != thread_id)
+            continue;
+        if (tstate == current) {
+            PyEval_SetTrace(func, arg);
+        }
+        else {
+#if PY_VERSION_HEX >= 0x030C0000
+            return -1;
+#elif PY_VERSION_HEX >= 0x03090000
+            /* The audit hook of sys.settrace can fail, which PyEval_SetTrace()
+             * also only reports. */
+            if (_PyEval_SetTrace(tstate, func, arg) < 0)
+                PyErr_WriteUnraisable(NULL);
+#else
+            PyThreadState_Swap(tstate);
+            PyEval_SetTrace(func, arg);
+            PyThreadState_Swap(current);
+#endif
+        }
+        return 0;
+    }
+    return -1;
+}
+
+int
+unset_thread_trace(unsigned long thread_id)
+{
+    return set_thread_trace(thread_id, NULL, NULL);
+}
+
+/* Install the same trace function and argument on every thread of the
+ * interpreter. Returns -1 before Python 3.12, which has no safe way to do it.
+ */
+int
+set_trace_all_threads(Py_tracefunc func, PyObject *arg)
+{
+#if PY_VERSION_HEX >= 0x030C0000
+    PyEval_SetTraceAllThreads(func, arg);
+    return 0;
+#else
+    return -1;
+#endif
+}
+
+int
+unset_trace_all_threads(void)
+{
+    return set_trace_all_threads(NULL, NULL);
+}
+
+/* Return an identifier of the calling thread's state. Unlike the thread id,
+ * it is never reused by a later thread. Returns 0 before Python 3.7, which
+ * has no such identifier.
+ */
+unsigned long long
+current_thread_state_id(void)
+{
+#if PY_VERSION_HEX >= 0x03090000
+    return PyThreadState_GetID(PyThreadState_Get());
+#elif PY_VERSION_HEX >= 0x03070000
+    return PyThreadState_Get()->id;
+#else
+    return 0;
+#endif
+}
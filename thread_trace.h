@@ -0,0 +1,7 @@
+#include "Python.h"
+
+int set_thread_trace(unsigned long thread_id, Py_tracefunc func, PyObject *arg);
+int unset_thread_trace(unsigned long thread_id);
+int set_trace_all_threads(Py_tracefunc func, PyObject *arg);
+int unset_trace_all_threads(void);
+unsigned long long current_thread_state_id(void);
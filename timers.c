@@ -1,27 +1,43 @@
 #include "Python.h"
+#include <string.h>
 
-/* The following timer code comes from Python 2.5.2's _lsprof.c */
+#include "timers.h"
+
+/* The following timer code started from Python 2.5.2's _lsprof.c, but now
+ * provides several selectable backends. Each backend returns an integer count
+ * of ticks and has a fixed number of seconds per tick.
+ *
+ *   gettimeofday   Wall clock with microsecond resolution. Not monotonic.
+ *   monotonic      clock_gettime(CLOCK_MONOTONIC) in nanoseconds.
+ *   monotonic_raw  clock_gettime(CLOCK_MONOTONIC_RAW) in nanoseconds. Not
+ *                  slewed by NTP.
+ *   qpc            QueryPerformanceCounter (Windows only).
+ *   tsc            The x86 time stamp counter, calibrated at first use against
+ *                  the monotonic clock. Only meaningful on CPUs with an
+ *                  invariant TSC.
+ *
+ * hpTimer()/hpTimerUnit() use the default backend: qpc on Windows, monotonic
+ * where clock_gettime() is available, and gettimeofday otherwise.
+ */
 
 #if !defined(HAVE_LONG_LONG)
 #error "This module requires long longs!"
 #endif
 
-/*** Selection of a high-precision timer ***/
-
 #ifdef MS_WINDOWS
 
 #include <windows.h>
 
-PY_LONG_LONG
-hpTimer(void)
+static PY_LONG_LONG
+qpcTimer(void)
 {
         LARGE_INTEGER li;
         QueryPerformanceCounter(&li);
         return li.QuadPart;
 }
 
-double
-hpTimerUnit(void)
+static double
+qpcTimerUnit(void)
 {
         LARGE_INTEGER li;
         if (QueryPerformanceFrequency(&li))
@@ -30,21 +46,24 @@ hpTimerUnit(void)
                 return 0.000001;  /* unlikely */
 }
 
+#define LP_DEFAULT_TIMER "qpc"
+#define referenceTimer qpcTimer
+#define referenceTimerUnit qpcTimerUnit
+
 #else  /* !MS_WINDOWS */
 
-#ifndef HAVE_GETTIMEOFDAY
-#error "This module requires gettimeofday() on non-Windows platforms!"
-#endif
+#include <time.h>
 
 #if (defined(PYOS_OS2) && defined(PYCC_GCC))
 #include <sys/time.h>
 #else
+#include <sys/time.h>
 #include <sys/resource.h>
 #include <sys/times.h>
 #endif
 
-PY_LONG_LONG
-hpTimer(void)
+static PY_LONG_LONG
+gettimeofdayTimer(void)
 {
         struct timeval tv;
         PY_LONG_LONG ret;
@@ -58,11 +77,160 @@ hpTimer(void)
         return ret;
 }
 
-double
-hpTimerUnit(void)
+static double
+gettimeofdayTimerUnit(void)
 {
         return 0.000001;
 }
 
+#if defined(HAVE_CLOCK_GETTIME) && defined(CLOCK_MONOTONIC)
+
+static PY_LONG_LONG
+monotonicTimer(void)
+{
+        struct timespec ts;
+        PY_LONG_LONG ret;
+        clock_gettime(CLOCK_MONOTONIC, &ts);
+        ret = ts.tv_sec;
+        ret = ret * 1000000000 + ts.tv_nsec;
+        return ret;
+}
+
+#ifdef CLOCK_MONOTONIC_RAW
+static PY_LONG_LONG
+monotonicRawTimer(void)
+{
+        struct timespec ts;
+        PY_LONG_LONG ret;
+        clock_gettime(CLOCK_MONOTONIC_RAW, &ts);
+        ret = ts.tv_sec;
+        ret = ret * 1000000000 + ts.tv_nsec;
+        return ret;
+}
+#endif  /* CLOCK_MONOTONIC_RAW */
+
+static double
+nanosecondTimerUnit(void)
+{
+        return 0.000000001;
+}
+
+#define LP_DEFAULT_TIMER "monotonic"
+#define referenceTimer monotonicTimer
+#define referenceTimerUnit nanosecondTimerUnit
+
+#else  /* !HAVE_CLOCK_GETTIME */
+
+#define LP_DEFAULT_TIMER "gettimeofday"
+#define referenceTimer gettimeofdayTimer
+#define referenceTimerUnit gettimeofdayTimerUnit
+
+#endif  /* HAVE_CLOCK_GETTIME */
+
 #endif  /* MS_WINDOWS */
 
+
+/*** The x86 time stamp counter ***/
+
+#if defined(_MSC_VER) && (defined(_M_X64) || defined(_M_IX86))
+#include <intrin.h>
+#define LP_HAVE_TSC
+#elif (defined(__GNUC__) || defined(__clang__)) && \
+      (defined(__x86_64__) || defined(__i386__))
+#include <x86intrin.h>
+#define LP_HAVE_TSC
+#endif
+
+#ifdef LP_HAVE_TSC
+
+static double tsc_unit = 0.0;
+
+static PY_LONG_LONG
+tscTimer(void)
+{
+        return (PY_LONG_LONG)__rdtsc();
+}
+
+/* Calibrate the TSC against the reference clock by spinning for about 20 ms.
+ * This happens once, the first time the tsc backend is requested.
+ */
+static double
+tscTimerUnit(void)
+{
+        PY_LONG_LONG ref0, ref1, tsc0, tsc1;
+        double ref_unit;
+
+        if (tsc_unit > 0.0)
+                return tsc_unit;
+        ref_unit = referenceTimerUnit();
+        ref0 = referenceTimer();
+        tsc0 = tscTimer();
+        do {
+                ref1 = referenceTimer();
+        } while ((ref1 - ref0) * ref_unit < 0.02);
+        tsc1 = tscTimer();
+        if (tsc1 <= tsc0)
+                return 0.0;
+        tsc_unit = (ref1 - ref0) * ref_unit / (double)(tsc1 - tsc0);
+        return tsc_unit;
+}
+
+#endif  /* LP_HAVE_TSC */
+
+
+PY_LONG_LONG
+hpTimer(void)
+{
+        return referenceTimer();
+}
+
+double
+hpTimerUnit(void)
+{
+        return referenceTimerUnit();
+}
+
+const char *
+hpTimerDefaultName(void)
+{
+        return LP_DEFAULT_TIMER;
+}
+
+hpTimerFunc
+hpTimerLookup(const char *name, double *unit)
+{
+        if (name == NULL || strcmp(name, "default") == 0)
+                name = LP_DEFAULT_TIMER;
+#ifdef MS_WINDOWS
+        if (strcmp(name, "qpc") == 0) {
+                *unit = qpcTimerUnit();
+                return qpcTimer;
+        }
+#else
+        if (strcmp(name, "gettimeofday") == 0) {
+                *unit = gettimeofdayTimerUnit();
+                return gettimeofdayTimer;
+        }
+#if defined(HAVE_CLOCK_GETTIME) && defined(CLOCK_MONOTONIC)
+        if (strcmp(name, "monotonic") == 0) {
+                *unit = nanosecondTimerUnit();
+                return monotonicTimer;
+        }
+#ifdef CLOCK_MONOTONIC_RAW
+        if (strcmp(name, "monotonic_raw") == 0) {
+                *unit = nanosecondTimerUnit();
+                return monotonicRawTimer;
+        }
+#endif
+#endif
+#endif  /* MS_WINDOWS */
+#ifdef LP_HAVE_TSC
+        if (strcmp(name, "tsc") == 0) {
+                *unit = tscTimerUnit();
+                if (*unit <= 0.0)
+                        return NULL;
+                return tscTimer;
+        }
+#endif
+        return NULL;
+}
@@ -1,4 +1,8 @@
 #include "Python.h"
 
+typedef PY_LONG_LONG (*hpTimerFunc)(void);
+
 PY_LONG_LONG hpTimer(void);
 double hpTimerUnit(void);
+const char *hpTimerDefaultName(void);
+hpTimerFunc hpTimerLookup(const char *name, double *unit);
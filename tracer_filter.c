@@ -0,0 +1,195 @@
+/* Cheap filters that keep the trace callback away from unprofiled code. */
+
+#include "Python.h"
+#include "frameobject.h"
+#include "structmember.h"
+
+#include "tracer_filter.h"
+
+/* Code objects registered with any LineProfiler are tagged through one of the
+ * per-code "extra" slots added in Python 3.6 (PEP 523), so the callback can
+ * reject other code with an array read instead of a dictionary lookup. On
+ * older versions every code object counts as tagged and the callback falls
+ * back to the dictionary.
+ */
+
+#if PY_VERSION_HEX >= 0x03060000
+static Py_ssize_t tag_index = -1;
+#endif
+
+int
+tag_code(PyObject *code)
+{
+#if PY_VERSION_HEX >= 0x03060000
+    if (tag_index < 0) {
+        tag_index = _PyEval_RequestCodeExtraIndex(NULL);
+        if (tag_index < 0)
+            return -1;
+    }
+    return _PyCode_SetExtra(code, tag_index, (void *)1);
+#else
+    return 0;
+#endif
+}
+
+int
+code_is_tagged(PyObject *code)
+{
+#if PY_VERSION_HEX >= 0x03060000
+    void *extra = NULL;
+    if (tag_index < 0)
+        return 0;
+    if (_PyCode_GetExtra(code, tag_index, &extra) < 0) {
+        PyErr_Clear();
+        return 1;
+    }
+    return extra != NULL;
+#else
+    return 1;
+#endif
+}
+
+/* The sys.monitoring engine finds the profilers of a code object through
+ * another extra slot, which owns a reference to an object of its choosing. The
+ * object is set once per code object and then only changed in place.
+ */
+
+#if PY_VERSION_HEX >= 0x03060000
+static Py_ssize_t entry_index = -1;
+
+static void
+free_entry(void *entry)
+{
+    Py_XDECREF((PyObject *)entry);
+}
+#endif
+
+int
+set_code_entry(PyObject *code, PyObject *entry)
+{
+#if PY_VERSION_HEX >= 0x03060000
+    if (entry_index < 0) {
+        entry_index = _PyEval_RequestCodeExtraIndex(free_entry);
+        if (entry_index < 0) {
+            PyErr_SetString(PyExc_RuntimeError,
+                            "No free code extra slot for line_profiler.");
+            return -1;
+        }
+    }
+    Py_INCREF(entry);
+    if (_PyCode_SetExtra(code, entry_index, entry) < 0) {
+        Py_DECREF(entry);
+        return -1;
+    }
+    return 0;
+#else
+    PyErr_SetString(PyExc_RuntimeError,
+                    "Code extra slots require Python 3.6 or later.");
+    return -1;
+#endif
+}
+
+/* Return a borrowed reference to the object set for `code`, or NULL. */
+PyObject *
+get_code_entry(PyObject *code)
+{
+#if PY_VERSION_HEX >= 0x03060000
+    void *entry = NULL;
+    if (entry_index < 0)
+        return NULL;
+    if (_PyCode_GetExtra(code, entry_index, &entry) < 0) {
+        PyErr_Clear();
+        return NULL;
+    }
+    return (PyObject *)entry;
+#else
+    return NULL;
+#endif
+}
+
+/* Stop a frame from producing line events, even for C trace functions. This
+ * is what the f_trace_lines attribute from Python 3.7 does; earlier versions
+ * have no equivalent. Generators and coroutines are left alone, since their
+ * frames can resume after the profiler is disabled. The frames of other code
+ * cannot, and restore_line_events() switches their events back on for the
+ * frames that are still running then. Returns 1 if line events were disabled.
+ */
+
+#define SUSPENDABLE_FLAGS (CO_GENERATOR | CO_COROUTINE | \
+                           CO_ITERABLE_COROUTINE | CO_ASYNC_GENERATOR)
+
+#if PY_VERSION_HEX >= 0x030B0000
+/* f_trace_lines became private in Python 3.11, but it is still a member of
+ * frame objects, so it can be set through its offset instead of by name.
+ * 0 until looked up, -1 if it is not a boolean member.
+ */
+static Py_ssize_t trace_lines_offset = 0;
+
+static int
+set_trace_lines(PyFrameObject *frame, int value)
+{
+    if (trace_lines_offset == 0) {
+        PyMemberDef *member = PyFrame_Type.tp_members;
+        trace_lines_offset = -1;
+        for (; member != NULL && member->name != NULL; member++) {
+            if (strcmp(member->name, "f_trace_lines") == 0 &&
+                    member->type == T_BOOL) {
+                trace_lines_offset = member->offset;
+                break;
+            }
+        }
+    }
+    if (trace_lines_offset > 0) {
+        *((char *)frame + trace_lines_offset) = (char)value;
+        return 1;
+    }
+    if (PyObject_SetAttrString((PyObject *)frame, "f_trace_lines",
+                               value ? Py_True : Py_False) < 0) {
+        PyErr_Clear();
+        return 0;
+    }
+    return 1;
+}
+#elif PY_VERSION_HEX >= 0x03070000
+static int
+set_trace_lines(PyFrameObject *frame, int value)
+{
+    frame->f_trace_lines = (char)value;
+    return 1;
+}
+#endif
+
+int
+disable_line_events(PyFrameObject *frame, PyObject *code)
+{
+#if PY_VERSION_HEX >= 0x03070000
+    if (((PyCodeObject *)code)->co_flags & SUSPENDABLE_FLAGS)
+        return 0;
+    return set_trace_lines(frame, 0);
+#else
+    return 0;
+#endif
+}
+
+void
+restore_line_events(PyFrameObject *frame)
+{
+#if PY_VERSION_HEX >= 0x03090000
+    Py_XINCREF(frame);
+    while (frame != NULL) {
+        PyFrameObject *back;
+        PyCodeObject *code = PyFrame_GetCode(frame);
+        if (!code_is_tagged((PyObject *)code))
+            set_trace_lines(frame, 1);
+        Py_DECREF(code);
+        back = PyFrame_GetBack(frame);
+        Py_DECREF(frame);
+        frame = back;
+    }
+#elif PY_VERSION_HEX >= 0x03070000
+    for (; frame != NULL; frame = frame->f_back) {
+        if (!code_is_tagged((PyObject *)frame->f_code))
+            frame->f_trace_lines = 1;
+    }
+#endif
+}
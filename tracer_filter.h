@@ -0,0 +1,9 @@
+#include "Python.h"
+#include "frameobject.h"
+
+int tag_code(PyObject *code);
+int code_is_tagged(PyObject *code);
+int set_code_entry(PyObject *code, PyObject *entry);
+PyObject *get_code_entry(PyObject *code);
+int disable_line_events(PyFrameObject *frame, PyObject *code);
+void restore_line_events(PyFrameObject *frame);